@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Deterministic synthetic UMI amplicon data for the benchmarks.
+
+From one seed, writes a consistent set of inputs for the bin/ scripts:
+- reference.fa           amplicon sequences (one contig per amplicon)
+- raw_R1.fastq           UMI + insert, as before umi_tools extract
+- extracted_R1.fastq     insert only, UMI appended to the read name (umi_tools style)
+- umi_only.fastq         UMI bases and qualities (extract_umi_with_quality.py output)
+- grouped.bam            coordinate-sorted alignments with UG/BX tags (umi_tools group style)
+- counts.featureCounts.tsv  molecules per amplicon (featureCounts layout)
+- manifest.json          parameters, realised counts and file names
+
+Molecules are allocated to amplicons with lognormal abundance skew, family
+sizes are drawn from the chosen distribution and every base of the UMI and
+insert is substituted with probability --error-rate. Reads are generated in
+chunks, so memory stays bounded at the 100M-read scale.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+FAMILY_SIZE_DISTRIBUTIONS = ('geometric', 'poisson', 'lognormal', 'fixed')
+
+# Molecules generated per chunk
+CHUNK_MOLECULES = 100_000
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Generate deterministic synthetic UMI amplicon data')
+    parser.add_argument('--outdir', required=True, help='Output directory')
+    parser.add_argument('--reads', type=int, default=1_000_000, help='Number of reads (default: 1000000)')
+    parser.add_argument('--umi-length', type=int, default=12, help='UMI length (default: 12)')
+    parser.add_argument('--read-length', type=int, default=100, help='Insert bases per read (default: 100)')
+    parser.add_argument('--amplicons', type=int, default=1000, help='Number of amplicons (default: 1000)')
+    parser.add_argument('--amplicon-length', type=int, default=150, help='Amplicon length (default: 150)')
+    parser.add_argument('--amplicon-skew', type=float, default=1.0,
+                        help='Sigma of the lognormal amplicon abundance; 0 for uniform (default: 1.0)')
+    parser.add_argument('--family-size-dist', choices=FAMILY_SIZE_DISTRIBUTIONS, default='geometric',
+                        help='Reads-per-molecule distribution (default: geometric)')
+    parser.add_argument('--family-size-mean', type=float, default=4.0, help='Mean family size (default: 4.0)')
+    parser.add_argument('--family-size-sigma', type=float, default=1.0,
+                        help='Sigma for the lognormal family-size distribution (default: 1.0)')
+    parser.add_argument('--error-rate', type=float, default=0.001,
+                        help='Per-base substitution rate in UMI and insert (default: 0.001)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+    parser.add_argument('--no-bam', action='store_true', help='Skip the grouped BAM (needs pysam)')
+    return parser.parse_args()
+
+
+def draw_family_sizes(rng, n_reads, distribution, mean, sigma=1.0):
+    """
+    Draw molecule family sizes summing to exactly n_reads.
+    
+    Returns:
+        np.ndarray: Family sizes (int32), the last one trimmed to fit
+    """
+    sizes = []
+    total = 0
+    while total < n_reads:
+        n = max(1024, int((n_reads - total) / mean * 1.05))
+        if distribution == 'geometric':
+            batch = rng.geometric(1.0 / mean, n)
+        elif distribution == 'poisson':
+            batch = 1 + rng.poisson(mean - 1.0, n)
+        elif distribution == 'lognormal':
+            batch = np.maximum(1, np.rint(rng.lognormal(np.log(mean) - sigma ** 2 / 2, sigma, n)))
+        else:
+            batch = np.full(n, max(1, int(round(mean))))
+        batch = batch.astype(np.int32)
+        sizes.append(batch)
+        total += int(batch.sum())
+    
+    sizes = np.concatenate(sizes)
+    cumulative = np.cumsum(sizes, dtype=np.int64)
+    last = int(np.searchsorted(cumulative, n_reads))
+    sizes = sizes[:last + 1]
+    sizes[-1] -= cumulative[last] - n_reads
+    return sizes
+
+
+def mutate(rng, codes, error_rate):
+    """Substitute each base (0-3 code) with another base with probability error_rate."""
+    if error_rate <= 0:
+        return codes
+    errors = rng.random(codes.shape) < error_rate
+    codes[errors] = (codes[errors] + rng.integers(1, 4, int(errors.sum()), dtype=np.uint8)) % 4
+    return codes
+
+
+def as_strings(matrix):
+    """Rows of a uint8 ASCII matrix as a list of bytes objects."""
+    if matrix.shape[1] == 0:
+        return [b''] * matrix.shape[0]
+    return np.ascontiguousarray(matrix).view(f'S{matrix.shape[1]}').ravel().tolist()
+
+
+def write_reference(path, amplicon_codes):
+    """Write amplicon sequences as a FASTA file."""
+    with open(path, 'wb') as f:
+        for i, codes in enumerate(amplicon_codes):
+            f.write(b'>%s\n%s\n' % (amplicon_name(i).encode(), BASES[codes].tobytes()))
+
+
+def amplicon_name(index):
+    return f'amplicon_{index + 1:06d}'
+
+
+def write_counts(path, molecules_per_amplicon, amplicon_length):
+    """Write molecules per amplicon in featureCounts layout."""
+    with open(path, 'w') as f:
+        f.write('# Program:featureCounts v2.0.1; Command:"synthetic"\n')
+        f.write('Geneid\tChr\tStart\tEnd\tStrand\tLength\tsynthetic.dedup.bam\n')
+        for i, count in enumerate(molecules_per_amplicon):
+            name = amplicon_name(i)
+            f.write(f'{name}\t{name}\t1\t{amplicon_length}\t+\t{amplicon_length}\t{count}\n')
+
+
+def generate(outdir, reads=1_000_000, umi_length=12, read_length=100, amplicons=1000, amplicon_length=150,
+             amplicon_skew=1.0, family_size_dist='geometric', family_size_mean=4.0, family_size_sigma=1.0,
+             error_rate=0.001, seed=42, bam=True):
+    """
+    Generate a synthetic data set in outdir.
+    
+    Returns:
+        dict: The manifest (also written to outdir/manifest.json)
+    """
+    if read_length > amplicon_length:
+        raise ValueError('--read-length must not exceed --amplicon-length')
+    if family_size_mean < 1:
+        raise ValueError('--family-size-mean must be at least 1')
+    
+    params = {
+        'reads': reads, 'umi_length': umi_length, 'read_length': read_length, 'amplicons': amplicons,
+        'amplicon_length': amplicon_length, 'amplicon_skew': amplicon_skew,
+        'family_size_dist': family_size_dist, 'family_size_mean': family_size_mean,
+        'family_size_sigma': family_size_sigma, 'error_rate': error_rate, 'seed': seed
+    }
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    
+    # Amplicons, their abundance and the molecules drawn from each
+    amplicon_codes = rng.integers(0, 4, (amplicons, amplicon_length), dtype=np.uint8)
+    weights = rng.lognormal(0.0, amplicon_skew, amplicons) if amplicon_skew > 0 else np.ones(amplicons)
+    weights /= weights.sum()
+    sizes = draw_family_sizes(rng, reads, family_size_dist, family_size_mean, family_size_sigma)
+    molecules_per_amplicon = rng.multinomial(len(sizes), weights)
+    molecule_amplicon = np.repeat(np.arange(amplicons, dtype=np.int32), molecules_per_amplicon)
+    
+    files = {
+        'reference': 'reference.fa',
+        'raw_fastq': 'raw_R1.fastq',
+        'extracted_fastq': 'extracted_R1.fastq',
+        'umi_fastq': 'umi_only.fastq',
+        'counts': 'counts.featureCounts.tsv'
+    }
+    write_reference(os.path.join(outdir, files['reference']), amplicon_codes)
+    write_counts(os.path.join(outdir, files['counts']), molecules_per_amplicon, amplicon_length)
+    
+    bam_writer = None
+    if bam:
+        try:
+            import pysam
+        except ImportError:
+            print("WARNING: pysam not installed, skipping grouped.bam", file=sys.stderr)
+        else:
+            files['grouped_bam'] = 'grouped.bam'
+            header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+                      'SQ': [{'SN': amplicon_name(i), 'LN': amplicon_length} for i in range(amplicons)]}
+            bam_writer = pysam.AlignmentFile(os.path.join(outdir, files['grouped_bam']), 'wb', header=header)
+    
+    raw = open(os.path.join(outdir, files['raw_fastq']), 'wb')
+    extracted = open(os.path.join(outdir, files['extracted_fastq']), 'wb')
+    umi_only = open(os.path.join(outdir, files['umi_fastq']), 'wb')
+    
+    read_offset = 0
+    try:
+        for start in range(0, len(sizes), CHUNK_MOLECULES):
+            chunk_sizes = sizes[start:start + CHUNK_MOLECULES]
+            n_molecules = len(chunk_sizes)
+            molecule_ids = np.arange(start, start + n_molecules)
+    
+            # One true UMI per molecule; every read of the family copies it with errors
+            umis = rng.integers(0, 4, (n_molecules, umi_length), dtype=np.uint8)
+            read_molecule = np.repeat(np.arange(n_molecules), chunk_sizes)
+            n = len(read_molecule)
+            read_umis = mutate(rng, umis[read_molecule], error_rate)
+            inserts = mutate(rng, amplicon_codes[molecule_amplicon[molecule_ids[read_molecule]], :read_length],
+                             error_rate)
+            quals = rng.integers(25, 41, (n, umi_length + read_length), dtype=np.uint8) + 33
+    
+            umi_seqs = as_strings(BASES[read_umis])
+            insert_seqs = as_strings(BASES[inserts])
+            umi_quals = as_strings(quals[:, :umi_length])
+            insert_quals = as_strings(quals[:, umi_length:])
+    
+            # FASTQ order is shuffled (families interleaved, as sequenced);
+            # names follow FASTQ order so every file agrees on them
+            order = rng.permutation(n)
+            names = np.empty(n, dtype=np.int64)
+            names[order] = np.arange(read_offset + 1, read_offset + n + 1)
+    
+            raw.write(b''.join(b'@SYN.%d\n%s%s\n+\n%s%s\n' % (names[i], umi_seqs[i], insert_seqs[i],
+                                                               umi_quals[i], insert_quals[i]) for i in order))
+            extracted.write(b''.join(b'@SYN.%d_%s\n%s\n+\n%s\n' % (names[i], umi_seqs[i], insert_seqs[i],
+                                                                    insert_quals[i]) for i in order))
+            umi_only.write(b''.join(b'@SYN.%d_%s\n%s\n+\n%s\n' % (names[i], umi_seqs[i], umi_seqs[i], umi_quals[i])
+                                    for i in order))
+    
+            # BAM order is by amplicon (all reads start at position 0), i.e. coordinate-sorted
+            if bam_writer is not None:
+                cigar = ((0, read_length),)
+                for i in range(n):
+                    segment = pysam.AlignedSegment(bam_writer.header)
+                    segment.query_name = f'SYN.{names[i]}_{umi_seqs[i].decode()}'
+                    segment.query_sequence = insert_seqs[i].decode()
+                    segment.flag = 0
+                    segment.reference_id = int(molecule_amplicon[start + read_molecule[i]])
+                    segment.reference_start = 0
+                    segment.mapping_quality = 60
+                    segment.cigartuples = cigar
+                    segment.query_qualities = quals[i, umi_length:] - 33
+                    segment.set_tag('UG', int(start + read_molecule[i]))
+                    segment.set_tag('BX', umi_seqs[i].decode())
+                    bam_writer.write(segment)
+    
+            read_offset += n
+    finally:
+        raw.close()
+        extracted.close()
+        umi_only.close()
+        if bam_writer is not None:
+            bam_writer.close()
+    
+    if bam_writer is not None:
+        pysam.index(os.path.join(outdir, files['grouped_bam']))
+    
+    manifest = {
+        'params': params,
+        'reads': int(read_offset),
+        'molecules': int(len(sizes)),
+        'detected_amplicons': int(np.count_nonzero(molecules_per_amplicon)),
+        'files': files
+    }
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    """Main entry point."""
+    args = parse_args()
+    manifest = generate(args.outdir, args.reads, args.umi_length, args.read_length, args.amplicons,
+                        args.amplicon_length, args.amplicon_skew, args.family_size_dist, args.family_size_mean,
+                        args.family_size_sigma, args.error_rate, args.seed, bam=not args.no_bam)
+    print(f"Generated {manifest['reads']:,} reads from {manifest['molecules']:,} molecules over "
+          f"{manifest['detected_amplicons']:,}/{args.amplicons:,} amplicons in {args.outdir}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
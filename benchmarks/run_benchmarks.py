@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Throughput and peak-memory benchmarks for the pipeline's Python code.
+
+Each case runs in a fresh interpreter (spawned process), so its peak RSS is
+not inflated by earlier cases. The data for each scale is generated once
+with generate_synthetic_data.py and reused from --data-dir.
+
+Results can be saved as a named baseline (benchmarks/baselines/NAME.json)
+and later runs compared against it; a case is a regression when its time or
+peak memory grows by more than --tolerance.
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BIN_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'bin')
+BASELINE_DIR = os.path.join(BENCHMARK_DIR, 'baselines')
+sys.path.insert(0, BIN_DIR)
+
+from generate_synthetic_data import generate  # noqa: E402
+from umi_perf import peak_rss_mb  # noqa: E402
+from umi_amplicon.cli import COMMANDS  # noqa: E402
+
+# Named data scales: reads and amplicons of the synthetic library
+SCALES = {
+    '1M': {'reads': 1_000_000, 'amplicons': 1_000},
+    '10M': {'reads': 10_000_000, 'amplicons': 10_000},
+    '100M': {'reads': 100_000_000, 'amplicons': 100_000},
+}
+DEFAULT_TOLERANCE = 0.2
+# Fresh-interpreter runs per startup case
+STARTUP_RUNS = 5
+# --memory-limit of the count_umis_external case
+EXTERNAL_MEMORY_LIMIT = '8M'
+
+
+# Benchmark cases: setup(data) -> (timed callable returning the number of items processed, unit).
+# Only the callable is timed; imports and input loading happen in setup.
+
+def _case_parse_fastq_with_umi(data):
+    from calculate_umi_metrics import parse_fastq_with_umi
+    return (lambda: parse_fastq_with_umi(data['extracted_fastq'])[2]), 'reads'
+
+
+def _case_calculate_metrics(data):
+    from calculate_umi_metrics import calculate_metrics, parse_fastq_with_umi, parse_umi_only_fastq
+    umi_counts, _, total_reads = parse_fastq_with_umi(data['extracted_fastq'])
+    umi_qualities, _ = parse_umi_only_fastq(data['umi_fastq'])
+    umi_length = data['params']['umi_length']
+
+    def run():
+        calculate_metrics(umi_counts, umi_qualities, total_reads, umi_length)
+        return total_reads
+    return run, 'reads'
+
+
+def _case_neighbour_census(data):
+    from calculate_umi_metrics import hamming_neighbour_census, parse_fastq_with_umi
+    umi_counts, _, _ = parse_fastq_with_umi(data['extracted_fastq'])
+    umi_length = data['params']['umi_length']
+    
+    def run():
+        hamming_neighbour_census(umi_counts, umi_length)
+        return len(umi_counts)
+    return run, 'umis'
+
+
+def _case_count_umis_external(data):
+    # Spill-to-disk counting with a budget well below the 1M data set's UMI table
+    from calculate_umi_metrics import ExternalUmiCounter, parse_fastq_with_umi, parse_memory_size, summarize_umi_counts
+    umi_length = data['params']['umi_length']
+    memory_limit = parse_memory_size(EXTERNAL_MEMORY_LIMIT)
+    
+    def run():
+        with ExternalUmiCounter(umi_length, memory_limit, data['scratch']) as counter:
+            _, _, total_reads = parse_fastq_with_umi(data['extracted_fastq'], counter)
+            summarize_umi_counts(counter)
+        return total_reads
+    return run, 'reads'
+
+
+def _case_extract_umi_with_quality(data):
+    from extract_umi_with_quality import extract_umi_with_quality
+    output = os.path.join(data['scratch'], 'umi_only.fastq')
+    return (lambda: extract_umi_with_quality(data['raw_fastq'], data['extracted_fastq'], output,
+                                             data['params']['umi_length'])[0]), 'reads'
+
+
+def _case_build_consensus(data):
+    if 'grouped_bam' not in data:
+        raise RuntimeError('no grouped BAM in the data set (generated without pysam)')
+    from build_umi_consensus import build_consensus, group_reads_by_umi_tools
+    groups = group_reads_by_umi_tools(data['grouped_bam'], min_family_size=2)
+
+    def run():
+        for reads in groups.values():
+            build_consensus(reads)
+        return len(groups)
+    return run, 'families'
+
+
+def _case_calculate_library_coverage(data):
+    from calculate_library_coverage import calculate_coverage_metrics, load_fasta_index, parse_featurecounts
+    total_refs = len(load_fasta_index(data['reference'], data['scratch']))
+
+    def run():
+        feature_ids, counts = parse_featurecounts(data['counts'])
+        calculate_coverage_metrics(feature_ids, counts, total_refs, 'synthetic')
+        return len(feature_ids)
+    return run, 'features'
+
+
+def _case_startup(command, data):
+    # Interpreter start and the imports of one umi-amplicon command (its
+    # --help exits right after argument parsing)
+    argv = [sys.executable, os.path.join(BIN_DIR, 'umi-amplicon'), command, '--help']
+    
+    def run():
+        for _ in range(STARTUP_RUNS):
+            subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+        return STARTUP_RUNS
+    return run, 'starts'
+
+
+CASES = {
+    'parse_fastq_with_umi': _case_parse_fastq_with_umi,
+    'calculate_metrics': _case_calculate_metrics,
+    'neighbour_census': _case_neighbour_census,
+    'count_umis_external': _case_count_umis_external,
+    'extract_umi_with_quality': _case_extract_umi_with_quality,
+    'build_consensus': _case_build_consensus,
+    'calculate_library_coverage': _case_calculate_library_coverage,
+    **{f'startup_{command}': functools.partial(_case_startup, command) for command in COMMANDS},
+}
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Run throughput and peak-memory benchmarks')
+    parser.add_argument('--scale', action='append', choices=list(SCALES),
+                        help='Data scale to run; repeat for several (default: 1M)')
+    parser.add_argument('--case', action='append', choices=list(CASES),
+                        help='Benchmark case to run; repeat for several (default: all)')
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARK_DIR, 'data'),
+                        help='Where synthetic data sets are generated and reused (default: benchmarks/data)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per case; the fastest time and largest peak RSS are kept (default: 1)')
+    parser.add_argument('--seed', type=int, default=42, help='Synthetic data seed (default: 42)')
+    parser.add_argument('--output', help='Write the results JSON here')
+    parser.add_argument('--save-baseline', metavar='NAME', help='Save the results as baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='Compare against baselines/NAME.json (or a JSON path)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help=f'Allowed relative growth of time and peak RSS before a case counts '
+                             f'as a regression (default: {DEFAULT_TOLERANCE})')
+    return parser.parse_args()
+
+
+def ensure_data(data_dir, scale, seed):
+    """Generate the synthetic data set for a scale unless an identical one exists."""
+    params = dict(SCALES[scale], seed=seed)
+    outdir = os.path.join(data_dir, f'{scale}-seed{seed}')
+    manifest_file = os.path.join(outdir, 'manifest.json')
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if all(manifest['params'].get(key) == value for key, value in params.items()):
+            return outdir, manifest
+    
+    print(f"Generating {scale} synthetic data set in {outdir}...", file=sys.stderr)
+    started = time.perf_counter()
+    manifest = generate(outdir, **params)
+    print(f"  done in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    return outdir, manifest
+
+
+def _worker(case, data, queue):
+    """Run one case in this (fresh) process and report timing and memory."""
+    try:
+        rss_before = peak_rss_mb()
+        run, unit = CASES[case](data)
+        rss_setup = peak_rss_mb()
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        items = run()
+        queue.put({
+            'seconds': time.perf_counter() - started,
+            'cpu_seconds': time.process_time() - cpu_started,
+            'items': int(items),
+            'unit': unit,
+            'peak_rss_mb': peak_rss_mb(),
+            'setup_rss_mb': rss_setup,
+            'baseline_rss_mb': rss_before
+        })
+    except Exception as e:
+        queue.put({'error': f'{type(e).__name__}: {e}'})
+
+
+def run_case(case, data, repeat=1):
+    """Run a case `repeat` times, each in a spawned interpreter."""
+    context = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        queue = context.Queue()
+        process = context.Process(target=_worker, args=(case, data, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        if 'error' in result:
+            return result
+        if best is None:
+            best = result
+        else:
+            best['peak_rss_mb'] = max(best['peak_rss_mb'], result['peak_rss_mb'])
+            if result['seconds'] < best['seconds']:
+                best.update(seconds=result['seconds'], cpu_seconds=result['cpu_seconds'])
+    
+    best['throughput'] = best['items'] / best['seconds'] if best['seconds'] > 0 else 0.0
+    # Memory the timed call itself added on top of its inputs
+    best['run_rss_mb'] = max(0.0, best['peak_rss_mb'] - best['setup_rss_mb'])
+    return best
+
+
+def environment_info():
+    """Machine and code identification stored with every result set."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import numpy
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'hostname': platform.node()
+    }
+
+
+def load_baseline(name):
+    """Load a baseline by name (baselines/NAME.json) or path."""
+    path = name if name.endswith('.json') else os.path.join(BASELINE_DIR, f'{name}.json')
+    with open(path) as f:
+        return json.load(f), path
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with a baseline.
+    
+    Returns:
+        list: (key, metric, baseline value, current value, relative change) for
+              every case/metric whose growth exceeds the tolerance
+    """
+    regressions = []
+    print(f"\n{'case':<42} {'time':>10} {'vs base':>9} {'peak MB':>9} {'vs base':>9}")
+    for key, current in results['results'].items():
+        reference = baseline['results'].get(key)
+        if 'error' in current or reference is None or 'error' in reference:
+            print(f"{key:<42} {'(no baseline)' if reference is None else '(skipped)':>10}")
+            continue
+        changes = {}
+        for metric in ('seconds', 'peak_rss_mb'):
+            change = current[metric] / reference[metric] - 1.0 if reference[metric] > 0 else 0.0
+            changes[metric] = change
+            if change > tolerance:
+                regressions.append((key, metric, reference[metric], current[metric], change))
+        print(f"{key:<42} {current['seconds']:>9.2f}s {changes['seconds']:>+8.1%} "
+              f"{current['peak_rss_mb']:>9.0f} {changes['peak_rss_mb']:>+8.1%}")
+    return regressions
+
+
+def main():
+    """Main entry point."""
+    args = parse_args()
+    scales = args.scale or ['1M']
+    cases = args.case or list(CASES)
+    
+    results = {'environment': environment_info(), 'results': {}}
+    for scale in scales:
+        data_dir, manifest = ensure_data(args.data_dir, scale, args.seed)
+        with tempfile.TemporaryDirectory(prefix='umi_bench_') as scratch:
+            data = {key: os.path.join(data_dir, name) for key, name in manifest['files'].items()}
+            data.update(params=manifest['params'], scratch=scratch)
+            for case in cases:
+                key = f'{case}@{scale}'
+                result = run_case(case, data, args.repeat)
+                results['results'][key] = result
+                if 'error' in result:
+                    print(f"{key:<42} skipped: {result['error']}", file=sys.stderr)
+                else:
+                    print(f"{key:<42} {result['seconds']:>9.2f}s {result['throughput']:>12,.0f} "
+                          f"{result['unit']}/s  peak {result['peak_rss_mb']:>7.0f} MB", file=sys.stderr)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'{args.save_baseline}.json')
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved: {path}", file=sys.stderr)
+    
+    if args.compare:
+        baseline, path = load_baseline(args.compare)
+        if baseline['environment'].get('hostname') != results['environment']['hostname']:
+            print(f"WARNING: baseline {path} was recorded on a different machine "
+                  f"({baseline['environment'].get('hostname')}); timings may not be comparable", file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}:", file=sys.stderr)
+            for key, metric, before, after, change in regressions:
+                print(f"  {key} {metric}: {before:.3g} -> {after:.3g} ({change:+.1%})", file=sys.stderr)
+            return 1
+        print(f"\nNo regressions beyond {args.tolerance:.0%} against {path}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Aggregate per-sample UMI QC metrics records into cohort-level tables and a
+single interactive dashboard.
+
+Reads the versioned metrics records written by the QC stages
+(*.umi_metrics.json before deduplication, *.dedup_metrics.json after it) and
+builds, with memory proportional to samples x metrics:
+- a columnar metrics table (one row per sample)
+- a family-size matrix (fraction of UMI families per log2 size bin)
+- a per-position UMI quality matrix
+- robust (median/MAD) z-scores and outlier flags for every metric
+"""
+
+import argparse
+import sys
+import warnings
+
+import numpy as np
+import plotly.graph_objects as go
+
+import umi_perf
+from umi_metrics_schema import ExtractMetrics, DedupMetrics, load_metrics
+from generate_umi_report_plotly import (PLOTLYJS_MODES, figure_div, get_status_color, plotlyjs_tag,
+                                        render_page)
+
+# Metrics compared across samples: (column, record kind, field, label)
+COHORT_COLUMNS = [
+    ('diversity_ratio', 'extract', 'diversity_ratio', 'Diversity ratio'),
+    ('shannon_entropy', 'extract', 'shannon_entropy', 'Shannon entropy'),
+    ('complexity_score', 'extract', 'complexity_score', 'Complexity score'),
+    ('observed_collision_rate', 'extract', 'observed_collision_rate', 'Observed duplication rate'),
+    ('expected_duplicate_rate', 'extract', 'expected_duplicate_rate', 'Expected duplicate rate'),
+    ('mean_family_size', 'extract', 'mean_family_size', 'Mean family size (pre-dedup)'),
+    ('singleton_rate', 'extract', 'singleton_rate', 'Singleton rate'),
+    ('mean_umi_quality', 'extract', 'mean_umi_quality', 'Mean UMI quality'),
+    ('deduplication_rate_pct', 'dedup', 'deduplication_rate_pct', 'Deduplication rate (%)'),
+    ('avg_family_size', 'dedup', 'avg_family_size', 'Mean family size (post-dedup)'),
+    ('singleton_family_rate_pct', 'dedup', 'singleton_family_rate_pct', 'Singleton family rate (%)'),
+    ('error_correction_rate_pct', 'dedup', 'error_correction_rate_pct', 'Error correction rate (%)'),
+]
+
+# Upper edges of the log2 family-size bins: 1, 2, 3-4, 5-8, ... , >512
+FAMILY_SIZE_EDGES = np.array([1, 2, 4, 8, 16, 32, 64, 128, 256, 512])
+FAMILY_SIZE_LABELS = ['1', '2', '3-4', '5-8', '9-16', '17-32', '33-64', '65-128',
+                      '129-256', '257-512', '>512']
+
+# Robust z-score (0.6745 * (x - median) / MAD) beyond which a value is an outlier
+DEFAULT_OUTLIER_Z = 3.5
+
+
+def parse_args():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Aggregate UMI QC metrics records across samples into a cohort dashboard'
+    )
+    parser.add_argument(
+        '--pre-dedup-metrics',
+        nargs='*',
+        default=[],
+        help='Pre-deduplication metrics records (*.umi_metrics.json)'
+    )
+    parser.add_argument(
+        '--post-dedup-metrics',
+        nargs='*',
+        default=[],
+        help='Post-deduplication metrics records (*.dedup_metrics.json)'
+    )
+    parser.add_argument(
+        '--output-prefix',
+        type=str,
+        default='cohort',
+        help='Prefix for output files (default: cohort)'
+    )
+    parser.add_argument(
+        '--outlier-z',
+        type=float,
+        default=DEFAULT_OUTLIER_Z,
+        help=f'Robust z-score threshold for outlier flags (default: {DEFAULT_OUTLIER_Z})'
+    )
+    parser.add_argument(
+        '--plotlyjs',
+        choices=PLOTLYJS_MODES,
+        default='cdn',
+        help="How the dashboard loads plotly.js (default: cdn)"
+    )
+    umi_perf.add_perf_arguments(parser)
+    return parser.parse_args()
+
+
+def bin_family_sizes(distribution):
+    """
+    Bin one family-size distribution into FAMILY_SIZE_EDGES log2 bins.
+    
+    Args:
+        distribution: Mapping of family size (str or int) -> number of families
+    
+    Returns:
+        np.ndarray: Number of families per bin, length len(FAMILY_SIZE_LABELS)
+    """
+    if not distribution:
+        return np.zeros(len(FAMILY_SIZE_LABELS))
+    sizes = np.fromiter((int(size) for size in distribution), dtype=np.int64, count=len(distribution))
+    counts = np.fromiter(distribution.values(), dtype=np.float64, count=len(distribution))
+    bins = np.searchsorted(FAMILY_SIZE_EDGES, sizes, side='left')
+    return np.bincount(bins, weights=counts, minlength=len(FAMILY_SIZE_LABELS))
+
+
+def load_cohort(pre_files, post_files):
+    """
+    Load metrics records into columnar arrays, one record at a time.
+    
+    Only the cohort columns, the binned family sizes and the per-position
+    mean qualities are kept, so memory grows with samples x metrics.
+    
+    Returns:
+        dict: samples (list), columns (n_samples x n_columns, NaN where
+              missing), family_sizes (n_samples x n_bins, family counts),
+              position_quality (n_samples x max UMI length, NaN padded)
+    """
+    samples = []
+    index = {}
+    rows = []
+    family_rows = {}
+    quality_rows = {}
+    column_index = {(kind, name): j for j, (_, kind, name, _) in enumerate(COHORT_COLUMNS)}
+    
+    for metrics_file in list(pre_files) + list(post_files):
+        record = load_metrics(metrics_file)
+        if record.sample not in index:
+            index[record.sample] = len(samples)
+            samples.append(record.sample)
+            rows.append(np.full(len(COHORT_COLUMNS), np.nan))
+        i = index[record.sample]
+    
+        for (kind, name), j in column_index.items():
+            if kind == record.KIND:
+                rows[i][j] = getattr(record, name)
+    
+        # Post-dedup family sizes are complete (pre-dedup ones are capped for
+        # display), so they take precedence when both are present
+        if record.family_size_distribution and (isinstance(record, DedupMetrics) or i not in family_rows):
+            family_rows[i] = bin_family_sizes(record.family_size_distribution)
+    
+        if isinstance(record, ExtractMetrics) and record.per_position_quality:
+            quality_rows[i] = np.array([pos.mean_quality for pos in record.per_position_quality])
+    
+    n_samples = len(samples)
+    family_sizes = np.zeros((n_samples, len(FAMILY_SIZE_LABELS)))
+    for i, row in family_rows.items():
+        family_sizes[i] = row
+    
+    max_length = max((len(row) for row in quality_rows.values()), default=0)
+    position_quality = np.full((n_samples, max_length), np.nan)
+    for i, row in quality_rows.items():
+        position_quality[i, :len(row)] = row
+    
+    columns = np.vstack(rows) if rows else np.empty((0, len(COHORT_COLUMNS)))
+    
+    return {
+        'samples': samples,
+        'columns': columns,
+        'family_sizes': family_sizes,
+        'position_quality': position_quality
+    }
+
+
+def robust_z_scores(values):
+    """
+    Column-wise robust z-scores: 0.6745 * (x - median) / MAD.
+    
+    Columns with zero MAD (no spread) score 0 where equal to the median and
+    +/-inf otherwise; missing values stay NaN.
+    
+    Args:
+        values: 2D array (n_samples x n_metrics), NaN for missing
+    
+    Returns:
+        np.ndarray: Robust z-scores, same shape
+    """
+    if values.size == 0:
+        return np.empty_like(values)
+    
+    # All-NaN columns (e.g. post-dedup metrics in a pre-dedup-only cohort)
+    # stay NaN; nanmedian warns about them through the warnings module
+    with np.errstate(all='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(values, axis=0)
+        deviation = values - median
+        mad = np.nanmedian(np.abs(deviation), axis=0)
+        z = 0.6745 * deviation / mad
+    
+        # Zero spread: equal values are not outliers, anything else is
+        no_spread = mad == 0
+        z[:, no_spread] = np.where(deviation[:, no_spread] == 0, 0.0,
+                                   np.sign(deviation[:, no_spread]) * np.inf)
+    z[np.isnan(values)] = np.nan
+    return z
+
+
+def write_cohort_tables(cohort, z_scores, outliers, output_prefix):
+    """Write the cohort metrics, family-size, quality and outlier tables (TSV)."""
+    samples = cohort['samples']
+    names = [column for column, _, _, _ in COHORT_COLUMNS]
+    
+    def write_matrix(path, header, matrix, fmt):
+        with open(path, 'w') as f:
+            f.write('sample\t' + '\t'.join(header) + '\n')
+            for sample, row in zip(samples, matrix):
+                f.write(sample + '\t' + '\t'.join('NA' if np.isnan(v) else fmt.format(v) for v in row) + '\n')
+    
+    write_matrix(f"{output_prefix}_umi_metrics.tsv", names, cohort['columns'], '{:.6g}')
+    
+    totals = cohort['family_sizes'].sum(axis=1, keepdims=True)
+    fractions = np.divide(cohort['family_sizes'], totals, out=np.zeros_like(cohort['family_sizes']),
+                          where=totals > 0)
+    write_matrix(f"{output_prefix}_family_size_bins.tsv", FAMILY_SIZE_LABELS, fractions, '{:.6f}')
+    
+    positions = [str(pos + 1) for pos in range(cohort['position_quality'].shape[1])]
+    write_matrix(f"{output_prefix}_position_quality.tsv", positions, cohort['position_quality'], '{:.2f}')
+    
+    with open(f"{output_prefix}_umi_outliers.tsv", 'w') as f:
+        f.write('sample\tmetric\tvalue\trobust_z\n')
+        for i, j in zip(*np.nonzero(outliers)):
+            f.write(f"{samples[i]}\t{names[j]}\t{cohort['columns'][i, j]:.6g}\t{z_scores[i, j]:.2f}\n")
+    
+    return fractions
+
+
+def create_heatmap(z, x, y, title, colorscale, zmid=None, text=None, colorbar_title=None):
+    """Heatmap figure sized to the number of samples."""
+    fig = go.Figure(data=go.Heatmap(
+        z=z, x=x, y=y, colorscale=colorscale, zmid=zmid, text=text,
+        hovertemplate='<b>%{y}</b><br>%{x}: %{z:.3f}<extra></extra>' if text is None else
+                      '<b>%{y}</b><br>%{x}: %{text}<extra></extra>',
+        colorbar={'title': colorbar_title} if colorbar_title else None
+    ))
+    fig.update_layout(
+        title=title,
+        template='plotly_white',
+        height=max(400, 22 * len(y) + 200),
+        yaxis={'autorange': 'reversed'}
+    )
+    return fig
+
+
+def generate_cohort_dashboard(cohort, z_scores, outliers, fractions, outlier_z, output_file, plotlyjs='cdn'):
+    """Render the cohort dashboard: outlier table and metric, family-size and quality heatmaps."""
+    samples = cohort['samples']
+    labels = [label for _, _, _, label in COHORT_COLUMNS]
+    
+    # Outlier table
+    flagged = np.nonzero(outliers.any(axis=1))[0]
+    if len(flagged):
+        rows = ''
+        for i in flagged:
+            cells = ', '.join(f"{labels[j]} ({cohort['columns'][i, j]:.4g}, z={z_scores[i, j]:.1f})"
+                              for j in np.nonzero(outliers[i])[0])
+            rows += f'<tr><td>{samples[i]}</td><td style="text-align: left;">{cells}</td></tr>'
+        outlier_html = f'<table class="cohort-table"><tr><th>Sample</th><th style="text-align: left;">Outlying metrics</th></tr>{rows}</table>'
+    else:
+        outlier_html = '<p>✅ No sample has a metric beyond the outlier threshold.</p>'
+    
+    # Robust z-score heatmap, clipped so single extreme values do not wash out the scale
+    display_z = np.clip(np.nan_to_num(z_scores, nan=0.0, posinf=10.0, neginf=-10.0), -10, 10)
+    value_text = [[f'{v:.4g} (z={z:.1f})' if not np.isnan(v) else 'NA'
+                   for v, z in zip(row, z_row)] for row, z_row in zip(cohort['columns'], z_scores)]
+    plots_html = f'<div class="plot-container">{figure_div(create_heatmap(display_z, labels, samples, f"Robust z-scores per metric (|z| > {outlier_z} flagged)", "RdBu_r", zmid=0, text=value_text, colorbar_title="z"), "cohort_z")}</div>'
+    
+    plots_html += f'<div class="plot-container">{figure_div(create_heatmap(fractions, FAMILY_SIZE_LABELS, samples, "Family size distribution (fraction of UMI families per size bin)", "Blues", colorbar_title="fraction"), "cohort_family_size")}</div>'
+    
+    if cohort['position_quality'].size:
+        positions = [str(pos + 1) for pos in range(cohort['position_quality'].shape[1])]
+        plots_html += f'<div class="plot-container">{figure_div(create_heatmap(cohort["position_quality"], positions, samples, "Mean UMI base quality by position", "Viridis", colorbar_title="Phred"), "cohort_position_quality")}</div>'
+    
+    # Per-metric strip of sample values, coloured by the report thresholds
+    for j, (column, _, _, label) in enumerate(COHORT_COLUMNS):
+        values = cohort['columns'][:, j]
+        present = ~np.isnan(values)
+        if not present.any():
+            continue
+        colors = ['#ef4444' if outliers[i, j] else get_status_color(column.replace('observed_', ''), values[i])
+                  for i in np.nonzero(present)[0]]
+        fig = go.Figure(data=[go.Bar(x=[samples[i] for i in np.nonzero(present)[0]], y=values[present],
+                                     marker_color=colors,
+                                     hovertemplate='<b>%{x}</b><br>' + label + ': %{y}<extra></extra>')])
+        fig.update_layout(title=label, template='plotly_white', height=320, showlegend=False)
+        plots_html += f'<div class="plot-container">{figure_div(fig, f"cohort_{column}")}</div>'
+    
+    content = f'''<div class="section">
+                <h2>🚩 Outliers</h2>
+                {outlier_html}
+            </div>
+    
+            <div class="section">
+                <h2>📊 Cohort Overview</h2>
+                {plots_html}
+            </div>'''
+    html = render_page("UMI QC Cohort Dashboard", "🧬 UMI QC Cohort Dashboard",
+                       f"Samples: {len(samples)} | Outlier samples: {len(flagged)}", content,
+                       plotlyjs_tag(plotlyjs, output_file))
+    
+    with open(output_file, 'w') as f:
+        f.write(html)
+    
+    print(f"Cohort dashboard generated: {output_file}", file=sys.stderr)
+
+
+def main():
+    """Main entry point."""
+    args = parse_args()
+    
+    if not args.pre_dedup_metrics and not args.post_dedup_metrics:
+        print("ERROR: No metrics records given", file=sys.stderr)
+        return 1
+    umi_perf.start_from_args('aggregate_umi_cohort', args)
+    umi_perf.count('metrics_records', len(args.pre_dedup_metrics) + len(args.post_dedup_metrics))
+    
+    with umi_perf.stage('load'):
+        cohort = load_cohort(args.pre_dedup_metrics, args.post_dedup_metrics)
+    print(f"Loaded metrics for {len(cohort['samples'])} sample(s)", file=sys.stderr)
+    umi_perf.count('samples', len(cohort['samples']))
+    
+    with umi_perf.stage('compute'):
+        z_scores = robust_z_scores(cohort['columns'])
+        outliers = np.abs(np.nan_to_num(z_scores, nan=0.0)) > args.outlier_z
+    
+    with umi_perf.stage('write'):
+        fractions = write_cohort_tables(cohort, z_scores, outliers, args.output_prefix)
+    with umi_perf.stage('render'):
+        generate_cohort_dashboard(cohort, z_scores, outliers, fractions, args.outlier_z,
+                                  f"{args.output_prefix}_umi_qc_dashboard.html", args.plotlyjs)
+    
+    print(f"Outlier flags: {int(outliers.sum())} across {int(outliers.any(axis=1).sum())} sample(s)",
+          file=sys.stderr)
+    umi_perf.finish()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,16 +2,22 @@
 """
 Build consensus sequences from UMI-grouped reads.
 Simple and fast consensus calling for each UMI family.
+
+With --bam-output, families whose reads share one alignment (reference,
+start, strand and an indel-free CIGAR) are written as an aligned,
+coordinate-sorted consensus BAM directly; only the remaining families are
+written to --realign-fasta for realignment.
 """
 
+import array
+import math
 import pysam
 import argparse
 from collections import defaultdict
-from Bio import SeqIO
-from Bio.Seq import Seq
-from Bio.SeqRecord import SeqRecord
 import sys
 
+import umi_perf
+
 def group_reads_by_umi_tools(bam_file, min_family_size=2):
     """
     Group reads using umi_tools group output tags
@@ -93,7 +99,7 @@ def build_consensus(reads, min_base_quality=20, min_consensus_freq=0.6):
         if freq >= min_consensus_freq:
             consensus_seq.append(most_common[0])
             # Quality = -10*log10(1-freq), capped at 60
-            qual_score = min(60, int(-10 * (-0.001 if freq >= 0.999 else (1 - freq))))
+            qual_score = min(60, int(-10 * math.log10(max(1 - freq, 1e-6))))
             consensus_qual.append(qual_score)
         else:
             consensus_seq.append('N')
@@ -101,97 +107,166 @@ def build_consensus(reads, min_base_quality=20, min_consensus_freq=0.6):
     
     return ''.join(consensus_seq), consensus_qual
 
-def write_consensus_fasta(umi_groups, output_file, min_base_quality=20, min_consensus_freq=0.6):
-    """Write consensus sequences to FASTA"""
-    records = []
-    stats = {
-        'total_groups': len(umi_groups),
-        'consensus_generated': 0,
-        'failed': 0
-    }
+def call_consensus(umi_groups, min_base_quality=20, min_consensus_freq=0.6):
+    """
+    Build the consensus of every UMI family
     
+    Returns:
+        tuple: (list of (group_id, reads, consensus_seq, consensus_qual), failed family count)
+    """
+    called = []
+    failed = 0
     for group_id, reads in umi_groups.items():
         consensus_seq, consensus_qual = build_consensus(reads, min_base_quality, min_consensus_freq)
-        
         if not consensus_seq or len(consensus_seq) == 0:
-            stats['failed'] += 1
+            failed += 1
             continue
-        
+        called.append((group_id, reads, consensus_seq, consensus_qual))
+    return called, failed
+
+def _family_umi(read):
+    """UMI of a family from the BX or RX tag of one of its reads"""
+    if read.has_tag('BX'):
+        return read.get_tag('BX')
+    if read.has_tag('RX'):
+        return read.get_tag('RX')
+    return 'unknown'
+
+def write_called_consensus(called, output_file, output_format='fasta', total_groups=None, failed=0):
+    """Write called consensus sequences to FASTA or FASTQ (with quality scores)"""
+    # Biopython is only needed here, not for grouping, calling or BAM placement
+    from Bio import SeqIO
+    from Bio.Seq import Seq
+    from Bio.SeqRecord import SeqRecord
+    
+    records = []
+    for group_id, reads, consensus_seq, consensus_qual in called:
         # Get info from first read
         first_read = reads[0]
         chrom = first_read.reference_name if first_read.reference_name else 'unknown'
         pos = first_read.reference_start if first_read.reference_start else 0
+        umi = _family_umi(first_read)
         
-        # Get UMI from tags
-        umi = 'unknown'
-        if first_read.has_tag('BX'):
-            umi = first_read.get_tag('BX')
-        elif first_read.has_tag('RX'):
-            umi = first_read.get_tag('RX')
-        
-        # Create record
         record_id = f"{group_id}"
-        avg_qual = sum(consensus_qual) / len(consensus_qual) if consensus_qual else 0
-        description = f"umi={umi} chrom={chrom} pos={pos} reads={len(reads)} avg_qual={avg_qual:.1f}"
-        
-        record = SeqRecord(
-            Seq(consensus_seq),
-            id=record_id,
-            description=description
-        )
+        if output_format == 'fastq':
+            description = f"umi={umi} chrom={chrom} pos={pos} reads={len(reads)}"
+            record = SeqRecord(
+                Seq(consensus_seq),
+                id=record_id,
+                description=description,
+                letter_annotations={"phred_quality": consensus_qual}
+            )
+        else:
+            avg_qual = sum(consensus_qual) / len(consensus_qual) if consensus_qual else 0
+            description = f"umi={umi} chrom={chrom} pos={pos} reads={len(reads)} avg_qual={avg_qual:.1f}"
+            record = SeqRecord(
+                Seq(consensus_seq),
+                id=record_id,
+                description=description
+            )
         records.append(record)
-        stats['consensus_generated'] += 1
     
-    # Write FASTA
-    SeqIO.write(records, output_file, 'fasta')
+    SeqIO.write(records, output_file, output_format)
     
-    return stats
+    return {
+        'total_groups': total_groups if total_groups is not None else len(called) + failed,
+        'consensus_generated': len(records),
+        'failed': failed
+    }
+
+def write_consensus_fasta(umi_groups, output_file, min_base_quality=20, min_consensus_freq=0.6):
+    """Write consensus sequences to FASTA"""
+    called, failed = call_consensus(umi_groups, min_base_quality, min_consensus_freq)
+    return write_called_consensus(called, output_file, 'fasta', len(umi_groups), failed)
 
 def write_consensus_fastq(umi_groups, output_file, min_base_quality=20, min_consensus_freq=0.6):
     """Write consensus sequences to FASTQ with quality scores"""
-    records = []
-    stats = {
-        'total_groups': len(umi_groups),
-        'consensus_generated': 0,
-        'failed': 0
-    }
+    called, failed = call_consensus(umi_groups, min_base_quality, min_consensus_freq)
+    return write_called_consensus(called, output_file, 'fastq', len(umi_groups), failed)
+
+# CIGAR operations that keep a consensus column-aligned with the reference:
+# M, S, H, = and X (no insertions, deletions or skips)
+PLACEABLE_CIGAR_OPS = frozenset((0, 4, 5, 7, 8))
+
+def family_alignment(reads):
+    """
+    Alignment shared by all reads of a family, if the consensus can keep it
     
-    for group_id, reads in umi_groups.items():
-        consensus_seq, consensus_qual = build_consensus(reads, min_base_quality, min_consensus_freq)
-        
-        if not consensus_seq or len(consensus_seq) == 0:
-            stats['failed'] += 1
-            continue
-        
-        # Get info from first read
-        first_read = reads[0]
-        chrom = first_read.reference_name if first_read.reference_name else 'unknown'
-        pos = first_read.reference_start if first_read.reference_start else 0
-        
-        # Get UMI from tags
-        umi = 'unknown'
-        if first_read.has_tag('BX'):
-            umi = first_read.get_tag('BX')
-        elif first_read.has_tag('RX'):
-            umi = first_read.get_tag('RX')
-        
-        # Create FASTQ record with quality scores
-        record_id = f"{group_id}"
-        description = f"umi={umi} chrom={chrom} pos={pos} reads={len(reads)}"
-        
-        record = SeqRecord(
-            Seq(consensus_seq),
-            id=record_id,
-            description=description,
-            letter_annotations={"phred_quality": consensus_qual}
-        )
-        records.append(record)
-        stats['consensus_generated'] += 1
+    A family can be placed without realignment when every read maps to the
+    same reference, start and strand with the same CIGAR and that CIGAR has
+    no indels: the consensus is then built column by column over identical
+    query coordinates, so it has the reads' alignment.
     
-    # Write FASTQ
-    SeqIO.write(records, output_file, 'fastq')
+    Returns:
+        tuple: (reference_id, reference_start, is_reverse, cigartuples), or None
+               if the family has to be realigned
+    """
+    first = reads[0]
+    cigar = first.cigartuples
+    if not cigar or any(op not in PLACEABLE_CIGAR_OPS for op, _ in cigar):
+        return None
+    for read in reads[1:]:
+        if (read.reference_id != first.reference_id or read.reference_start != first.reference_start
+                or read.is_reverse != first.is_reverse or read.cigartuples != cigar):
+            return None
+    return first.reference_id, first.reference_start, first.is_reverse, cigar
+
+def write_consensus_bam(called, template_bam, bam_output, realign_fasta=None):
+    """
+    Write placeable consensus sequences as an aligned, coordinate-sorted BAM
+    
+    Each record takes its position, strand and CIGAR from the family (see
+    family_alignment), MAPQ is the lowest of the family's reads and the
+    UMI (RX), family size (cD) and group (UG) are kept as tags. Families
+    with indels or disagreeing alignments go to realign_fasta instead.
     
-    return stats
+    Args:
+        called: Output of call_consensus
+        template_bam: BAM the families were read from (header source)
+        bam_output: Output BAM path (indexed after writing)
+        realign_fasta: FASTA for the families that need realignment
+    
+    Returns:
+        dict: Counts of placed and realign families
+    """
+    placed = []
+    realign = []
+    for group_id, reads, consensus_seq, consensus_qual in called:
+        alignment = family_alignment(reads)
+        if alignment is None:
+            realign.append((group_id, reads, consensus_seq, consensus_qual))
+        else:
+            placed.append((alignment, group_id, reads, consensus_seq, consensus_qual))
+    
+    # Sort by coordinate (then name, so the output is deterministic)
+    placed.sort(key=lambda item: (item[0][0], item[0][1], str(item[1])))
+    
+    with pysam.AlignmentFile(template_bam, 'rb') as template:
+        header = template.header.to_dict()
+    header['HD'] = dict(header.get('HD', {'VN': '1.6'}), SO='coordinate')
+    
+    with pysam.AlignmentFile(bam_output, 'wb', header=header) as out:
+        for (reference_id, reference_start, is_reverse, cigar), group_id, reads, consensus_seq, consensus_qual in placed:
+            record = pysam.AlignedSegment(out.header)
+            record.query_name = str(group_id)
+            record.flag = 16 if is_reverse else 0
+            record.reference_id = reference_id
+            record.reference_start = reference_start
+            record.mapping_quality = min(read.mapping_quality for read in reads)
+            record.cigartuples = cigar
+            record.query_sequence = consensus_seq
+            record.query_qualities = array.array('B', consensus_qual)
+            record.set_tag('RX', _family_umi(reads[0]))
+            record.set_tag('cD', len(reads), 'i')
+            if reads[0].has_tag('UG'):
+                record.set_tag('UG', reads[0].get_tag('UG'))
+            out.write(record)
+    pysam.index(bam_output)
+    
+    if realign_fasta:
+        write_called_consensus(realign, realign_fasta, 'fasta')
+    
+    return {'placed': len(placed), 'realign': len(realign)}
 
 def main():
     parser = argparse.ArgumentParser(
@@ -208,34 +283,45 @@ def main():
     parser.add_argument('--min-consensus-freq', type=float, default=0.6,
                        help='Minimum frequency for consensus base (default: 0.6)')
     parser.add_argument('--stats', help='Output statistics file')
+    parser.add_argument('--bam-output',
+                        help='Also write families with a shared, indel-free alignment as an aligned, '
+                             'coordinate-sorted consensus BAM')
+    parser.add_argument('--realign-fasta',
+                        help='With --bam-output, write the consensus of all other families here for realignment')
+    umi_perf.add_perf_arguments(parser)
     
     args = parser.parse_args()
+    umi_perf.start_from_args('build_umi_consensus', args)
+    umi_perf.count_bytes('input_bytes', args.bam)
     
     print(f"Reading umi_tools group output from {args.bam}...", file=sys.stderr)
-    umi_groups = group_reads_by_umi_tools(args.bam, args.min_family_size)
+    with umi_perf.stage('group_reads'):
+        umi_groups = group_reads_by_umi_tools(args.bam, args.min_family_size)
+    umi_perf.count('umi_groups', len(umi_groups))
     print(f"Found {len(umi_groups)} UMI groups (>={args.min_family_size} reads)", file=sys.stderr)
     
     print(f"Building consensus sequences ({args.format} format)...", file=sys.stderr)
     
-    if args.format == 'fastq':
-        stats = write_consensus_fastq(
-            umi_groups,
-            args.output,
-            args.min_base_quality,
-            args.min_consensus_freq
-        )
-    else:
-        stats = write_consensus_fasta(
-            umi_groups,
-            args.output,
-            args.min_base_quality,
-            args.min_consensus_freq
-        )
+    with umi_perf.stage('consensus'):
+        called, failed = call_consensus(umi_groups, args.min_base_quality, args.min_consensus_freq)
+    with umi_perf.stage('write'):
+        stats = write_called_consensus(called, args.output, args.format, len(umi_groups), failed)
+    if args.bam_output:
+        with umi_perf.stage('write_bam'):
+            stats.update(write_consensus_bam(called, args.bam, args.bam_output, args.realign_fasta))
+        umi_perf.count('consensus_placed', stats['placed'])
+        umi_perf.count('consensus_realign', stats['realign'])
+        umi_perf.count_bytes('output_bytes', args.bam_output)
+    umi_perf.count('consensus_generated', stats['consensus_generated'])
+    umi_perf.count_bytes('output_bytes', args.output)
     
     print(f"\nConsensus Statistics:", file=sys.stderr)
     print(f"  Total UMI groups: {stats['total_groups']}", file=sys.stderr)
     print(f"  Consensus generated: {stats['consensus_generated']}", file=sys.stderr)
     print(f"  Failed: {stats['failed']}", file=sys.stderr)
+    if args.bam_output:
+        print(f"  Placed without realignment: {stats['placed']}", file=sys.stderr)
+        print(f"  Needing realignment: {stats['realign']}", file=sys.stderr)
     
     # Write stats file
     if args.stats:
@@ -244,6 +330,11 @@ def main():
             f.write(f"Consensus sequences generated: {stats['consensus_generated']}\n")
             f.write(f"Failed: {stats['failed']}\n")
             f.write(f"Success rate: {stats['consensus_generated']/stats['total_groups']*100:.1f}%\n")
+            if args.bam_output:
+                f.write(f"Consensus placed without realignment: {stats['placed']}\n")
+                f.write(f"Consensus needing realignment: {stats['realign']}\n")
+    
+    umi_perf.finish()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+Post-deduplication UMI QC metrics from umi_tools dedup outputs.
+
+Reads the dedup log (input/output read counts), the per-UMI table (family
+sizes) and the edit distance table (UMI error correction/clustering) and
+writes a text summary, the versioned DedupMetrics record and the MultiQC
+JSON derived from it.
+"""
+
+import argparse
+import json
+import re
+import statistics
+import sys
+from collections import Counter
+from pathlib import Path
+
+import umi_perf
+from umi_metrics_schema import DedupMetrics, from_metrics, to_multiqc, write_metrics
+
+
+def parse_dedup_log(log_file):
+    """
+    Read counts from a umi_tools dedup log
+    
+    Returns:
+        dict: total_reads, deduplicated_reads and the deduplication rates
+    """
+    stats = {
+        'total_reads': 0,
+        'unique_umis': 0,
+        'deduplicated_reads': 0,
+        'deduplication_rate': 0.0,
+        'duplication_rate': 0.0
+    }
+    
+    with open(log_file, 'r') as f:
+        log_content = f.read()
+    
+    # Pattern: "INFO Reads: Input Reads: 477015, Read pairs: ..."
+    input_match = re.search(r'INFO Reads: Input Reads:\s+(\d+)', log_content)
+    if input_match:
+        stats['total_reads'] = int(input_match.group(1))
+    
+    output_match = re.search(r'INFO Number of reads out:\s+(\d+)', log_content)
+    if output_match:
+        stats['deduplicated_reads'] = int(output_match.group(1))
+    
+    if stats['total_reads'] > 0:
+        duplicates_removed = stats['total_reads'] - stats['deduplicated_reads']
+        stats['deduplication_rate'] = (duplicates_removed / stats['total_reads']) * 100
+        stats['duplication_rate'] = (stats['total_reads'] / stats['deduplicated_reads']) if stats['deduplicated_reads'] > 0 else 0
+    return stats
+
+
+def read_family_sizes(per_umi_tsv):
+    """Reads per UMI family from the dedup per-UMI table (second column)"""
+    family_sizes = []
+    if not per_umi_tsv or not Path(per_umi_tsv).exists():
+        return family_sizes
+    with open(per_umi_tsv, 'r') as f:
+        next(f, None)  # Skip header
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) >= 2:
+                try:
+                    family_sizes.append(int(parts[1]))
+                except ValueError:
+                    pass
+    return family_sizes
+
+
+def read_edit_distances(edit_distance_tsv):
+    """Edit distance histogram from the dedup edit distance table, as a Counter"""
+    edit_distances = Counter()
+    if not edit_distance_tsv or not Path(edit_distance_tsv).exists():
+        return edit_distances
+    with open(edit_distance_tsv, 'r') as f:
+        next(f, None)  # Skip header
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) >= 2:
+                try:
+                    edit_distances[int(parts[0])] += int(parts[1])
+                except ValueError:
+                    pass
+    return edit_distances
+
+
+def add_family_metrics(stats, family_sizes):
+    """Add UMI family size and singleton statistics to stats"""
+    stats['unique_umis'] = len(family_sizes)
+    stats['avg_family_size'] = statistics.mean(family_sizes) if family_sizes else 0
+    stats['median_family_size'] = statistics.median(family_sizes) if family_sizes else 0
+    stats['max_family_size'] = max(family_sizes) if family_sizes else 0
+    stats['min_family_size'] = min(family_sizes) if family_sizes else 0
+    stats['stdev_family_size'] = statistics.stdev(family_sizes) if len(family_sizes) > 1 else 0
+    
+    # Singleton rate (UMI families with only 1 read)
+    singletons = sum(1 for size in family_sizes if size == 1)
+    stats['singleton_families'] = singletons
+    stats['singleton_family_rate'] = (singletons / len(family_sizes) * 100) if family_sizes else 0
+
+
+def add_edit_distance_metrics(stats, edit_distances):
+    """Add edit distance (error correction) statistics to stats"""
+    distances = sorted(edit_distances.elements())
+    if distances:
+        stats['total_umi_pairs_compared'] = len(distances)
+        stats['mean_edit_distance'] = statistics.mean(distances)
+        stats['median_edit_distance'] = statistics.median(distances)
+        stats['max_edit_distance'] = max(distances)
+        # Count how many UMI pairs were within error correction distance
+        stats['umi_pairs_clustered'] = sum(1 for d in distances if d <= 1)
+        stats['error_correction_rate'] = stats['umi_pairs_clustered'] / len(distances) * 100
+    else:
+        stats['total_umi_pairs_compared'] = 0
+        stats['mean_edit_distance'] = 0
+        stats['median_edit_distance'] = 0
+        stats['max_edit_distance'] = 0
+        stats['umi_pairs_clustered'] = 0
+        stats['error_correction_rate'] = 0
+
+
+def write_dedup_report(path, sample, stats):
+    """Write the human-readable post-dedup metrics summary"""
+    with open(path, 'w') as f:
+        f.write(f"Sample: {sample}\n")
+        f.write("=" * 70 + "\n\n")
+        
+        f.write("DEDUPLICATION SUMMARY\n")
+        f.write("-" * 70 + "\n")
+        f.write(f"Total input reads: {stats['total_reads']:,}\n")
+        f.write(f"Deduplicated reads (output): {stats['deduplicated_reads']:,}\n")
+        f.write(f"Duplicates removed: {stats['total_reads'] - stats['deduplicated_reads']:,}\n")
+        f.write(f"Deduplication rate: {stats['deduplication_rate']:.2f}%\n")
+        f.write(f"Duplication rate (fold): {stats['duplication_rate']:.2f}x\n")
+        f.write("\n")
+        
+        f.write("UMI FAMILY STATISTICS\n")
+        f.write("-" * 70 + "\n")
+        f.write(f"Unique UMI families: {stats['unique_umis']:,}\n")
+        f.write(f"Average family size: {stats['avg_family_size']:.2f}\n")
+        f.write(f"Median family size: {stats['median_family_size']:.2f}\n")
+        f.write(f"Std dev family size: {stats['stdev_family_size']:.2f}\n")
+        f.write(f"Min family size: {stats['min_family_size']}\n")
+        f.write(f"Max family size: {stats['max_family_size']}\n")
+        f.write(f"Singleton families: {stats['singleton_families']:,}\n")
+        f.write(f"Singleton family rate: {stats['singleton_family_rate']:.2f}%\n")
+        f.write("\n")
+        
+        f.write("UMI ERROR CORRECTION & CLUSTERING\n")
+        f.write("-" * 70 + "\n")
+        f.write(f"UMI pairs compared: {stats['total_umi_pairs_compared']:,}\n")
+        f.write(f"Mean edit distance: {stats['mean_edit_distance']:.2f}\n")
+        f.write(f"Median edit distance: {stats['median_edit_distance']:.2f}\n")
+        f.write(f"Max edit distance: {stats['max_edit_distance']}\n")
+        f.write(f"UMI pairs clustered (≤1 edit): {stats['umi_pairs_clustered']:,}\n")
+        f.write(f"Error correction rate: {stats['error_correction_rate']:.2f}%\n")
+        f.write("\n")
+        
+        f.write("INTERPRETATION\n")
+        f.write("-" * 70 + "\n")
+        if stats['deduplication_rate'] > 80:
+            f.write("⚠ HIGH deduplication rate (>80%) - check for over-amplification\n")
+        elif stats['deduplication_rate'] < 10:
+            f.write("⚠ LOW deduplication rate (<10%) - UMIs may not be effective\n")
+        else:
+            f.write("✓ Deduplication rate is within expected range\n")
+        
+        if stats['singleton_family_rate'] > 50:
+            f.write("⚠ HIGH singleton rate (>50%) - many UMIs seen only once\n")
+        else:
+            f.write("✓ Singleton rate is acceptable\n")
+        
+        if stats['error_correction_rate'] > 30:
+            f.write("⚠ HIGH error correction (>30%) - UMI errors or diversity issues\n")
+        else:
+            f.write("✓ Error correction rate is normal\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calculate post-deduplication UMI QC metrics from umi_tools dedup outputs')
+    parser.add_argument('--dedup-log', required=True, help='umi_tools dedup log')
+    parser.add_argument('--per-umi', help='umi_tools dedup --output-stats per-UMI table (*_per_umi.tsv)')
+    parser.add_argument('--edit-distance', help='umi_tools dedup --output-stats edit distance table (*_edit_distance.tsv)')
+    parser.add_argument('--sample', required=True, help='Sample name')
+    parser.add_argument('--output', required=True, help='Output metrics file')
+    parser.add_argument('--multiqc', required=True, help='Output MultiQC JSON file')
+    parser.add_argument('--metrics-json', help='Output metrics record (versioned schema, .json or .msgpack)')
+    umi_perf.add_perf_arguments(parser)
+    
+    args = parser.parse_args()
+    umi_perf.start_from_args('calculate_dedup_metrics', args, args.sample)
+    
+    with umi_perf.stage('parse_log'):
+        stats = parse_dedup_log(args.dedup_log)
+    with umi_perf.stage('parse_family_sizes'):
+        family_sizes = read_family_sizes(args.per_umi)
+        add_family_metrics(stats, family_sizes)
+    with umi_perf.stage('parse_edit_distances'):
+        edit_distances = read_edit_distances(args.edit_distance)
+        add_edit_distance_metrics(stats, edit_distances)
+    
+    umi_perf.mark('write')
+    write_dedup_report(args.output, args.sample, stats)
+    
+    # Versioned metrics record, written once; the report reads it directly
+    # and the MultiQC JSON is derived from it
+    record = from_metrics(
+        DedupMetrics, args.sample, stats,
+        duplicates_removed=stats['total_reads'] - stats['deduplicated_reads'],
+        deduplication_rate_pct=stats['deduplication_rate'],
+        unique_umi_families=stats['unique_umis'],
+        singleton_family_rate_pct=stats['singleton_family_rate'],
+        error_correction_rate_pct=stats['error_correction_rate'],
+        family_size_distribution=dict(Counter(family_sizes)),
+        edit_distance_distribution=dict(edit_distances)
+    )
+    if args.metrics_json:
+        write_metrics(record, args.metrics_json)
+    with open(args.multiqc, 'w') as f:
+        json.dump(to_multiqc(record), f, indent=2)
+    
+    umi_perf.count('reads', stats['total_reads'])
+    umi_perf.count('umi_families', stats['unique_umis'])
+    print(f"Post-dedup metrics written to {args.output}", file=sys.stderr)
+    umi_perf.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,116 +1,549 @@
 #!/usr/bin/env python3
 """
-Calculate library coverage metrics from featureCounts output.
+Calculate library coverage metrics from featureCounts output (or the UMI
+molecule counts of count_umi_molecules.py).
 
 Metrics include:
 - Library coverage (% of reference sequences detected)
 - Evenness metrics (Shannon entropy, Simpson index, Pielou's evenness)
-- Count distribution statistics and plots
+- Count distribution statistics and plots (PNG, or MultiQC plot data)
+- Optional per-feature length-normalised coverage (reads per kb)
 """
 
 import argparse
+import hashlib
 import json
+import os
 import sys
+import warnings
 from pathlib import Path
 import numpy as np
-import matplotlib
-matplotlib.use('Agg')  # Non-interactive backend
-import matplotlib.pyplot as plt
-import seaborn as sns
 
+import umi_perf
 
-def count_fasta_sequences(fasta_file):
+
+EVENNESS_KEYS = ('shannon_entropy', 'simpson_index', 'pielou_evenness', 'gini_coefficient')
+
+# Fractions of detected features at which the cumulative read curve is
+# sampled: log-spaced for the steep head of the curve, linear for the body.
+# The curve size is fixed no matter how many features the library has.
+CURVE_FRACTIONS = np.unique(np.concatenate([np.geomspace(1e-5, 1, 101), np.linspace(0, 1, 101)]))[1:]
+
+
+def _read_fai(fai_file):
+    """Read sequence names and lengths from a samtools .fai index."""
+    index = {}
+    with open(fai_file, 'r') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) >= 2:
+                index[parts[0]] = int(parts[1])
+    return index
+
+
+def _scan_fasta(fasta_file):
+    """Scan a FASTA file once and return sequence names and lengths."""
+    index = {}
+    name = None
+    length = 0
+    with open(fasta_file, 'rb') as f:
+        for line in f:
+            if line.startswith(b'>'):
+                if name is not None:
+                    index[name] = length
+                name = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ''
+                length = 0
+            else:
+                length += len(line.rstrip())
+    if name is not None:
+        index[name] = length
+    return index
+
+
+def load_fasta_index(fasta_file, cache_dir=None, fasta_index=None):
+    """
+    Load reference sequence names and lengths without rescanning the FASTA.
+    
+    Lookup order:
+    1. An explicit samtools .fai (fasta_index), used as given - the caller
+       vouches that it belongs to this FASTA (e.g. the content-addressed
+       PREPARE_REFERENCE cache, whose .fai has a fixed name)
+    2. A samtools .fai next to the FASTA (or next to its symlink target)
+       that is not older than the FASTA
+    3. A cached sidecar index whose key (resolved path, size, mtime) matches
+    4. A single scan of the FASTA, written back as the sidecar index
+    
+    The sidecar is written next to the resolved FASTA, or into cache_dir
+    when given. Failing to write it only costs a rescan on the next run.
+    
+    Args:
+        fasta_file: Reference FASTA file
+        cache_dir: Optional directory for sidecar indexes
+        fasta_index: Optional samtools .fai for this FASTA
+    
+    Returns:
+        dict: Ordered mapping of sequence name -> length
+    """
+    if fasta_index:
+        print(f"Using FASTA index: {fasta_index}", file=sys.stderr)
+        return _read_fai(fasta_index)
+    
+    resolved = Path(fasta_file).resolve()
+    stat = resolved.stat()
+    
+    for fai in (Path(f'{fasta_file}.fai'), Path(f'{resolved}.fai')):
+        if fai.exists() and fai.stat().st_mtime >= stat.st_mtime:
+            print(f"Using FASTA index: {fai}", file=sys.stderr)
+            return _read_fai(fai)
+    
+    key = f"path={resolved}\tsize={stat.st_size}\tmtime_ns={stat.st_mtime_ns}"
+    if cache_dir:
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        sidecar = Path(cache_dir) / f'{resolved.name}.{digest}.seqlen.tsv'
+    else:
+        sidecar = Path(f'{resolved}.seqlen.tsv')
+    
+    if sidecar.exists():
+        with open(sidecar, 'r') as f:
+            if f.readline().rstrip('\n') == f'#{key}':
+                print(f"Using cached FASTA index: {sidecar}", file=sys.stderr)
+                return {name: int(length) for name, length in
+                        (line.rstrip('\n').split('\t') for line in f)}
+    
+    index = _scan_fasta(resolved)
+    try:
+        sidecar.parent.mkdir(parents=True, exist_ok=True)
+        tmp = sidecar.with_name(f'{sidecar.name}.tmp{os.getpid()}')
+        with open(tmp, 'w') as f:
+            f.write(f'#{key}\n')
+            for name, length in index.items():
+                f.write(f'{name}\t{length}\n')
+        os.replace(tmp, sidecar)
+        print(f"Cached FASTA index: {sidecar}", file=sys.stderr)
+    except OSError as e:
+        print(f"WARNING: Could not cache FASTA index ({e})", file=sys.stderr)
+    
+    return index
+
+
+def count_fasta_sequences(fasta_file, cache_dir=None):
     """Count total number of sequences in reference FASTA."""
-    count = 0
-    with open(fasta_file, 'r') as f:
+    return len(load_fasta_index(fasta_file, cache_dir))
+
+
+def write_feature_table(feature_ids, sample_ids, counts, fasta_index, output_file):
+    """
+    Write per-feature length-normalised coverage (reads per kb of reference).
+    
+    Lengths come from the FASTA index, so the reference is not rescanned.
+    Features missing from the index are written with an empty length.
+    
+    Args:
+        feature_ids: Array of feature identifiers
+        sample_ids: Sample identifiers, one per count column
+        counts: 2D array of read counts, shape (n_features, n_samples)
+        fasta_index: Mapping of sequence name -> length
+        output_file: Output TSV path
+    """
+    lengths = np.fromiter((fasta_index.get(f, 0) for f in feature_ids),
+                          dtype=np.int64, count=len(feature_ids))
+    missing = int(np.count_nonzero(lengths == 0))
+    if missing:
+        print(f"WARNING: {missing} features not found in FASTA index; reads per kb left empty", file=sys.stderr)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reads_per_kb = counts * 1000.0 / lengths[:, None]
+    
+    with open(output_file, 'w') as f:
+        header = ['feature_id', 'length']
+        for sample_id in sample_ids:
+            header += [f'{sample_id}_count', f'{sample_id}_reads_per_kb']
+        f.write('\t'.join(header) + '\n')
+        for i, feature_id in enumerate(feature_ids):
+            row = [str(feature_id), str(lengths[i]) if lengths[i] else '']
+            for j in range(len(sample_ids)):
+                row += [str(counts[i, j]), f'{reads_per_kb[i, j]:.4f}' if lengths[i] else '']
+            f.write('\t'.join(row) + '\n')
+
+
+def _sample_name(column):
+    """Derive a sample name from a featureCounts BAM column header."""
+    name = Path(column).name
+    for suffix in ('.bam', '.dedup', '.sorted'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+
+def parse_featurecounts_matrix(counts_file):
+    """
+    Parse a (possibly multi-BAM) featureCounts table into a count matrix.
+    
+    featureCounts writes one count column per input BAM after the six
+    annotation columns. Feature IDs and counts are each loaded by numpy's
+    C tokenizer, so no per-line Python loop runs even for libraries with
+    millions of designed sequences.
+    
+    Returns:
+        tuple: (feature_ids, sample_names, counts) where counts has shape
+               (n_features, n_samples)
+    """
+    columns = []
+    header_lines = 0
+    with open(counts_file, 'r') as f:
+        # Skip the featureCounts command comment up to the Geneid header
         for line in f:
-            if line.startswith('>'):
-                count += 1
-    return count
+            header_lines += 1
+            if line.startswith('Geneid'):
+                columns = line.rstrip('\n').split('\t')
+                break
+    
+    sample_columns = columns[6:]
+    if not sample_columns:
+        return np.array([], dtype=str), [], np.zeros((0, 0), dtype=np.int64)
+    
+    with warnings.catch_warnings():
+        # An empty table is valid (no features annotated)
+        warnings.simplefilter('ignore', UserWarning)
+        feature_ids = np.loadtxt(counts_file, dtype=str, delimiter='\t', usecols=0,
+                                 skiprows=header_lines, ndmin=1, comments=None)
+        counts = np.loadtxt(counts_file, dtype=np.int64, delimiter='\t',
+                            usecols=range(6, len(columns)),
+                            skiprows=header_lines, ndmin=2, comments=None)
+    
+    sample_names = [_sample_name(c) for c in sample_columns]
+    if len(feature_ids) == 0:
+        return feature_ids, sample_names, np.zeros((0, len(sample_columns)), dtype=np.int64)
+    return feature_ids, sample_names, counts.reshape(len(feature_ids), -1)
 
 
 def parse_featurecounts(counts_file):
     """
-    Parse featureCounts output and extract feature counts.
+    Parse single-sample featureCounts output into columnar arrays.
     
     Returns:
-        dict: Dictionary mapping feature_id to count
+        tuple: (feature_ids, counts) numpy arrays in file order
     """
-    feature_counts = {}
+    feature_ids, _, counts = parse_featurecounts_matrix(counts_file)
+    if counts.shape[1] == 0:
+        return feature_ids, np.zeros(len(feature_ids), dtype=np.int64)
+    return feature_ids, counts[:, 0]
+
+
+def parse_umi_counts(counts_file, column='molecules'):
+    """
+    Parse a count_umi_molecules.py table into columnar arrays.
+    
+    The table is sparse (references without reads are absent); absent
+    features count as zero, which the coverage metrics ignore anyway.
     
+    Args:
+        counts_file: count_umi_molecules.py output
+        column: Count column to use: reads, molecules or families
+    
+    Returns:
+        tuple: (feature_ids, counts) numpy arrays in file order
+    """
     with open(counts_file, 'r') as f:
-        for line in f:
-            # Skip comment and header lines
-            if line.startswith('#') or line.startswith('Geneid'):
-                continue
-            
-            parts = line.strip().split('\t')
-            if len(parts) < 7:
-                continue
-                
-            feature_id = parts[0]
-            count = int(parts[6])  # Last column is the count
-            feature_counts[feature_id] = count
+        first = f.readline()
+        columns = f.readline().rstrip('\n').split('\t')
+    if not first.startswith('# umi_molecule_counts') or column not in columns:
+        raise ValueError(f"{counts_file} is not a count_umi_molecules.py table with a '{column}' column")
+    
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', UserWarning)
+        feature_ids = np.loadtxt(counts_file, dtype=str, delimiter='\t', usecols=0,
+                                 skiprows=2, ndmin=1, comments=None)
+        counts = np.loadtxt(counts_file, dtype=np.int64, delimiter='\t', usecols=columns.index(column),
+                            skiprows=2, ndmin=1, comments=None)
+    return feature_ids, counts
+
+
+def select_top_features(feature_ids, counts, top_n=20):
+    """
+    Select the top_n features by count without sorting the whole table.
+    
+    Ties are broken by file order, matching a stable descending sort.
+    
+    Returns:
+        dict: Ordered mapping of feature_id -> count (highest first)
+    """
+    top_n = min(top_n, len(counts))
+    if top_n == 0:
+        return {}
+    
+    kth = np.partition(counts, len(counts) - top_n)[len(counts) - top_n]
+    above = np.flatnonzero(counts > kth)
+    ties = np.flatnonzero(counts == kth)[:top_n - len(above)]
+    idx = np.concatenate([above, ties])
+    idx = idx[np.lexsort((idx, -counts[idx]))]
     
-    return feature_counts
+    return {str(feature_ids[i]): int(counts[i]) for i in idx}
 
 
-def calculate_evenness_metrics(counts):
+def summarize_count_columns(counts):
     """
-    Calculate evenness metrics for count distribution.
+    Calculate count summary and evenness metrics for every column at once.
+    
+    Only non-zero counts enter the statistics, as for a single sample. Each
+    column is sorted once; the sorted block gives the detected-feature
+    median, and one cumulative sum over it gives both the Gini coefficient
+    and the cumulative read distribution curve, so the plotted curve and
+    the reported Gini always come from the same array pass.
     
     Args:
-        counts: List or array of counts (non-zero values)
+        counts: 2D array of non-negative counts, shape (n_features, n_columns)
     
     Returns:
-        dict: Dictionary with evenness metrics
+        dict: Arrays (one value per column) for detected, total, mean,
+              median, shannon_entropy, simpson_index, pielou_evenness and
+              gini_coefficient; curve_ranks/curve_percent hold the
+              cumulative read curve knots, shape (len(CURVE_FRACTIONS), n_columns)
     """
-    counts = np.array([c for c in counts if c > 0])
-    
-    if len(counts) == 0:
-        return {
-            'shannon_entropy': 0,
-            'simpson_index': 0,
-            'pielou_evenness': 0,
-            'gini_coefficient': 0
-        }
+    counts = np.asarray(counts)
+    n_features, n_columns = counts.shape
+    detected = np.count_nonzero(counts, axis=0)
+    total = counts.sum(axis=0)
+    has_counts = detected > 0
+    safe_detected = np.maximum(detected, 1)
+    safe_total = np.where(total > 0, total, 1)
     
     # Shannon entropy and Pielou's evenness
-    total = np.sum(counts)
-    proportions = counts / total
-    shannon_entropy = -np.sum(proportions * np.log(proportions))
-    max_entropy = np.log(len(counts))
-    pielou_evenness = shannon_entropy / max_entropy if max_entropy > 0 else 0
+    proportions = counts / safe_total
+    log_proportions = np.log(proportions, out=np.zeros_like(proportions), where=proportions > 0)
+    shannon_entropy = 0.0 - np.sum(proportions * log_proportions, axis=0)
+    max_entropy = np.log(safe_detected)
+    pielou_evenness = np.divide(shannon_entropy, max_entropy,
+                                out=np.zeros(n_columns), where=max_entropy > 0)
     
     # Simpson index (1 - D, where D is Simpson's dominance)
-    simpson_d = np.sum(proportions ** 2)
-    simpson_index = 1 - simpson_d
+    simpson_index = np.where(has_counts, 1 - np.sum(proportions ** 2, axis=0), 0.0)
+    
+    # Zeros sort first, so the detected counts are the last `detected` rows
+    sorted_counts = np.sort(counts, axis=0).astype(np.float64)
+    
+    lower = np.minimum(n_features - detected + (safe_detected - 1) // 2, n_features - 1)
+    upper = np.minimum(n_features - detected + detected // 2, n_features - 1)
+    if n_features > 0:
+        median = (np.take_along_axis(sorted_counts, lower[None, :], axis=0)[0] +
+                  np.take_along_axis(sorted_counts, upper[None, :], axis=0)[0]) / 2
+    else:
+        median = np.zeros(n_columns)
+    
+    # Lorenz curve: cumulative counts of the ascending column. Zeros add
+    # nothing, so the same cumulative sums serve every column
+    cumulative = np.zeros((n_features + 1, n_columns))
+    np.cumsum(sorted_counts, axis=0, out=cumulative[1:])
+    
+    # Gini coefficient (inequality measure) over the detected counts only,
+    # from the area under the Lorenz curve: G = (n + 1 - 2 * sum(L) / T) / n
+    gini = (detected + 1 - 2 * cumulative.sum(axis=0) / safe_total) / safe_detected
+    
+    # Cumulative % of reads in the top-ranked features, sampled at fixed
+    # fractions of the detected features (knots of the same Lorenz curve)
+    curve_ranks = np.clip(np.ceil(CURVE_FRACTIONS[:, None] * detected), 1, safe_detected).astype(np.int64)
+    top_sums = cumulative[n_features] - np.take_along_axis(cumulative, n_features - curve_ranks, axis=0)
+    curve_percent = 100 * top_sums / safe_total
+    
+    return {
+        'detected': detected,
+        'total': total,
+        'mean': np.where(has_counts, total / safe_detected, 0.0),
+        'median': np.where(has_counts, median, 0.0),
+        'shannon_entropy': np.where(has_counts, shannon_entropy, 0.0),
+        'simpson_index': simpson_index,
+        'pielou_evenness': np.where(has_counts, pielou_evenness, 0.0),
+        'gini_coefficient': np.where(has_counts, gini, 0.0),
+        'curve_ranks': curve_ranks,
+        'curve_percent': curve_percent
+    }
+
+
+def calculate_evenness_metrics(counts):
+    """
+    Calculate evenness metrics for count distribution.
     
-    # Gini coefficient (inequality measure)
-    sorted_counts = np.sort(counts)
-    n = len(counts)
-    cumsum = np.cumsum(sorted_counts)
-    gini = (2 * np.sum((np.arange(1, n + 1)) * sorted_counts)) / (n * np.sum(sorted_counts)) - (n + 1) / n
+    Args:
+        counts: List or array of counts (zero values are ignored)
     
+    Returns:
+        dict: Dictionary with evenness metrics
+    """
+    summary = summarize_count_columns(np.asarray(counts).reshape(-1, 1))
+    return {key: float(summary[key][0]) for key in EVENNESS_KEYS}
+
+
+def _curve_knots(summary, column):
+    """Format one column's cumulative read curve knots (unique ranks only)."""
+    if summary['detected'][column] == 0:
+        return {'rank': [], 'cumulative_percent': []}
+    ranks, first = np.unique(summary['curve_ranks'][:, column], return_index=True)
     return {
-        'shannon_entropy': float(shannon_entropy),
-        'simpson_index': float(simpson_index),
-        'pielou_evenness': float(pielou_evenness),
-        'gini_coefficient': float(gini)
+        'rank': ranks.tolist(),
+        'cumulative_percent': [round(float(v), 4) for v in summary['curve_percent'][first, column]]
     }
 
 
-def plot_count_distribution(feature_counts, output_prefix, sample_id):
+def calculate_coverage_matrix(feature_ids, counts, total_refs, sample_ids, block_size=16):
+    """
+    Calculate coverage metrics for every sample column of a count matrix.
+    
+    Columns are processed in blocks with vectorized numpy operations so
+    memory stays bounded for wide cohort matrices. Each returned dictionary
+    is the per-sample JSON payload and is shared by the text report, the
+    JSON report and the plots so nothing is recomputed.
+    
+    Args:
+        feature_ids: Array of feature identifiers
+        counts: 2D array of read counts, shape (n_features, n_samples)
+        total_refs: Total number of reference sequences
+        sample_ids: Sample identifiers, one per column
+        block_size: Number of sample columns summarized at once
+    
+    Returns:
+        list: One metrics dictionary per sample, in column order
+    """
+    results = []
+    for start in range(0, len(sample_ids), block_size):
+        block = counts[:, start:start + block_size]
+        summary = summarize_count_columns(block)
+        
+        for j in range(block.shape[1]):
+            detected_refs = int(summary['detected'][j])
+            coverage_pct = (detected_refs / total_refs * 100) if total_refs > 0 else 0
+            results.append({
+                "sample_id": sample_ids[start + j],
+                "total_reference_sequences": total_refs,
+                "detected_reference_sequences": detected_refs,
+                "library_coverage_percent": round(coverage_pct, 2),
+                "total_read_counts": int(summary['total'][j]),
+                "mean_counts_per_detected_feature": round(float(summary['mean'][j]), 2),
+                "median_counts_per_detected_feature": round(float(summary['median'][j]), 2),
+                "evenness_metrics": {key: float(summary[key][j]) for key in EVENNESS_KEYS},
+                "cumulative_read_distribution": _curve_knots(summary, j),
+                "top_20_features": select_top_features(feature_ids, block[:, j], 20)
+            })
+    
+    return results
+
+
+def calculate_coverage_metrics(feature_ids, counts, total_refs, sample_id):
+    """
+    Calculate all coverage metrics for one sample.
+    
+    Args:
+        feature_ids: Array of feature identifiers
+        counts: Array of read counts (same order as feature_ids)
+        total_refs: Total number of reference sequences
+        sample_id: Sample identifier
+    
+    Returns:
+        dict: Coverage, count summary, evenness and top feature metrics
+    """
+    return calculate_coverage_matrix(feature_ids, counts.reshape(-1, 1), total_refs, [sample_id])[0]
+
+
+# MultiQC custom-content sections for --plots json (matched by the sp
+# patterns in assets/multiqc_config.yaml; files of all samples are merged)
+MULTIQC_PLOTS = {
+    'cumulative': {
+        'id': 'library_coverage_cumulative',
+        'section_name': 'Library Coverage: Cumulative Read Distribution',
+        'description': 'Cumulative % of reads in the top-ranked reference sequences, against the % of '
+                       'detected sequences; a straight diagonal is a perfectly even library',
+        'plot_type': 'linegraph',
+        'pconfig': {
+            'id': 'library_coverage_cumulative_plot',
+            'title': 'Cumulative Read Distribution',
+            'xlab': 'Top-ranked detected reference sequences (%)',
+            'ylab': 'Cumulative % of reads',
+            'xmin': 0, 'xmax': 100, 'ymin': 0, 'ymax': 100
+        }
+    },
+    'histogram': {
+        'id': 'library_coverage_histogram',
+        'section_name': 'Library Coverage: Read Count Distribution',
+        'description': 'Number of detected reference sequences by read count (histogram bin centres)',
+        'plot_type': 'linegraph',
+        'pconfig': {
+            'id': 'library_coverage_histogram_plot',
+            'title': 'Read Count Distribution',
+            'xlab': 'Reads per reference sequence',
+            'ylab': 'Reference sequences'
+        }
+    }
+}
+
+
+def build_plot_data(counts, metrics, bins=50):
+    """
+    Build the distribution plots as MultiQC custom content.
+    
+    Holds the cumulative read curve (the same knots as
+    cumulative_read_distribution) and a binned histogram of the detected
+    counts; sizes are independent of the number of features.
+    
+    Args:
+        counts: Array of read counts per feature
+        metrics: Metrics dictionary from calculate_coverage_metrics()
+        bins: Number of histogram bins
+    
+    Returns:
+        dict: {'cumulative': section, 'histogram': section} for one sample
+    """
+    sample = metrics['sample_id']
+    detected = metrics['detected_reference_sequences']
+    curve = metrics['cumulative_read_distribution']
+    cumulative = {round(100 * rank / detected, 4): percent
+                  for rank, percent in zip(curve['rank'], curve['cumulative_percent'])}
+    
+    detected_counts = counts[counts > 0]
+    histogram = {}
+    if len(detected_counts) > 0:
+        hist, edges = np.histogram(detected_counts, bins=bins)
+        histogram = {round(float(centre), 4): int(n) for centre, n in zip((edges[:-1] + edges[1:]) / 2, hist)}
+    
+    return {name: {**section, 'data': {sample: data} if data else {}}
+            for (name, section), data in zip(MULTIQC_PLOTS.items(), (cumulative, histogram))}
+
+
+def write_plots(counts, metrics, output_prefix, plots):
+    """
+    Write distribution plots in the requested format.
+    
+    Args:
+        counts: Array of read counts per feature
+        metrics: Metrics dictionary from calculate_coverage_metrics()
+        output_prefix: Prefix for output files
+        plots: 'none', 'png' (matplotlib render) or 'json' (MultiQC plot data)
+    """
+    if plots == 'png':
+        plot_count_distribution(counts, metrics, output_prefix)
+        print(f"Distribution plot saved: {output_prefix}_distribution.png")
+    elif plots == 'json':
+        for name, section in build_plot_data(counts, metrics).items():
+            with open(f'{output_prefix}_distribution.{name}.json', 'w') as f:
+                json.dump(section, f, separators=(',', ':'))
+        print(f"Distribution plot data saved: {output_prefix}_distribution.{{cumulative,histogram}}.json")
+
+
+def plot_count_distribution(counts, metrics, output_prefix):
     """
     Create distribution plots for feature counts.
     
     Args:
-        feature_counts: Dictionary of feature_id -> count
+        counts: Array of read counts per feature
+        metrics: Metrics dictionary from calculate_coverage_metrics()
         output_prefix: Prefix for output files
-        sample_id: Sample identifier
     """
-    counts = np.array(list(feature_counts.values()))
+    # Plotting libraries are only imported when a PNG is requested
+    import matplotlib
+    matplotlib.use('Agg')  # Non-interactive backend
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    
     detected_counts = counts[counts > 0]
+    sample_id = metrics['sample_id']
     
     # Set style
     sns.set_style("whitegrid")
@@ -134,10 +567,8 @@ def plot_count_distribution(feature_counts, output_prefix, sample_id):
     # 2. Cumulative distribution
     ax2 = axes[0, 1]
     if len(detected_counts) > 0:
-        sorted_counts = np.sort(detected_counts)[::-1]
-        cumsum = np.cumsum(sorted_counts)
-        cumsum_pct = 100 * cumsum / cumsum[-1]
-        ax2.plot(range(1, len(sorted_counts) + 1), cumsum_pct, linewidth=2)
+        curve = metrics['cumulative_read_distribution']
+        ax2.plot(curve['rank'], curve['cumulative_percent'], linewidth=2)
         ax2.set_xlabel('Number of Features (ranked)', fontsize=10)
         ax2.set_ylabel('Cumulative % of Reads', fontsize=10)
         ax2.set_title('Cumulative Read Distribution', fontsize=11)
@@ -154,9 +585,9 @@ def plot_count_distribution(feature_counts, output_prefix, sample_id):
     # 3. Top 20 features bar plot
     ax3 = axes[1, 0]
     if len(detected_counts) > 0:
-        top_features = sorted(feature_counts.items(), key=lambda x: x[1], reverse=True)[:20]
-        feature_names = [f[0][:20] for f in top_features]  # Truncate long names
-        feature_values = [f[1] for f in top_features]
+        top_features = metrics['top_20_features']
+        feature_names = [name[:20] for name in top_features]  # Truncate long names
+        feature_values = list(top_features.values())
         
         y_pos = np.arange(len(feature_names))
         ax3.barh(y_pos, feature_values, alpha=0.7)
@@ -173,24 +604,19 @@ def plot_count_distribution(feature_counts, output_prefix, sample_id):
     ax4 = axes[1, 1]
     ax4.axis('off')
     
-    total_refs = len(feature_counts)
-    detected_refs = len(detected_counts)
-    coverage_pct = (detected_refs / total_refs * 100) if total_refs > 0 else 0
-    total_counts = np.sum(detected_counts) if len(detected_counts) > 0 else 0
-    
-    evenness = calculate_evenness_metrics(detected_counts)
+    evenness = metrics['evenness_metrics']
     
     summary_text = f"""
     Library Coverage Summary
     {'=' * 40}
     
-    Total reference sequences: {total_refs:,}
-    Detected sequences: {detected_refs:,}
-    Coverage: {coverage_pct:.2f}%
+    Total reference sequences: {metrics['total_reference_sequences']:,}
+    Detected sequences: {metrics['detected_reference_sequences']:,}
+    Coverage: {metrics['library_coverage_percent']:.2f}%
     
-    Total read counts: {total_counts:,}
-    Mean counts (detected): {np.mean(detected_counts):.2f if len(detected_counts) > 0 else 0}
-    Median counts (detected): {np.median(detected_counts):.2f if len(detected_counts) > 0 else 0}
+    Total read counts: {metrics['total_read_counts']:,}
+    Mean counts (detected): {metrics['mean_counts_per_detected_feature']:.2f}
+    Median counts (detected): {metrics['median_counts_per_detected_feature']:.2f}
     
     Evenness Metrics:
     Shannon entropy: {evenness['shannon_entropy']:.3f}
@@ -208,33 +634,25 @@ def plot_count_distribution(feature_counts, output_prefix, sample_id):
     plt.close()
 
 
-def write_output_files(feature_counts, total_refs, sample_id, output_prefix):
+def write_output_files(metrics, output_prefix):
     """
     Write text and JSON output files with coverage metrics.
     
     Args:
-        feature_counts: Dictionary of feature_id -> count
-        total_refs: Total number of reference sequences
-        sample_id: Sample identifier
+        metrics: Metrics dictionary from calculate_coverage_metrics()
         output_prefix: Prefix for output files
     """
-    counts = np.array(list(feature_counts.values()))
-    detected_counts = counts[counts > 0]
-    detected_refs = len(detected_counts)
-    coverage_pct = (detected_refs / total_refs * 100) if total_refs > 0 else 0
-    total_counts = int(np.sum(detected_counts)) if len(detected_counts) > 0 else 0
-    
-    evenness = calculate_evenness_metrics(detected_counts)
+    evenness = metrics['evenness_metrics']
     
     # Write text output
     with open(f'{output_prefix}_library_coverage.txt', 'w') as f:
-        f.write(f"Sample: {sample_id}\n")
-        f.write(f"Total reference sequences: {total_refs}\n")
-        f.write(f"Detected reference sequences: {detected_refs}\n")
-        f.write(f"Library coverage: {coverage_pct:.2f}%\n")
-        f.write(f"Total read counts: {total_counts}\n")
-        f.write(f"Mean counts per detected feature: {np.mean(detected_counts):.2f if len(detected_counts) > 0 else 0}\n")
-        f.write(f"Median counts per detected feature: {np.median(detected_counts):.2f if len(detected_counts) > 0 else 0}\n")
+        f.write(f"Sample: {metrics['sample_id']}\n")
+        f.write(f"Total reference sequences: {metrics['total_reference_sequences']}\n")
+        f.write(f"Detected reference sequences: {metrics['detected_reference_sequences']}\n")
+        f.write(f"Library coverage: {metrics['library_coverage_percent']:.2f}%\n")
+        f.write(f"Total read counts: {metrics['total_read_counts']}\n")
+        f.write(f"Mean counts per detected feature: {metrics['mean_counts_per_detected_feature']:.2f}\n")
+        f.write(f"Median counts per detected feature: {metrics['median_counts_per_detected_feature']:.2f}\n")
         f.write(f"\nEvenness Metrics:\n")
         f.write(f"Shannon entropy: {evenness['shannon_entropy']:.4f}\n")
         f.write(f"Simpson index: {evenness['simpson_index']:.4f}\n")
@@ -242,53 +660,131 @@ def write_output_files(feature_counts, total_refs, sample_id, output_prefix):
         f.write(f"Gini coefficient: {evenness['gini_coefficient']:.4f}\n")
     
     # Write JSON output for MultiQC
-    top_features = dict(sorted(feature_counts.items(), key=lambda x: x[1], reverse=True)[:20])
-    
-    json_data = {
-        "sample_id": sample_id,
-        "total_reference_sequences": total_refs,
-        "detected_reference_sequences": detected_refs,
-        "library_coverage_percent": round(coverage_pct, 2),
-        "total_read_counts": total_counts,
-        "mean_counts_per_detected_feature": round(float(np.mean(detected_counts)), 2) if len(detected_counts) > 0 else 0,
-        "median_counts_per_detected_feature": round(float(np.median(detected_counts)), 2) if len(detected_counts) > 0 else 0,
-        "evenness_metrics": evenness,
-        "top_20_features": top_features
-    }
-    
     with open(f'{output_prefix}_library_coverage.json', 'w') as f:
-        json.dump(json_data, f, indent=2)
+        json.dump(metrics, f, indent=2)
+
+
+def write_cohort_files(cohort_metrics, output_prefix):
+    """
+    Write combined cohort TSV/JSON files plus per-sample text/JSON views.
+    
+    Args:
+        cohort_metrics: List of per-sample metrics from calculate_coverage_matrix()
+        output_prefix: Prefix for the combined output files
+    """
+    columns = [
+        'total_reference_sequences',
+        'detected_reference_sequences',
+        'library_coverage_percent',
+        'total_read_counts',
+        'mean_counts_per_detected_feature',
+        'median_counts_per_detected_feature',
+    ]
+    
+    with open(f'{output_prefix}_library_coverage_cohort.tsv', 'w') as f:
+        f.write('\t'.join(['sample_id'] + columns + list(EVENNESS_KEYS)) + '\n')
+        for metrics in cohort_metrics:
+            row = [metrics['sample_id']] + [metrics[c] for c in columns]
+            row += [f"{metrics['evenness_metrics'][key]:.6f}" for key in EVENNESS_KEYS]
+            f.write('\t'.join(str(value) for value in row) + '\n')
+    
+    with open(f'{output_prefix}_library_coverage_cohort.json', 'w') as f:
+        json.dump({"samples": {m['sample_id']: m for m in cohort_metrics}}, f, indent=2)
+    
+    # Per-sample views keep the single-sample layout for MultiQC
+    for metrics in cohort_metrics:
+        write_output_files(metrics, metrics['sample_id'])
 
 
 def main():
     parser = argparse.ArgumentParser(description='Calculate library coverage metrics from featureCounts output')
     parser.add_argument('--counts', required=True, help='featureCounts output file')
+    parser.add_argument('--counts-format', choices=['featurecounts', 'umi'], default='featurecounts',
+                        help='featureCounts table, or count_umi_molecules.py table (default: featurecounts)')
+    parser.add_argument('--count-column', choices=['reads', 'molecules', 'families'], default='molecules',
+                        help='Column of a --counts-format umi table to use (default: molecules)')
     parser.add_argument('--fasta', required=True, help='Reference FASTA file')
-    parser.add_argument('--sample-id', required=True, help='Sample identifier')
+    parser.add_argument('--sample-id', help='Sample identifier (single-sample mode)')
     parser.add_argument('--output-prefix', required=True, help='Output file prefix')
+    parser.add_argument('--matrix', action='store_true',
+                        help='Treat --counts as a multi-BAM featureCounts matrix and report every sample column')
+    parser.add_argument('--fasta-index', help='samtools .fai of --fasta, used instead of looking for one next to it')
+    parser.add_argument('--fasta-index-cache', help='Directory for cached FASTA indexes (default: next to the FASTA)')
+    parser.add_argument('--feature-table', action='store_true',
+                        help='Also write per-feature length-normalised coverage (*_feature_coverage.tsv)')
+    parser.add_argument('--plots', choices=['none', 'png', 'json'], default='png',
+                        help='Distribution plots: none, 300-dpi PNG, or MultiQC custom-content JSON (default: png)')
+    umi_perf.add_perf_arguments(parser)
     
     args = parser.parse_args()
-    
-    # Count total reference sequences
-    total_refs = count_fasta_sequences(args.fasta)
+    if not args.matrix and not args.sample_id:
+        parser.error('--sample-id is required unless --matrix is given')
+    if args.matrix and args.counts_format != 'featurecounts':
+        parser.error('--matrix needs a featureCounts matrix')
+    umi_perf.start_from_args('calculate_library_coverage', args, args.sample_id)
+    umi_perf.count_bytes('input_bytes', args.counts)
+    
+    # Count total reference sequences from the (cached) FASTA index
+    with umi_perf.stage('fasta_index'):
+        fasta_index = load_fasta_index(args.fasta, args.fasta_index_cache, args.fasta_index)
+    total_refs = len(fasta_index)
+    umi_perf.count('reference_sequences', total_refs)
     print(f"Total reference sequences: {total_refs}")
     
-    # Parse featureCounts output
-    feature_counts = parse_featurecounts(args.counts)
-    detected_refs = sum(1 for c in feature_counts.values() if c > 0)
-    print(f"Detected reference sequences: {detected_refs}")
-    
-    # Calculate coverage
-    coverage_pct = (detected_refs / total_refs * 100) if total_refs > 0 else 0
-    print(f"Library coverage: {coverage_pct:.2f}%")
+    if args.matrix:
+        # Cohort mode: one featureCounts matrix, one FASTA scan, all samples
+        with umi_perf.stage('parse'):
+            feature_ids, sample_ids, counts = parse_featurecounts_matrix(args.counts)
+        umi_perf.count('samples', len(sample_ids))
+        with umi_perf.stage('compute'):
+            cohort_metrics = calculate_coverage_matrix(feature_ids, counts, total_refs, sample_ids)
+        for metrics in cohort_metrics:
+            print(f"{metrics['sample_id']}: {metrics['detected_reference_sequences']} detected, "
+                  f"{metrics['library_coverage_percent']:.2f}% coverage")
+        
+        with umi_perf.stage('write'):
+            write_cohort_files(cohort_metrics, args.output_prefix)
+        with umi_perf.stage('plots'):
+            for j, metrics in enumerate(cohort_metrics):
+                write_plots(counts[:, j], metrics, metrics['sample_id'], args.plots)
+        if args.feature_table:
+            with umi_perf.stage('feature_table'):
+                write_feature_table(feature_ids, sample_ids, counts, fasta_index,
+                                    f'{args.output_prefix}_feature_coverage_cohort.tsv')
+        print(f"Cohort files written: {args.output_prefix}_library_coverage_cohort.tsv/json "
+              f"({len(cohort_metrics)} samples)")
+        umi_perf.finish()
+        return
+    
+    # Parse featureCounts output (or UMI molecule counts)
+    with umi_perf.stage('parse'):
+        if args.counts_format == 'umi':
+            feature_ids, counts = parse_umi_counts(args.counts, args.count_column)
+        else:
+            feature_ids, counts = parse_featurecounts(args.counts)
+    
+    # Calculate all metrics once; plots and reports reuse them
+    with umi_perf.stage('compute'):
+        metrics = calculate_coverage_metrics(feature_ids, counts, total_refs, args.sample_id)
+    print(f"Detected reference sequences: {metrics['detected_reference_sequences']}")
+    print(f"Library coverage: {metrics['library_coverage_percent']:.2f}%")
     
     # Create distribution plots
-    plot_count_distribution(feature_counts, args.output_prefix, args.sample_id)
-    print(f"Distribution plot saved: {args.output_prefix}_distribution.png")
+    with umi_perf.stage('plots'):
+        write_plots(counts, metrics, args.output_prefix, args.plots)
     
     # Write output files
-    write_output_files(feature_counts, total_refs, args.sample_id, args.output_prefix)
+    with umi_perf.stage('write'):
+        write_output_files(metrics, args.output_prefix)
     print(f"Output files written: {args.output_prefix}_library_coverage.txt/json")
+    
+    if args.feature_table:
+        with umi_perf.stage('feature_table'):
+            write_feature_table(feature_ids, [args.sample_id], counts.reshape(-1, 1), fasta_index,
+                                f'{args.output_prefix}_feature_coverage.tsv')
+        print(f"Feature table written: {args.output_prefix}_feature_coverage.tsv")
+    
+    umi_perf.finish()
 
 
 if __name__ == '__main__':
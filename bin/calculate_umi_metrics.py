@@ -4,12 +4,46 @@ Calculate comprehensive UMI QC metrics from FASTQ files with extracted UMIs
 """
 
 import sys
+import re
 import gzip
 import json
 import argparse
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+import zlib
+from array import array
 from collections import Counter
 from math import log2
 
+import umi_perf
+from umi_metrics_schema import ExtractMetrics, from_metrics, to_multiqc, write_metrics
+
+# Chunk partial state (written per FASTQ chunk, combined per sample)
+PARTIAL_FORMAT = 'umi_extract_partial'
+PARTIAL_VERSION = 1
+
+# Binary state: magic, then a zlib stream of a length-prefixed JSON header
+# followed by the UMI and count arrays (little endian)
+STATE_MAGIC = b'UMISTAT1'
+STATE_SUFFIX = '.umi_state'
+_PACK_BASES = str.maketrans('ACGT', '0123')
+# One hex digit holds two 2-bit bases
+_UNPACK_HEX = str.maketrans({f'{i:x}': 'ACGT'[i >> 2] + 'ACGT'[i & 3] for i in range(16)})
+
+# Read subsampling fractions of the rarefaction/saturation curves
+RAREFACTION_FRACTIONS = tuple(i / 20 for i in range(1, 21))
+
+# External counting: estimated bytes per distinct UMI held in the count
+# buffer (dict entry, int objects, sort list), (code, count) pairs per
+# run-file block and the most runs merged at once
+BYTES_PER_BUFFERED_UMI = 100
+RUN_BLOCK_PAIRS = 65536
+MAX_MERGE_RUNS = 64
+_MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
 def calculate_shannon_entropy(umi_counts):
     """Calculate Shannon entropy of UMI distribution"""
     total = sum(umi_counts.values())
@@ -81,7 +115,112 @@ def prob_at_least_one_umi_collision(n: int, umi_length: int) -> float:
     m = 4 ** umi_length
     return 1.0 - math.exp(-(n * (n - 1)) / (2.0 * m))
 
-def parse_fastq_with_umi(fastq_file):
+def rarefaction_curve(size_histogram, fractions=RAREFACTION_FRACTIONS):
+    """
+    Expected unique UMIs and saturation when subsampling the reads.
+    
+    Drawing n of the N reads without replacement, a UMI with k reads is
+    missed with the hypergeometric probability C(N-k, n) / C(N, n), so
+    E[unique UMIs at n reads] = sum_k f_k * (1 - C(N-k, n) / C(N, n))
+    over the family-size histogram (f_k UMIs with k reads). The binomial
+    ratio is evaluated with lgamma, so the cost is one term per distinct
+    family size and grid point, independent of the number of reads.
+    
+    Args:
+        size_histogram: Family size -> number of UMIs of that size
+        fractions: Subsampling fractions of the reads
+    
+    Returns:
+        list: dicts with fraction, reads, unique_umis and saturation
+              (fraction of the subsampled reads that are duplicates)
+    """
+    total = sum(size * n for size, n in size_histogram.items())
+    curve = []
+    if total == 0:
+        return curve
+    log_total = math.lgamma(total + 1)
+    for fraction in fractions:
+        reads = int(round(fraction * total))
+        log_rest = math.lgamma(total - reads + 1) - log_total
+        unique = 0.0
+        for size, n in size_histogram.items():
+            if total - size >= reads:
+                missed = math.exp(math.lgamma(total - size + 1) - math.lgamma(total - size - reads + 1) + log_rest)
+            else:
+                missed = 0.0
+            unique += n * (1.0 - missed)
+        curve.append({
+            'fraction': fraction,
+            'reads': reads,
+            'unique_umis': unique,
+            'saturation': 1.0 - unique / reads if reads else 0.0
+        })
+    return curve
+
+def hamming_neighbour_census(umi_counts, umi_length):
+    """
+    Census of UMIs one mismatch away from a more abundant UMI
+    
+    UMIs are packed 2 bits per base into integers, so the 3 * L one-mismatch
+    neighbours of a UMI are its value XOR one of 3 * L fixed masks and are
+    looked up in a dict of the packed counts. The cost is linear in the
+    number of distinct UMIs, with no pairwise comparison. UMIs with N bases
+    or another length are left out.
+    
+    Args:
+        umi_counts: UMI -> reads
+        umi_length: UMI length
+    
+    Returns:
+        dict: neighbour counts and rates, and 'neighbour_abundance_ratio'
+              (most abundant neighbour / own reads, binned by powers of 2)
+    """
+    index = {}
+    for umi, n in umi_counts.items():
+        if len(umi) == umi_length:
+            try:
+                index[int(umi.translate(_PACK_BASES), 4)] = n
+            except ValueError:
+                pass
+    return packed_neighbour_census(index, umi_length)
+
+def packed_neighbour_census(index, umi_length):
+    """hamming_neighbour_census of UMIs already packed (packed UMI -> reads)"""
+    masks = [d << (2 * pos) for pos in range(umi_length) for d in (1, 2, 3)]
+    
+    with_neighbour = abundant = directional = directional_reads = 0
+    ratio_bins = Counter()
+    get = index.get
+    for value, n in index.items():
+        best = max([get(value ^ mask, 0) for mask in masks]) if masks else 0
+        if not best:
+            continue
+        with_neighbour += 1
+        if best > n:
+            abundant += 1
+            ratio_bins[min(int(log2(best / n)), 10)] += 1
+            # umi_tools directional: a UMI is absorbed by a neighbour with at least 2n - 1 reads
+            if best >= 2 * n - 1:
+                directional += 1
+                directional_reads += n
+    
+    checked = len(index)
+    total_reads = sum(index.values())
+    return {
+        'neighbour_checked_umis': checked,
+        'hamming1_neighbour_umis': with_neighbour,
+        'abundant_neighbour_umis': abundant,
+        'abundant_neighbour_rate': abundant / checked if checked else 0.0,
+        'directional_neighbour_umis': directional,
+        'directional_neighbour_rate': directional / checked if checked else 0.0,
+        'directional_neighbour_read_fraction': directional_reads / total_reads if total_reads else 0.0,
+        'neighbour_abundance_ratio': {
+            (f'{2 ** b}-{2 ** (b + 1)}' if b < 10 else f'>={2 ** b}'): ratio_bins[b]
+            for b in range(11) if ratio_bins[b]
+        }
+    }
+
+def parse_fastq_with_umi(fastq_file, counter=None):
     """
     Parse FASTQ file and extract UMI information from read headers
     Assumes UMI is in the read ID after extraction by umi_tools
@@ -90,8 +229,12 @@ def parse_fastq_with_umi(fastq_file):
     Note: After umi_tools extract, UMI quality scores are NOT available in the FASTQ.
     The UMI has been moved to the header and removed from the sequence.
     Quality information must be obtained from the umi_tools extract log.
+    
+    With counter (an ExternalUmiCounter), UMIs are added to it and it is
+    returned in place of the Counter.
     """
-    umi_counts = Counter()
+    umi_counts = Counter() if counter is None else counter
+    add = counter.add if counter is not None else None
     total_reads = 0
     
     opener = gzip.open if fastq_file.endswith('.gz') else open
@@ -117,10 +260,172 @@ def parse_fastq_with_umi(fastq_file):
                 umi_seq = read_id.split('_')[-1]
                 # Check if it's a valid UMI (only ACGT characters)
                 if umi_seq and all(c in 'ACGTN' for c in umi_seq):
-                    umi_counts[umi_seq] += 1
+                    if add:
+                        add(umi_seq)
+                    else:
+                        umi_counts[umi_seq] += 1
     
     return umi_counts, None, total_reads
 
+def parse_memory_size(text):
+    """Bytes of a size such as 512M, 4G, 1.5GB or 4.GB (binary units; plain numbers are bytes)"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)[\s.]*([KMGT]?)I?B?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid memory size '{text}' (expected e.g. 512M or 4G)")
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2).upper()])
+
+class ExternalUmiCounter:
+    """
+    UMI read counts with a memory budget, spilled to sorted runs on disk
+    
+    UMIs of the expected length with only ACGT bases are counted under their
+    2-bit packed code in a dict of at most memory_limit /
+    BYTES_PER_BUFFERED_UMI entries. When it is full, its (code, count) pairs
+    are written to a temporary run file in code order and the dict is
+    emptied; items() k-way merges the runs (and what is still buffered),
+    adding up the counts of a UMI found in several runs. Peak memory follows
+    memory_limit, not the number of distinct UMIs. UMIs with N bases or of
+    another length are rare and counted as text in memory.
+    
+    It stands in for the Counter of a partial state: build_partial_state,
+    merge_partial_states, write_partial_state and calculate_metrics accept it.
+    """
+    
+    def __init__(self, umi_length, memory_limit, tmp_dir=None):
+        if not 0 < umi_length <= 32:
+            raise ValueError(f"External UMI counting supports UMIs of 1-32 bases, got {umi_length}")
+        self.umi_length = umi_length
+        self.capacity = max(1, memory_limit // BYTES_PER_BUFFERED_UMI)
+        self.tmp_dir = tmp_dir
+        self.buffer = {}
+        self.other = Counter()
+        self.runs = []
+        self.run_files = 0
+        self._directory = None
+        self._distinct = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    @property
+    def spilled(self):
+        """True once counts have been written to disk"""
+        return bool(self.runs)
+    
+    def __len__(self):
+        """Number of distinct UMIs (one merge pass once counts were spilled)"""
+        if not self.runs:
+            return len(self.buffer) + len(self.other)
+        if self._distinct is None:
+            self._distinct = sum(1 for _ in self.items())
+        return self._distinct
+    
+    def add(self, umi, reads=1):
+        """Count reads of a UMI"""
+        self._distinct = None
+        if len(umi) == self.umi_length:
+            try:
+                code = int(umi.translate(_PACK_BASES), 4)
+            except ValueError:
+                self.other[umi] += reads
+                return
+            buffer = self.buffer
+            buffer[code] = buffer.get(code, 0) + reads
+            if len(buffer) >= self.capacity:
+                self._spill()
+        else:
+            self.other[umi] += reads
+    
+    def update(self, umi_counts):
+        """Add the counts of a UMI -> reads mapping (e.g. a chunk state)"""
+        add = self.add
+        for umi, reads in umi_counts.items():
+            add(umi, reads)
+    
+    def _new_run_path(self):
+        if self._directory is None:
+            self._directory = tempfile.TemporaryDirectory(prefix='umi_counts_', dir=self.tmp_dir)
+        self.run_files += 1
+        return os.path.join(self._directory.name, f'run{self.run_files:05d}.bin')
+    
+    def _write_run(self, pairs):
+        """Write sorted (code, count) pairs to a new run file"""
+        path = self._new_run_path()
+        block = array('Q')
+        with open(path, 'wb') as f:
+            for code, count in pairs:
+                block.append(code)
+                block.append(count)
+                if len(block) >= 2 * RUN_BLOCK_PAIRS:
+                    block.tofile(f)
+                    del block[:]
+            block.tofile(f)
+        self.runs.append(path)
+    
+    def _spill(self):
+        buffer = self.buffer
+        self._write_run((code, buffer[code]) for code in sorted(buffer))
+        buffer.clear()
+    
+    @staticmethod
+    def _read_run(path):
+        """Yield the (code, count) pairs of a run file"""
+        with open(path, 'rb') as f:
+            while True:
+                block = array('Q')
+                block.frombytes(f.read(16 * RUN_BLOCK_PAIRS))
+                if not block:
+                    return
+                yield from zip(block[::2], block[1::2])
+    
+    @staticmethod
+    def _sum_sorted(pairs):
+        """Add up the counts of equal adjacent codes"""
+        current, total = None, 0
+        for code, count in pairs:
+            if code == current:
+                total += count
+                continue
+            if current is not None:
+                yield current, total
+            current, total = code, count
+        if current is not None:
+            yield current, total
+    
+    def items(self):
+        """
+        Yield (UMI, reads) for every UMI
+        
+        Packed UMIs are yielded as their integer code (see decode), in code
+        order once counts were spilled, then the text UMIs.
+        """
+        if not self.runs:
+            yield from self.buffer.items()
+        else:
+            # Merge in passes of at most MAX_MERGE_RUNS open files
+            while len(self.runs) > MAX_MERGE_RUNS:
+                batch, self.runs = self.runs[:MAX_MERGE_RUNS], self.runs[MAX_MERGE_RUNS:]
+                self._write_run(self._sum_sorted(heapq.merge(*map(self._read_run, batch))))
+                for path in batch:
+                    os.unlink(path)
+            buffered = ((code, self.buffer[code]) for code in sorted(self.buffer))
+            yield from self._sum_sorted(heapq.merge(buffered, *map(self._read_run, self.runs)))
+        yield from self.other.items()
+    
+    def decode(self, umi):
+        """UMI string of an items() key"""
+        return umi if isinstance(umi, str) else unpack_umis([umi], self.umi_length)[0]
+    
+    def close(self):
+        """Remove the run files"""
+        if self._directory is not None:
+            self._directory.cleanup()
+            self._directory = None
+        self.runs = []
+
 def parse_umi_only_fastq(umi_fastq_file):
     """
     Parse UMI-only FASTQ file to extract quality scores
@@ -157,11 +462,155 @@ def calculate_quality_score(qual_string):
         return 0.0
     return sum(ord(c) - 33 for c in qual_string) / len(qual_string)
 
-def calculate_metrics(umi_counts, umi_qualities, total_reads, umi_length):
-    """Calculate comprehensive UMI QC metrics"""
+def count_umi_qualities(umi_fastq_file):
+    """
+    Count UMI quality strings in a UMI-only FASTQ (extract_umi_with_quality.py output)
+    
+    Unlike parse_umi_only_fastq, only distinct quality strings are kept.
+    
+    Returns:
+        Counter: Quality string -> number of UMIs
+    """
+    quality_counts = Counter()
+    opener = gzip.open if umi_fastq_file.endswith('.gz') else open
+    
+    with opener(umi_fastq_file, 'rt') as f:
+        while True:
+            header = f.readline()
+            if not header.strip():
+                break
+            umi_seq = f.readline().strip()
+            f.readline()
+            umi_qual = f.readline().strip()
+            if umi_seq and umi_qual:
+                quality_counts[umi_qual] += 1
+    
+    return quality_counts
+
+def summarize_quality_strings(quality_counts, umi_length):
+    """
+    Reduce UMI quality strings to integer histograms
+    
+    The histograms hold everything the quality metrics need and add up
+    exactly, so chunks of a sample can be summarised separately and merged.
+    
+    Args:
+        quality_counts: Counter of quality string -> number of UMIs
+        umi_length: Number of UMI positions tracked
+    
+    Returns:
+        dict: 'read_quality' (Counter of (Phred sum, length) -> UMIs) and
+              'position_quality' (one Counter of Phred -> UMIs per position)
+    """
+    read_quality = Counter()
+    position_quality = [Counter() for _ in range(umi_length)]
+    for qual_str, n in quality_counts.items():
+        phred = [ord(c) - 33 for c in qual_str]
+        read_quality[(sum(phred), len(phred))] += n
+        for pos, qual in enumerate(phred[:umi_length]):
+            position_quality[pos][qual] += n
+    return {'read_quality': read_quality, 'position_quality': position_quality}
+
+def calculate_quality_metrics(quality_summary):
+    """Overall and per-position UMI quality metrics from a quality summary"""
+    read_quality = quality_summary['read_quality'] if quality_summary else {}
+    total = sum(read_quality.values())
+    if total == 0:
+        return {
+            'mean_umi_quality': 0.0,
+            'min_umi_quality': 0.0,
+            'max_umi_quality': 0.0,
+            'per_position_quality': []
+        }
+    
+    # Mean quality of each UMI, summed in a fixed order so the result does
+    # not depend on the order in which reads (or chunks) were seen
+    read_means = sorted((qual_sum / length if length else 0.0, n) for (qual_sum, length), n in read_quality.items())
+    metrics = {
+        'mean_umi_quality': math.fsum(mean * n for mean, n in read_means) / total,
+        'min_umi_quality': read_means[0][0],
+        'max_umi_quality': read_means[-1][0],
+        'per_position_quality': []
+    }
+    
+    for pos, histogram in enumerate(quality_summary['position_quality']):
+        observed = {qual: n for qual, n in histogram.items() if n > 0}
+        if not observed:
+            continue
+        metrics['per_position_quality'].append({
+            'position': pos + 1,  # 1-indexed
+            'mean_quality': sum(qual * n for qual, n in observed.items()) / sum(observed.values()),
+            'min_quality': min(observed),
+            'max_quality': max(observed)
+        })
+    return metrics
+
+class _TopUmi:
+    """Top-UMI heap entry: more reads rank higher, then the smaller UMI string"""
+    __slots__ = ('reads', 'umi')
+    
+    def __init__(self, reads, umi):
+        self.reads = reads
+        self.umi = umi
+    
+    def __lt__(self, other):
+        return (self.reads, other.umi) < (other.reads, self.umi)
+
+def summarize_umi_counts(umi_counts, top=20):
+    """
+    One pass over the UMI counts: everything the metrics need but the census
+    
+    Args:
+        umi_counts: Counter (UMI -> reads) or ExternalUmiCounter
+        top: Number of most abundant UMIs kept
+    
+    Returns:
+        dict: unique_umis, total_umis, size_histogram (Counter of reads ->
+              UMIs) and top_umis ((UMI, reads) pairs, most abundant first,
+              ties by UMI string, so the order does not depend on how the
+              UMIs were counted)
+    """
+    decode = getattr(umi_counts, 'decode', None)
+    size_histogram = Counter()
+    heap = []
+    for umi, n in umi_counts.items():
+        size_histogram[n] += 1
+        # Only UMIs that can enter the heap are decoded
+        if len(heap) == top and n < heap[0].reads:
+            continue
+        entry = _TopUmi(n, decode(umi) if decode else umi)
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+        elif heap[0] < entry:
+            heapq.heapreplace(heap, entry)
+    return {
+        'unique_umis': sum(size_histogram.values()),
+        'total_umis': sum(n * umis for n, umis in size_histogram.items()),
+        'size_histogram': size_histogram,
+        'top_umis': [(entry.umi, entry.reads) for entry in sorted(heap, reverse=True)]
+    }
+
+def family_size_distribution(size_histogram, max_size=100):
+    """Family size -> UMIs for sizes 1 to min(largest, max_size), the MultiQC plot data"""
+    largest = min(max(size_histogram), max_size) if size_histogram else 0
+    return {size: size_histogram[size] for size in range(1, largest + 1)}
+
+def calculate_metrics(umi_counts, umi_qualities, total_reads, umi_length, quality_summary=None, umi_summary=None):
+    """
+    Calculate comprehensive UMI QC metrics
     
-    unique_umis = len(umi_counts)
-    total_umis = sum(umi_counts.values())
+    UMI quality comes from quality_summary (see summarize_quality_strings) or,
+    when that is not given, from umi_qualities (UMI -> quality strings).
+    umi_counts is a Counter or an ExternalUmiCounter; the Hamming-1 census
+    needs every UMI in memory and is skipped once an ExternalUmiCounter has
+    spilled (neighbour_census_computed is then False). umi_summary saves a
+    pass over the counts when the caller already has summarize_umi_counts.
+    """
+    if umi_summary is None:
+        umi_summary = summarize_umi_counts(umi_counts)
+    size_histogram = umi_summary['size_histogram']
+    unique_umis = umi_summary['unique_umis']
+    total_umis = umi_summary['total_umis']
     
     # Basic metrics
     metrics = {
@@ -176,7 +625,10 @@ def calculate_metrics(umi_counts, umi_qualities, total_reads, umi_length):
     
     # UMI diversity and complexity
     metrics['diversity_ratio'] = unique_umis / total_umis if total_umis > 0 else 0.0
-    metrics['shannon_entropy'] = calculate_shannon_entropy(umi_counts)
+    # Same value as calculate_shannon_entropy, summed once per family size
+    # (0.0 - x, not -x: a single distinct UMI gives 0.0, never -0.0)
+    metrics['shannon_entropy'] = 0.0 - math.fsum(umis * (n / total_umis) * log2(n / total_umis)
+                                                 for n, umis in size_histogram.items())
     metrics['max_entropy'] = umi_length * 2  # Maximum possible entropy for DNA (log2(4) per position)
     metrics['complexity_score'] = metrics['shannon_entropy'] / metrics['max_entropy'] if metrics['max_entropy'] > 0 else 0.0
     
@@ -197,101 +649,521 @@ def calculate_metrics(umi_counts, umi_qualities, total_reads, umi_length):
     metrics['observed_collision_rate'] = observed_collision_rate
     
     # Family size statistics
-    family_sizes = list(umi_counts.values())
-    family_sizes.sort()
-    
-    metrics['mean_family_size'] = sum(family_sizes) / len(family_sizes)
-    metrics['median_family_size'] = family_sizes[len(family_sizes) // 2]
-    metrics['min_family_size'] = min(family_sizes)
-    metrics['max_family_size'] = max(family_sizes)
+    metrics['mean_family_size'] = total_umis / unique_umis
+    metrics['median_family_size'] = _histogram_value_at(size_histogram, unique_umis // 2)
+    metrics['min_family_size'] = min(size_histogram)
+    metrics['max_family_size'] = max(size_histogram)
     
     # Singleton rate (UMIs with only 1 read)
-    singletons = sum(1 for count in umi_counts.values() if count == 1)
+    singletons = size_histogram[1]
     metrics['singleton_count'] = singletons
     metrics['singleton_rate'] = singletons / unique_umis if unique_umis > 0 else 0.0
     
     # Amplification metrics
     metrics['amplification_ratio'] = metrics['mean_family_size']  # Same as mean family size
     
+    # Saturation: analytic rarefaction over the family-size histogram. At full
+    # depth one more read finds a new UMI with probability singletons / reads
+    curve = rarefaction_curve(size_histogram)
+    metrics['umi_discovery_rate'] = size_histogram[1] / total_umis
+    metrics['umi_rarefaction'] = {point['reads']: round(point['unique_umis'], 2) for point in curve}
+    metrics['umi_saturation'] = {point['reads']: round(point['saturation'], 6) for point in curve}
+    
+    # Likely sequencing/PCR errors: UMIs one mismatch from a more abundant UMI
+    if not isinstance(umi_counts, ExternalUmiCounter):
+        metrics.update(hamming_neighbour_census(umi_counts, umi_length))
+    elif not umi_counts.spilled:
+        metrics.update(packed_neighbour_census(umi_counts.buffer, umi_length))
+    metrics['neighbour_census_computed'] = 'neighbour_checked_umis' in metrics
+    
     # UMI quality - overall and per-position
-    if umi_qualities:
-        all_qualities = []
-        position_qualities = [[] for _ in range(umi_length)]  # Track quality per position
-        
-        for umi, qual_list in umi_qualities.items():
-            for qual_str in qual_list:
-                # Overall quality
-                all_qualities.append(calculate_quality_score(qual_str))
-                
-                # Per-position quality
-                for pos, qual_char in enumerate(qual_str):
-                    if pos < umi_length:
-                        position_qualities[pos].append(ord(qual_char) - 33)
-        
-        # Overall quality metrics
-        metrics['mean_umi_quality'] = sum(all_qualities) / len(all_qualities) if all_qualities else 0.0
-        metrics['min_umi_quality'] = min(all_qualities) if all_qualities else 0.0
-        metrics['max_umi_quality'] = max(all_qualities) if all_qualities else 0.0
-        
-        # Per-position quality metrics
-        metrics['per_position_quality'] = []
-        for pos in range(umi_length):
-            if position_qualities[pos]:
-                pos_mean = sum(position_qualities[pos]) / len(position_qualities[pos])
-                pos_min = min(position_qualities[pos])
-                pos_max = max(position_qualities[pos])
-                metrics['per_position_quality'].append({
-                    'position': pos + 1,  # 1-indexed
-                    'mean_quality': pos_mean,
-                    'min_quality': pos_min,
-                    'max_quality': pos_max
-                })
-    else:
-        metrics['mean_umi_quality'] = 0.0
-        metrics['min_umi_quality'] = 0.0
-        metrics['max_umi_quality'] = 0.0
-        metrics['per_position_quality'] = []
+    if quality_summary is None and umi_qualities:
+        quality_counts = Counter(qual_str for qual_list in umi_qualities.values() for qual_str in qual_list)
+        quality_summary = summarize_quality_strings(quality_counts, umi_length)
+    metrics.update(calculate_quality_metrics(quality_summary))
     
     # Success rate (percentage of UMIs that would pass typical filters)
     # Typically: family size >= 2, quality >= 20
-    passing_umis = sum(1 for umi, count in umi_counts.items() if count >= 2)
+    passing_umis = unique_umis - singletons
     metrics['success_rate'] = passing_umis / unique_umis if unique_umis > 0 else 0.0
     
     return metrics
 
-def main():
-    parser = argparse.ArgumentParser(description='Calculate UMI QC metrics')
-    parser.add_argument('--fastq', required=True, help='Input FASTQ file with extracted UMIs')
-    parser.add_argument('--sample', required=True, help='Sample name')
-    parser.add_argument('--umi-length', type=int, default=12, help='UMI length')
-    parser.add_argument('--output', required=True, help='Output metrics file')
-    parser.add_argument('--multiqc', required=True, help='Output MultiQC JSON file')
+def _histogram_value_at(histogram, rank):
+    """Value at 0-based rank of the sorted values a histogram (value -> count) describes"""
+    seen = 0
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if seen > rank:
+            return value
+    raise IndexError(rank)
+
+def add_extract_metrics(metrics, extract_stats):
+    """Add the umi_tools extract counts (parse_extract_log) to a metrics dict"""
+    if not extract_stats:
+        return metrics
+    total_reads = metrics['total_reads']
+    metrics['extract_input_reads'] = extract_stats.get('input_reads', total_reads)
+    metrics['extract_output_reads'] = extract_stats.get('output_reads', total_reads)
+    metrics['quality_filtered_reads'] = extract_stats.get('quality_filtered', 0)
+    if extract_stats.get('input_reads'):
+        metrics['extract_pass_rate'] = extract_stats['output_reads'] / extract_stats['input_reads']
+        if metrics['quality_filtered_reads'] > 0:
+            metrics['quality_filter_rate'] = metrics['quality_filtered_reads'] / extract_stats['input_reads']
+    return metrics
+
+def parse_extract_log(log_file):
+    """
+    Parse read counts from a umi_tools extract log
     
-    args = parser.parse_args()
+    Returns:
+        dict: input_reads and output_reads (when logged) and quality_filtered
+    """
+    extract_stats = {}
+    with open(log_file, 'r') as f:
+        log_content = f.read()
     
-    # Parse FASTQ and extract UMI information
-    print(f"Processing {args.fastq}...", file=sys.stderr)
-    umi_counts, umi_qualities, total_reads = parse_fastq_with_umi(args.fastq)
+    input_match = re.search(r'INFO Input Reads:\s+(\d+)', log_content)
+    if input_match:
+        extract_stats['input_reads'] = int(input_match.group(1))
     
-    # Calculate metrics
-    metrics = calculate_metrics(umi_counts, umi_qualities, total_reads, args.umi_length)
+    output_match = re.search(r'INFO Reads output:\s+(\d+)', log_content)
+    if output_match:
+        extract_stats['output_reads'] = int(output_match.group(1))
     
-    # Write metrics to file
-    with open(args.output, 'w') as f:
-        f.write(f"Sample: {args.sample}\n")
+    quality_filtered_match = re.search(r'INFO filtered: umi quality:\s+(\d+)', log_content)
+    extract_stats['quality_filtered'] = int(quality_filtered_match.group(1)) if quality_filtered_match else 0
+    return extract_stats
+
+def build_partial_state(fastq_file, umi_fastq_file, umi_length, extract_log=None, chunk=None, counter=None):
+    """
+    Collect the mergeable state behind the pre-dedup metrics of one FASTQ (chunk)
+    
+    Args:
+        fastq_file: Reads with the UMI in the read name (umi_tools extract output)
+        umi_fastq_file: UMI-only FASTQ with UMI qualities (None: no qualities)
+        umi_length: UMI length
+        extract_log: umi_tools extract log (optional)
+        chunk: 1-based chunk number, used to merge chunks in read order
+        counter: ExternalUmiCounter to count the UMIs in (default: a Counter)
+    
+    Returns:
+        dict: UMI counts (in first-seen order), read total, quality histograms
+              and extract log counts
+    """
+    with umi_perf.stage('parse_umis'):
+        umi_counts, _, total_reads = parse_fastq_with_umi(fastq_file, counter)
+    with umi_perf.stage('parse_umi_qualities'):
+        quality_counts = count_umi_qualities(umi_fastq_file) if umi_fastq_file else Counter()
+        quality_summary = summarize_quality_strings(quality_counts, umi_length)
+    return {
+        'chunk': chunk,
+        'umi_length': umi_length,
+        'total_reads': total_reads,
+        'umi_counts': umi_counts,
+        'quality': quality_summary,
+        'extract': parse_extract_log(extract_log) if extract_log else {}
+    }
+
+def build_streaming_partial_state(fastq_file, original_fastq, umi_length, extract_log=None, chunk=None,
+                                  counter=None):
+    """
+    build_partial_state in a single pass, without the UMI-only FASTQ
+    
+    UMI qualities are taken from the first umi_length bases of the reads
+    before extraction, walking the original FASTQ in step with the extracted
+    one (umi_tools extract keeps read order and only drops reads), so both
+    inputs can be pipes and memory does not grow with the read count.
+    
+    An extracted read with no match in the rest of the original FASTQ means
+    the inputs are out of step (reordered, or R1/R2 swapped): the walk has
+    then consumed the original, and every later read would be miscounted,
+    so it is an error rather than a warning.
+    
+    Args:
+        fastq_file: Extracted reads (UMI in the read name), e.g. a named pipe
+        original_fastq: Reads before extraction (R1)
+        umi_length: UMI length
+        extract_log: umi_tools extract log (optional)
+        chunk: 1-based chunk number, used to merge chunks in read order
+        counter: ExternalUmiCounter to count the UMIs in (default: a Counter)
+    
+    Returns:
+        dict: The same state build_partial_state returns for these reads
+    
+    Raises:
+        ValueError: If an extracted read is not found in the original FASTQ
+    """
+    umi_counts = Counter() if counter is None else counter
+    add = counter.add if counter is not None else None
+    quality_counts = Counter()
+    total_reads = 0
+    
+    with umi_perf.stage('parse_umis'):
+        original = _read_fastq(original_fastq)
+        for header, _, _ in _read_fastq(fastq_file):
+            total_reads += 1
+            read_id = header.split()[0][1:]
+            original_read_id, separator, umi_seq = read_id.rpartition('_')
+            if separator and umi_seq and all(c in 'ACGTN' for c in umi_seq):
+                if add:
+                    add(umi_seq)
+                else:
+                    umi_counts[umi_seq] += 1
+            
+            original_read_id = original_read_id if separator else read_id
+            for orig_header, orig_seq, orig_qual in original:
+                if orig_header.split()[0][1:] == original_read_id:
+                    if len(orig_seq) >= umi_length and len(orig_qual) >= umi_length and umi_length > 0:
+                        quality_counts[orig_qual[:umi_length]] += 1
+                    break
+            else:
+                raise ValueError(f"Extracted read {total_reads} ({original_read_id}) not found in the rest of "
+                                 f"{original_fastq}: the extracted and original reads are not in the same order")
+    
+    with umi_perf.stage('parse_umi_qualities'):
+        quality_summary = summarize_quality_strings(quality_counts, umi_length)
+    return {
+        'chunk': chunk,
+        'umi_length': umi_length,
+        'total_reads': total_reads,
+        'umi_counts': umi_counts,
+        'quality': quality_summary,
+        'extract': parse_extract_log(extract_log) if extract_log else {}
+    }
+
+def _read_fastq(fastq_file):
+    """Yield (header, sequence, quality) records of a (gzipped) FASTQ file"""
+    opener = gzip.open if fastq_file.endswith('.gz') else open
+    with opener(fastq_file, 'rt') as f:
+        while True:
+            header = f.readline().strip()
+            if not header:
+                return
+            seq = f.readline().strip()
+            f.readline()
+            yield header, seq, f.readline().strip()
+
+def combine_extract_stats(stats_list):
+    """Add up umi_tools extract counts; a count missing from any input is dropped"""
+    stats_list = list(stats_list)
+    extract = {}
+    for key in ('input_reads', 'output_reads', 'quality_filtered'):
+        if all(key in stats for stats in stats_list):
+            extract[key] = sum(stats[key] for stats in stats_list)
+    return extract
+
+def merge_partial_states(states, counter=None):
+    """
+    Combine chunk states of one sample into the state of the whole sample
+    
+    Chunks are merged in chunk order, so UMI counts keep the first-seen order
+    of an unsplit run and every metric computed from the merged state is
+    identical to the unsplit one.
+    
+    With counter (an ExternalUmiCounter) the UMI counts are added to it and
+    states may be a generator: one state is held in memory at a time.
+    """
+    if counter is None:
+        states = sorted(states, key=lambda state: state['chunk'] or 0)
+    umi_counts = Counter() if counter is None else counter
+    umi_length = None
+    read_quality = Counter()
+    position_quality = None
+    total_reads = 0
+    extract_stats = []
+    for state in states:
+        if umi_length is None:
+            umi_length = state['umi_length']
+            position_quality = [Counter() for _ in range(umi_length)]
+        elif state['umi_length'] != umi_length:
+            raise ValueError(f"Chunks disagree on the UMI length: {sorted({umi_length, state['umi_length']})}")
+        umi_counts.update(state['umi_counts'])
+        read_quality.update(state['quality']['read_quality'])
+        for merged, histogram in zip(position_quality, state['quality']['position_quality']):
+            merged.update(histogram)
+        total_reads += state['total_reads']
+        extract_stats.append(state['extract'])
+    if umi_length is None:
+        raise ValueError("No states to merge")
+    
+    return {
+        'chunk': None,
+        'umi_length': umi_length,
+        'total_reads': total_reads,
+        'umi_counts': umi_counts,
+        'quality': {'read_quality': read_quality, 'position_quality': position_quality},
+        'extract': combine_extract_stats(extract_stats)
+    }
+
+def _state_payload(state):
+    """JSON-serialisable form of a partial state"""
+    return {
+        'format': PARTIAL_FORMAT,
+        'version': PARTIAL_VERSION,
+        'chunk': state['chunk'],
+        'umi_length': state['umi_length'],
+        'total_reads': state['total_reads'],
+        'umi_counts': dict(state['umi_counts']),
+        'read_quality': [[qual_sum, length, n] for (qual_sum, length), n in state['quality']['read_quality'].items()],
+        'position_quality': [{str(qual): n for qual, n in histogram.items()}
+                             for histogram in state['quality']['position_quality']],
+        'extract': state['extract']
+    }
+
+def _state_from_payload(payload, path):
+    """Partial state from its JSON-serialisable form"""
+    if payload.get('format') != PARTIAL_FORMAT or payload.get('version') != PARTIAL_VERSION:
+        raise ValueError(f"{path} is not a version {PARTIAL_VERSION} {PARTIAL_FORMAT} file")
+    
+    return {
+        'chunk': payload['chunk'],
+        'umi_length': payload['umi_length'],
+        'total_reads': payload['total_reads'],
+        'umi_counts': Counter(payload['umi_counts']),
+        'quality': {
+            'read_quality': Counter({(qual_sum, length): n for qual_sum, length, n in payload['read_quality']}),
+            'position_quality': [Counter({int(qual): n for qual, n in histogram.items()})
+                                 for histogram in payload['position_quality']]
+        },
+        'extract': payload['extract']
+    }
+
+def _little_endian(values):
+    """Array bytes in little-endian order"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def _from_little_endian(typecode, data):
+    """Array from little-endian bytes"""
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def pack_umis(umis):
+    """
+    Pack UMIs of one length (ACGT only, up to 32 bases) 2 bits per base
+    
+    Returns:
+        array: One unsigned 64-bit integer per UMI, or None if the UMIs
+               cannot be packed (N bases, mixed or longer lengths)
+    """
+    lengths = {len(umi) for umi in umis}
+    if len(lengths) > 1 or (lengths and not 0 < lengths.pop() <= 32):
+        return None
+    try:
+        return array('Q', (int(umi.translate(_PACK_BASES), 4) for umi in umis))
+    except ValueError:
+        return None
+
+def unpack_umis(packed, umi_length):
+    """UMI strings of pack_umis output"""
+    # An odd length gets one padding 'A' in front (the leading 2 bits are 0)
+    width = (umi_length + 1) // 2
+    start = umi_length % 2
+    return [format(value, f'0{width}x').translate(_UNPACK_HEX)[start:] for value in packed]
+
+def write_binary_state(state, path):
+    """
+    Write a partial state in the compact binary format
+    
+    The UMIs are stored 2-bit packed (as text when they cannot be packed)
+    and the counts as fixed-width integers, both in first-seen order, so
+    loading and merging states reproduces the metrics of an unsplit run.
+    Counts in an ExternalUmiCounter are streamed from its merge instead.
+    """
+    if isinstance(state['umi_counts'], ExternalUmiCounter):
+        _write_external_state(state, path)
+        return
+    payload = _state_payload(state)
+    umis = list(payload.pop('umi_counts'))
+    counts = array('Q', state['umi_counts'].values())
+    packed = pack_umis(umis)
+    if counts and max(counts) < 2 ** 32:
+        counts = array('I', counts)
+    
+    if packed is not None:
+        payload['umi_encoding'] = '2bit'
+        payload['packed_length'] = len(umis[0]) if umis else 0
+        umi_bytes = _little_endian(packed)
+    else:
+        payload['umi_encoding'] = 'text'
+        umi_bytes = '\n'.join(umis).encode('ascii')
+    payload['umis'] = len(umis)
+    payload['umi_bytes'] = len(umi_bytes)
+    payload['count_type'] = counts.typecode
+    _write_state_blocks(path, payload, [umi_bytes, _little_endian(counts)])
+
+def _write_state_blocks(path, payload, blocks):
+    """Write the magic and the compressed header and data blocks of a binary state"""
+    header = json.dumps(payload).encode('utf-8')
+    compressor = zlib.compressobj(6)
+    with open(path, 'wb') as f:
+        f.write(STATE_MAGIC)
+        for block in itertools.chain((struct.pack('<I', len(header)), header), blocks):
+            f.write(compressor.compress(block))
+        f.write(compressor.flush())
+
+def _file_blocks(f, size=16 * RUN_BLOCK_PAIRS):
+    """Yield the contents of a file from its start in blocks"""
+    f.seek(0)
+    return iter(lambda: f.read(size), b'')
+
+def _write_external_state(state, path):
+    """
+    write_binary_state for UMI counts in an ExternalUmiCounter
+    
+    The merged UMIs and counts are spooled to temporary files (the header
+    needs their sizes), then compressed into the state, so memory stays
+    within the counter's budget. UMIs are in code order once spilled.
+    """
+    counter = state['umi_counts']
+    payload = _state_payload({**state, 'umi_counts': {}})
+    del payload['umi_counts']
+    text = bool(counter.other)
+    umis, counts = array('Q'), array('Q')
+    n = umi_bytes = max_count = 0
+    with tempfile.TemporaryFile(dir=counter.tmp_dir) as umi_file, \
+            tempfile.TemporaryFile(dir=counter.tmp_dir) as count_file:
+        def flush():
+            if not text:
+                umi_file.write(_little_endian(umis))
+                del umis[:]
+            count_file.write(counts.tobytes())
+            del counts[:]
+        
+        for umi, reads in counter.items():
+            if text:
+                data = (b'\n' if n else b'') + counter.decode(umi).encode('ascii')
+                umi_file.write(data)
+                umi_bytes += len(data)
+            else:
+                umis.append(umi)
+                umi_bytes += 8
+            counts.append(reads)
+            max_count = max(max_count, reads)
+            n += 1
+            if len(counts) >= RUN_BLOCK_PAIRS:
+                flush()
+        flush()
+        
+        count_type = 'I' if max_count < 2 ** 32 else 'Q'
+        def count_blocks():
+            for block in _file_blocks(count_file):
+                values = array('Q')
+                values.frombytes(block)
+                yield _little_endian(array(count_type, values))
+        
+        if text:
+            payload['umi_encoding'] = 'text'
+        else:
+            payload['umi_encoding'] = '2bit'
+            payload['packed_length'] = counter.umi_length if n else 0
+        payload['umis'] = n
+        payload['umi_bytes'] = umi_bytes
+        payload['count_type'] = count_type
+        _write_state_blocks(path, payload, itertools.chain(_file_blocks(umi_file), count_blocks()))
+    counter._distinct = n
+
+def load_binary_state(path):
+    """Read a partial state written by write_binary_state"""
+    with open(path, 'rb') as f:
+        if f.read(len(STATE_MAGIC)) != STATE_MAGIC:
+            raise ValueError(f"{path} is not a binary UMI state file")
+        data = zlib.decompress(f.read())
+    
+    header_length, = struct.unpack_from('<I', data)
+    offset = 4 + header_length
+    payload = json.loads(data[4:offset])
+    umi_bytes = data[offset:offset + payload['umi_bytes']]
+    counts = _from_little_endian(payload['count_type'], data[offset + payload['umi_bytes']:])
+    
+    if payload['umi_encoding'] == '2bit':
+        umis = unpack_umis(_from_little_endian('Q', umi_bytes), payload['packed_length'])
+    else:
+        umis = umi_bytes.decode('ascii').split('\n') if payload['umis'] else []
+    if len(umis) != payload['umis'] or len(counts) != payload['umis']:
+        raise ValueError(f"{path} is truncated or corrupt")
+    payload['umi_counts'] = dict(zip(umis, counts))
+    return _state_from_payload(payload, path)
+
+def write_partial_state(state, path):
+    """Write a partial state: binary unless the path ends in .json or .json.gz"""
+    path = str(path)
+    if not path.endswith(('.json', '.json.gz')):
+        write_binary_state(state, path)
+        return
+    if isinstance(state['umi_counts'], ExternalUmiCounter):
+        raise ValueError(f"UMI counts under a memory limit are only written as binary states, not {path}")
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as f:
+        json.dump(_state_payload(state), f)
+
+def load_partial_state(path):
+    """Read a partial state written by write_partial_state (binary or JSON)"""
+    with open(path, 'rb') as f:
+        is_binary = f.read(len(STATE_MAGIC)) == STATE_MAGIC
+    if is_binary:
+        return load_binary_state(path)
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        payload = json.load(f)
+    return _state_from_payload(payload, path)
+
+def write_metrics_report(path, sample, metrics, extract_stats, thresholds=None):
+    """
+    Write the human-readable pre-dedup metrics summary
+    
+    Args:
+        path: Output text file
+        sample: Sample name
+        metrics: Metrics from calculate_metrics() and add_extract_metrics()
+        extract_stats: umi_tools extract log counts ({} when not available)
+        thresholds: Optional QC check thresholds (collision_rate, diversity,
+                    quality); a QC Checks section is written for the given ones
+    """
+    umi_length = metrics['umi_length']
+    with open(path, 'w') as f:
+        f.write(f"Sample: {sample}\n")
         f.write("=" * 60 + "\n\n")
         
+        # UMI Extraction Statistics (from umi_tools extract log)
+        if extract_stats:
+            f.write("UMI Extraction Statistics:\n")
+            f.write(f"  Input reads during Extraction: {metrics.get('extract_input_reads', 'N/A'):,}\n")
+            f.write(f"  Output reads after Extraction: {metrics.get('extract_output_reads', 'N/A'):,}\n")
+            if metrics.get('quality_filtered_reads', 0) > 0:
+                f.write(f"  Quality filtered reads during Extraction: {metrics['quality_filtered_reads']:,}\n")
+                if 'quality_filter_rate' in metrics:
+                    f.write(f"  Quality filter rate during Extraction: {metrics['quality_filter_rate']:.2%}\n")
+            if 'extract_pass_rate' in metrics:
+                f.write(f"  Pass rate during Extraction: {metrics['extract_pass_rate']:.2%}\n")
+            f.write("\n")
+        
         f.write("Extraction Statistics:\n")
-        f.write(f"  Total reads: {metrics['total_reads']:,}\n")
+        f.write(f"  Total reads analyzed: {metrics['total_reads']:,}\n")
         f.write(f"  Total UMIs: {metrics['total_umis']:,}\n")
         f.write(f"  Unique UMIs: {metrics['unique_umis']:,}\n")
-        f.write(f"  UMI length: {metrics['umi_length']}\n\n")
+        f.write(f"  UMI length: {umi_length}\n\n")
         
         f.write("UMI Diversity:\n")
         f.write(f"  Diversity ratio: {metrics['diversity_ratio']:.4f}\n")
         f.write(f"  Shannon entropy: {metrics['shannon_entropy']:.4f}\n")
-        f.write(f"  Complexity score: {metrics['complexity_score']:.4f}\n")
-        f.write(f"  Collision rate: {metrics['collision_rate']:.4f}\n\n")
+        f.write(f"  Complexity score: {metrics['complexity_score']:.4f}\n\n")
+        
+        f.write("UMI Collision Analysis (Birthday Problem):\n")
+        f.write(f"  UMI space (m = 4^{umi_length}): {4**umi_length:,}\n")
+        f.write(f"  Starting molecules (n): {metrics['unique_umis']:,}\n")
+        f.write(f"  Expected num unique UMIs: {metrics.get('expected_num_unique_umis', 0):.1f}\n")
+        f.write(f"  Expected num colliding pairs: {metrics.get('expected_num_colliding_pairs', 0):.2f}\n")
+        f.write(f"  Expected fraction molecules colliding: {metrics.get('expected_fraction_molecules_colliding', 0):.4f} ({metrics.get('expected_fraction_molecules_colliding', 0)*100:.2f}%)\n")
+        f.write(f"  Probability of at least one UMI collision: {metrics.get('prob_at_least_one_umi_collision', 0):.6f}\n")
+        f.write(f"  Expected duplicate rate for UMI before PCR (random collision): {metrics.get('expected_duplicate_rate', 0):.4f} ({metrics.get('expected_duplicate_rate', 0)*100:.2f}%)\n")
+        f.write(f"  Observed duplication rate (PCR + collision): {metrics['observed_collision_rate']:.4f} ({metrics['observed_collision_rate']*100:.2f}%)\n\n")
         
         f.write("Family Size Statistics:\n")
         f.write(f"  Mean family size: {metrics['mean_family_size']:.2f}\n")
@@ -304,83 +1176,201 @@ def main():
         f.write(f"  Singleton count: {metrics['singleton_count']:,}\n")
         f.write(f"  Singleton rate: {metrics['singleton_rate']:.4f}\n\n")
         
+        f.write("Hamming-1 Neighbours:\n")
+        if not metrics['neighbour_census_computed']:
+            f.write("  Not computed (UMI counts exceeded --memory-limit)\n")
+        else:
+            f.write(f"  UMIs checked (ACGT, full length): {metrics['neighbour_checked_umis']:,}\n")
+            f.write(f"  UMIs with a 1-mismatch neighbour: {metrics['hamming1_neighbour_umis']:,}\n")
+            f.write(f"  UMIs with a more abundant 1-mismatch neighbour: {metrics['abundant_neighbour_umis']:,} ({metrics['abundant_neighbour_rate']:.4f})\n")
+            f.write(f"  UMIs absorbed by directional clustering (neighbour >= 2n-1 reads): {metrics['directional_neighbour_umis']:,} ({metrics['directional_neighbour_rate']:.4f})\n")
+            f.write(f"  Reads in directional-absorbed UMIs: {metrics['directional_neighbour_read_fraction']:.4f}\n")
+            for ratio, n in metrics['neighbour_abundance_ratio'].items():
+                f.write(f"    Neighbour/own reads {ratio}: {n:,}\n")
+        f.write("\n")
+        
+        f.write("Saturation (analytic rarefaction):\n")
+        f.write(f"  New UMIs per additional read: {metrics['umi_discovery_rate']:.4f}\n")
+        f.write("    Reads  Expected unique UMIs  Saturation\n")
+        for reads, unique in metrics['umi_rarefaction'].items():
+            f.write(f"    {reads:,}  {unique:,.1f}  {metrics['umi_saturation'][reads]:.4f}\n")
+        f.write("\n")
+        
         f.write("Quality Metrics:\n")
         f.write(f"  Mean UMI quality: {metrics['mean_umi_quality']:.2f}\n")
-        f.write(f"  Min UMI quality: {metrics['min_umi_quality']:.2f}\n\n")
+        f.write(f"  Min UMI quality: {metrics['min_umi_quality']:.2f}\n")
+        f.write(f"  Max UMI quality: {metrics.get('max_umi_quality', 0):.2f}\n")
+        
+        # Per-position quality
+        if metrics.get('per_position_quality'):
+            f.write("\n  Per-Position Quality Scores:\n")
+            f.write("    Pos  Mean   Min   Max\n")
+            f.write("    " + "-" * 24 + "\n")
+            for pos_data in metrics['per_position_quality']:
+                f.write(f"    {pos_data['position']:3d}  {pos_data['mean_quality']:5.1f}  {pos_data['min_quality']:4.0f}  {pos_data['max_quality']:4.0f}\n")
+        f.write("\n")
         
         f.write("Performance Metrics:\n")
         f.write(f"  Success rate: {metrics['success_rate']:.4f}\n")
+        
+        # QC checks
+        thresholds = {name: value for name, value in (thresholds or {}).items() if value is not None}
+        if not thresholds:
+            return
+        f.write("\nQC Checks:\n")
+        collision = thresholds.get('collision_rate')
+        if collision is not None:
+            if metrics['observed_collision_rate'] > collision:
+                f.write(f"  WARNING: High observed duplication rate ({metrics['observed_collision_rate']:.4f} > {collision:g})\n")
+            if metrics.get('expected_duplicate_rate', 0) > collision:
+                f.write(f"  WARNING: High expected duplicate rate ({metrics['expected_duplicate_rate']:.4f} > {collision:g})\n")
+        if 'diversity' in thresholds and metrics['unique_umis'] < thresholds['diversity']:
+            f.write(f"  WARNING: Low UMI diversity ({metrics['unique_umis']} < {thresholds['diversity']})\n")
+        if 'quality' in thresholds and metrics['mean_umi_quality'] < thresholds['quality']:
+            f.write(f"  WARNING: Low UMI quality ({metrics['mean_umi_quality']:.2f} < {thresholds['quality']:g})\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calculate UMI QC metrics')
+    parser.add_argument('--fastq', help='Input FASTQ file with extracted UMIs')
+    parser.add_argument('--merge-states', nargs='+', metavar='STATE',
+                        help='Compute the metrics from these saved states (lanes, top-up runs, chunks) instead of --fastq')
+    parser.add_argument('--umi-fastq',
+                        help='UMI-only FASTQ (extract_umi_with_quality.py) for the UMI base qualities of --fastq')
+    parser.add_argument('--extract-log', nargs='+', metavar='LOG',
+                        help='umi_tools extract log; with --merge-states, the logs of all merged parts, whose counts '
+                             'replace the extract counts saved in the states')
+    parser.add_argument('--sample', required=True, help='Sample name')
+    parser.add_argument('--umi-length', type=int, default=12, help='UMI length')
+    parser.add_argument('--output', help='Output metrics file')
+    parser.add_argument('--multiqc', help='Output MultiQC JSON file')
+    parser.add_argument('--metrics-json', help='Output metrics record (versioned schema, .json or .msgpack)')
+    parser.add_argument('--state-output',
+                        help=f'Also save the complete metrics state ({STATE_SUFFIX}) for merging with later runs')
+    parser.add_argument('--partial-output',
+                        help=f'Only write the mergeable pre-dedup state ({STATE_SUFFIX}, or .json.gz) '
+                             f'for UMI_QC_METRICS_POSTUMIEXTRACT or --merge-states')
+    parser.add_argument('--original-fastq',
+                        help='R1 before extraction; with --partial-output, UMI qualities are read from it in one '
+                             'streaming pass (both inputs may be named pipes)')
+    parser.add_argument('--chunk', type=int, help='Chunk number stored in the partial state')
+    parser.add_argument('--memory-limit', type=parse_memory_size,
+                        help='Memory for UMI counts, e.g. 4G; beyond it counts are spilled to sorted runs on disk '
+                             'and merged (the Hamming-1 census is skipped once spilled)')
+    parser.add_argument('--tmp-dir', help='Directory for the spilled UMI count runs (default: $TMPDIR)')
+    parser.add_argument('--collision-rate-threshold', type=float,
+                        help='QC check: warn when the observed or expected duplication rate is above this')
+    parser.add_argument('--diversity-threshold', type=int,
+                        help='QC check: warn when there are fewer unique UMIs than this')
+    parser.add_argument('--quality-threshold', type=float,
+                        help='QC check: warn when the mean UMI quality is below this')
+    umi_perf.add_perf_arguments(parser)
+    
+    args = parser.parse_args()
+    if bool(args.fastq) == bool(args.merge_states):
+        parser.error('exactly one of --fastq and --merge-states is required')
+    if not args.partial_output and not (args.output and args.multiqc):
+        parser.error('--output and --multiqc are required unless --partial-output is given')
+    if args.original_fastq and not args.partial_output:
+        parser.error('--original-fastq is only used with --partial-output')
+    if args.umi_fastq and (args.original_fastq or args.merge_states):
+        parser.error('--umi-fastq is only used with --fastq, without --original-fastq')
+    if args.extract_log and len(args.extract_log) > 1 and not args.merge_states:
+        parser.error('several --extract-log files are only used with --merge-states')
+    umi_perf.start_from_args('calculate_umi_metrics', args, args.sample)
+    umi_perf.count_bytes('input_bytes', *(args.merge_states or filter(None, (args.fastq, args.umi_fastq))))
+    extract_log = args.extract_log[0] if args.extract_log else None
+    
+    # Spill-to-disk UMI counts when memory is limited; the run files are
+    # removed on exit either way
+    counter = ExternalUmiCounter(args.umi_length, args.memory_limit, args.tmp_dir) if args.memory_limit else None
+    if args.merge_states:
+        # Lanes, sequencing runs or chunks of one sample: only the saved
+        # states are read, never the reads behind them
+        print(f"Merging {len(args.merge_states)} UMI states...", file=sys.stderr)
+        with umi_perf.stage('merge_states'):
+            state = merge_partial_states((load_partial_state(path) for path in args.merge_states), counter)
+        # States streamed while umi_tools was still running come without
+        # extract counts; those are taken from the logs instead
+        if args.extract_log:
+            state['extract'] = combine_extract_stats(parse_extract_log(path) for path in args.extract_log)
+    elif args.original_fastq:
+        state = build_streaming_partial_state(args.fastq, args.original_fastq, args.umi_length,
+                                              extract_log=extract_log, chunk=args.chunk, counter=counter)
+    else:
+        print(f"Processing {args.fastq}...", file=sys.stderr)
+        if args.umi_fastq:
+            print(f"Analyzing UMI quality scores in: {args.umi_fastq}", file=sys.stderr)
+        state = build_partial_state(args.fastq, args.umi_fastq, args.umi_length, extract_log=extract_log,
+                                    chunk=args.chunk, counter=counter)
+    umi_counts = state['umi_counts']
+    umi_perf.count('reads', state['total_reads'])
+    if state['extract']:
+        print(f"Extract stats: {state['extract']}", file=sys.stderr)
+    if counter is not None:
+        umi_perf.count('spilled_runs', counter.run_files)
+        if counter.spilled:
+            print(f"UMI counts exceeded --memory-limit: merging {counter.run_files} sorted run files from disk; "
+                  f"Hamming-1 neighbour census skipped", file=sys.stderr)
+    
+    for path in filter(None, (args.partial_output, args.state_output)):
+        with umi_perf.stage('write_state'):
+            write_partial_state(state, path)
+        print(f"UMI state written to {path}", file=sys.stderr)
+    if args.partial_output:
+        umi_perf.count('unique_umis', len(umi_counts))
+        if counter is not None:
+            counter.close()
+        umi_perf.finish()
+        return
+    
+    # Calculate metrics
+    umi_perf.mark('compute')
+    umi_summary = summarize_umi_counts(umi_counts)
+    metrics = calculate_metrics(umi_counts, None, state['total_reads'], state['umi_length'],
+                                quality_summary=state['quality'], umi_summary=umi_summary)
+    add_extract_metrics(metrics, state['extract'])
+    umi_perf.count('unique_umis', metrics['unique_umis'])
+    if counter is not None:
+        counter.close()
     
     # Prepare plot data for MultiQC
     
-    # 1. Family size distribution data
-    family_sizes = list(umi_counts.values())
-    family_size_dist = {}
-    for size in range(1, min(max(family_sizes) + 1, 101)):  # Cap at 100 for display
-        family_size_dist[size] = family_sizes.count(size)
+    # 1. Family size distribution data (capped at 100 for display)
+    family_size_dist = family_size_distribution(umi_summary['size_histogram'])
     
     # 2. Top 20 UMIs
-    top_umis = dict(umi_counts.most_common(20))
-    
-    # 3. UMI quality by position
-    umi_quality_by_pos = {}
-    if umi_qualities:
-        for pos in range(args.umi_length):
-            pos_qualities = []
-            for umi, quals in umi_qualities.items():
-                for qual_str in quals:
-                    if len(qual_str) > pos:
-                        pos_qualities.append(ord(qual_str[pos]) - 33)
-            if pos_qualities:
-                umi_quality_by_pos[pos + 1] = sum(pos_qualities) / len(pos_qualities)
-    
-    # Write MultiQC JSON with metrics and plots
-    multiqc_data = {
-        "id": f"umi_qc_{args.sample}",
-        "plot_type": "generalstats",
-        "pconfig": {
-            "namespace": "UMI QC Metrics"
-        },
-        "data": {
-            args.sample: {
-                "total_reads": metrics['total_reads'],
-                "total_umis": metrics['total_umis'],
-                "unique_umis": metrics['unique_umis'],
-                "umi_length": metrics['umi_length'],
-                "diversity_ratio": metrics['diversity_ratio'],
-                "shannon_entropy": metrics['shannon_entropy'],
-                "complexity_score": metrics['complexity_score'],
-                "collision_rate": metrics['collision_rate'],
-                "mean_family_size": metrics['mean_family_size'],
-                "median_family_size": metrics['median_family_size'],
-                "min_family_size": metrics['min_family_size'],
-                "max_family_size": metrics['max_family_size'],
-                "singleton_count": metrics['singleton_count'],
-                "singleton_rate": metrics['singleton_rate'],
-                "amplification_ratio": metrics['amplification_ratio'],
-                "mean_umi_quality": metrics['mean_umi_quality'],
-                "min_umi_quality": metrics['min_umi_quality'],
-                "success_rate": metrics['success_rate']
-            }
-        },
-        "plot_data": {
-            "family_size_distribution": {
-                args.sample: family_size_dist
-            },
-            "top_umis": {
-                args.sample: top_umis
-            },
-            "umi_quality_by_position": {
-                args.sample: umi_quality_by_pos
-            }
-        }
-    }
+    top_umis = dict(umi_summary['top_umis'])
+    
+    # One schema record: the MultiQC JSON (incl. UMI quality by position) is
+    # derived from it; without an extract log, no reads count as filtered
+    record = from_metrics(
+        ExtractMetrics, args.sample, metrics,
+        extract_input_reads=metrics.get('extract_input_reads', metrics['total_reads']),
+        extract_output_reads=metrics.get('extract_output_reads', metrics['total_reads']),
+        extract_pass_rate=metrics.get('extract_pass_rate', 1.0),
+        family_size_distribution=family_size_dist,
+        top_umis=top_umis
+    )
+    
+    # Write metrics to file
+    umi_perf.mark('write')
+    write_metrics_report(args.output, args.sample, metrics, state['extract'], {
+        'collision_rate': args.collision_rate_threshold,
+        'diversity': args.diversity_threshold,
+        'quality': args.quality_threshold
+    })
+    
+    if args.metrics_json:
+        write_metrics(record, args.metrics_json)
+    multiqc_data = to_multiqc(record)
     
     with open(args.multiqc, 'w') as f:
         json.dump(multiqc_data, f, indent=2)
     
     print(f"Metrics written to {args.output}", file=sys.stderr)
     print(f"MultiQC data written to {args.multiqc}", file=sys.stderr)
+    umi_perf.finish()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Count reads and UMI molecules per reference sequence from a umi_tools group BAM.
+
+For oligo-pool amplicon libraries each designed sequence is its own contig,
+so the reference a read aligns to is its feature. One pass over the grouped
+BAM counts, per reference:
+- reads (read pairs count once)
+- molecules (distinct UG groups)
+- families (UG groups with at least --min-family-size reads)
+
+The output is a sparse count table (references without reads are omitted)
+that calculate_library_coverage.py reads with --counts-format umi, replacing
+the dedup BAM -> featureCounts step.
+"""
+
+import argparse
+import sys
+
+import pysam
+
+import umi_perf
+
+COUNTS_HEADER = '# umi_molecule_counts'
+COUNT_COLUMNS = ('reads', 'molecules', 'families')
+
+
+def count_molecules(bam_file, min_family_size=2):
+    """
+    Count reads, molecules and families per reference in one BAM pass.
+    
+    The BAM must be coordinate sorted (as umi_tools group writes it), so the
+    reads of a reference are contiguous and only the current reference's
+    group sizes are held in memory.
+    
+    Args:
+        bam_file: umi_tools group output BAM (UG tags)
+        min_family_size: Minimum reads for a group to count as a family
+    
+    Returns:
+        tuple: (list of (reference, reads, molecules, families) in BAM order,
+                dict of skipped read counts)
+    """
+    rows = []
+    skipped = {'unmapped_or_secondary': 0, 'no_group_tag': 0}
+    finished = set()
+    current = None
+    group_sizes = {}
+    
+    def flush():
+        if current is not None and group_sizes:
+            families = sum(1 for size in group_sizes.values() if size >= min_family_size)
+            rows.append((current, sum(group_sizes.values()), len(group_sizes), families))
+    
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.is_unmapped or read.is_secondary or read.is_supplementary:
+                skipped['unmapped_or_secondary'] += 1
+                continue
+            # Count each read pair once (its first mate)
+            if read.is_paired and read.is_read2:
+                continue
+            if not read.has_tag('UG'):
+                skipped['no_group_tag'] += 1
+                continue
+    
+            reference = read.reference_name
+            if reference != current:
+                flush()
+                if reference in finished:
+                    raise ValueError(f"{bam_file} is not coordinate sorted (reference {reference} seen twice)")
+                if current is not None:
+                    finished.add(current)
+                current = reference
+                group_sizes = {}
+    
+            group = read.get_tag('UG')
+            group_sizes[group] = group_sizes.get(group, 0) + 1
+    flush()
+    
+    return rows, skipped
+
+
+def write_counts(rows, output_file, sample_id):
+    """Write the sparse per-reference count table."""
+    with open(output_file, 'w') as f:
+        f.write(f"{COUNTS_HEADER}\tsample={sample_id}\n")
+        f.write('feature_id\t' + '\t'.join(COUNT_COLUMNS) + '\n')
+        for reference, reads, molecules, families in rows:
+            f.write(f"{reference}\t{reads}\t{molecules}\t{families}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count reads and UMI molecules per reference from a umi_tools group BAM')
+    parser.add_argument('--bam', required=True, help='Coordinate-sorted umi_tools group BAM (UG tags)')
+    parser.add_argument('--sample-id', required=True, help='Sample identifier')
+    parser.add_argument('--output', required=True, help='Output count table (TSV)')
+    parser.add_argument('--min-family-size', type=int, default=2,
+                        help='Minimum reads per UMI group for the families column (default: 2)')
+    umi_perf.add_perf_arguments(parser)
+    
+    args = parser.parse_args()
+    umi_perf.start_from_args('count_umi_molecules', args, args.sample_id)
+    umi_perf.count_bytes('input_bytes', args.bam)
+    
+    print(f"Counting UMI molecules in {args.bam}...", file=sys.stderr)
+    with umi_perf.stage('count'):
+        rows, skipped = count_molecules(args.bam, args.min_family_size)
+    with umi_perf.stage('write'):
+        write_counts(rows, args.output, args.sample_id)
+    
+    total_reads = sum(row[1] for row in rows)
+    total_molecules = sum(row[2] for row in rows)
+    umi_perf.count('reads', total_reads)
+    umi_perf.count('molecules', total_molecules)
+    umi_perf.count('references', len(rows))
+    
+    print(f"References with reads: {len(rows)}", file=sys.stderr)
+    print(f"Reads: {total_reads}, molecules: {total_molecules}, "
+          f"families (>= {args.min_family_size} reads): {sum(row[3] for row in rows)}", file=sys.stderr)
+    for reason, n in skipped.items():
+        if n:
+            print(f"Skipped ({reason.replace('_', ' ')}): {n}", file=sys.stderr)
+    print(f"Counts written to {args.output}", file=sys.stderr)
+    
+    umi_perf.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,8 @@ import sys
 import gzip
 import argparse
 
+import umi_perf
+
 def extract_umi_with_quality(original_fastq, extracted_fastq, output_fastq, umi_length):
     """
     Extract UMI sequences and quality scores by matching reads between files
@@ -31,6 +33,7 @@ def extract_umi_with_quality(original_fastq, extracted_fastq, output_fastq, umi_
     opener_out = gzip.open if output_fastq.endswith('.gz') else open
     
     # Step 1: Read original FASTQ and build dictionary of UMI sequences and qualities
+    umi_perf.mark('index_original')
     print("Step 1: Reading original FASTQ to extract UMI sequences and qualities...", file=sys.stderr)
     umi_dict = {}  # read_id -> (umi_seq, umi_qual)
     original_reads = 0
@@ -59,6 +62,7 @@ def extract_umi_with_quality(original_fastq, extracted_fastq, output_fastq, umi_
     print(f"  Loaded {len(umi_dict)} UMI sequences from {original_reads} reads", file=sys.stderr)
     
     # Step 2: Process extracted FASTQ and write UMI-only FASTQ
+    umi_perf.mark('write_umi_fastq')
     print("Step 2: Processing extracted FASTQ and writing UMI-only output...", file=sys.stderr)
     extracted_reads = 0
     matched_reads = 0
@@ -112,6 +116,11 @@ def extract_umi_with_quality(original_fastq, extracted_fastq, output_fastq, umi_
                 if missing_reads <= 10:  # Only show first 10 warnings
                     print(f"WARNING: Read {original_read_id} not found in original FASTQ", file=sys.stderr)
     
+    umi_perf.mark(None)
+    umi_perf.count('original_reads', original_reads)
+    umi_perf.count('extracted_reads', extracted_reads)
+    umi_perf.count('matched_reads', matched_reads)
+    
     print(f"\nSummary:", file=sys.stderr)
     print(f"  Original FASTQ: {original_reads} reads", file=sys.stderr)
     print(f"  Extracted FASTQ: {extracted_reads} reads", file=sys.stderr)
@@ -134,8 +143,11 @@ def main():
                         help='Output FASTQ file with UMI sequences only')
     parser.add_argument('-l', '--umi-length', type=int, required=True,
                         help='Length of UMI')
+    umi_perf.add_perf_arguments(parser)
     
     args = parser.parse_args()
+    umi_perf.start_from_args('extract_umi_with_quality', args)
+    umi_perf.count_bytes('input_bytes', args.original, args.extracted)
     
     extract_umi_with_quality(
         args.original,
@@ -143,6 +155,9 @@ def main():
         args.output,
         args.umi_length
     )
+    
+    umi_perf.count_bytes('output_bytes', args.output)
+    umi_perf.finish()
 
 if __name__ == '__main__':
     main()
@@ -10,16 +10,414 @@ This script creates a publication-quality, interactive HTML report with:
 """
 
 import argparse
+import csv
+import functools
+import hashlib
 import json
+import re
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from typing import Dict, List, Any
 
+import plotly
 import plotly.graph_objects as go
-import plotly.express as px
-from plotly.subplots import make_subplots
-import numpy as np
+
+import umi_perf
+from umi_metrics_schema import from_dict, is_metrics_document, to_report_metrics
+from umi_metrics_schema import load_metrics as load_schema_metrics
+
+
+# Shared page stylesheet, reused by every sample report and the cohort dashboard
+REPORT_CSS = """        * {
+            margin: 0;
+            padding: 0;
+            box-sizing: border-box;
+        }
+        
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
+            line-height: 1.6;
+            color: #1f2937;
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            min-height: 100vh;
+            padding: 2rem;
+        }
+        
+        .container {
+            max-width: 1400px;
+            margin: 0 auto;
+            background: white;
+            border-radius: 20px;
+            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
+            overflow: hidden;
+        }
+        
+        .header {
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            color: white;
+            padding: 3rem 2rem;
+            text-align: center;
+        }
+        
+        .header h1 {
+            font-size: 2.5rem;
+            margin-bottom: 0.5rem;
+            font-weight: 700;
+        }
+        
+        .header .subtitle {
+            font-size: 1.2rem;
+            opacity: 0.9;
+        }
+        
+        .content {
+            padding: 2rem;
+        }
+        
+        .section {
+            margin-bottom: 3rem;
+        }
+        
+        .section h2 {
+            font-size: 1.8rem;
+            margin-bottom: 1.5rem;
+            color: #667eea;
+            border-bottom: 3px solid #667eea;
+            padding-bottom: 0.5rem;
+        }
+        
+        .metrics-grid {
+            display: grid;
+            grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
+            gap: 1.5rem;
+            margin-bottom: 2rem;
+        }
+        
+        .metric-group {
+            background: #f9fafb;
+            border-radius: 12px;
+            padding: 1.5rem;
+            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
+        }
+        
+        .metric-group h3 {
+            font-size: 1.2rem;
+            margin-bottom: 1rem;
+            color: #4b5563;
+        }
+        
+        .metrics-table {
+            width: 100%;
+            border-collapse: collapse;
+        }
+        
+        .metrics-table td {
+            padding: 0.75rem 0;
+            border-bottom: 1px solid #e5e7eb;
+        }
+        
+        .metrics-table tr:last-child td {
+            border-bottom: none;
+        }
+        
+        .metric-name {
+            font-weight: 500;
+            color: #6b7280;
+        }
+        
+        .metric-value {
+            text-align: right;
+            font-weight: 700;
+            font-size: 1.1rem;
+        }
+        
+        .plot-container {
+            margin-bottom: 2rem;
+            background: white;
+            border-radius: 12px;
+            padding: 1rem;
+            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
+        }
+        
+        .recommendations {
+            background: #fef3c7;
+            border-left: 4px solid #f59e0b;
+            padding: 1.5rem;
+            border-radius: 8px;
+        }
+        
+        .recommendations h3 {
+            color: #92400e;
+            margin-bottom: 1rem;
+        }
+        
+        .recommendations ul {
+            list-style-position: inside;
+            color: #78350f;
+        }
+        
+        .recommendations li {
+            margin-bottom: 0.5rem;
+        }
+        
+        .cohort-table {
+            width: 100%;
+            border-collapse: collapse;
+            font-size: 0.95rem;
+        }
+        
+        .cohort-table th, .cohort-table td {
+            padding: 0.5rem 0.75rem;
+            border-bottom: 1px solid #e5e7eb;
+            text-align: right;
+        }
+        
+        .cohort-table th:first-child, .cohort-table td:first-child {
+            text-align: left;
+        }
+        
+        .footer {
+            text-align: center;
+            padding: 2rem;
+            color: #6b7280;
+            font-size: 0.9rem;
+            border-top: 1px solid #e5e7eb;
+        }
+        
+        @media print {
+            body {
+                background: white;
+                padding: 0;
+            }
+            .container {
+                box-shadow: none;
+            }
+        }
+"""
+
+# Columns of the --manifest TSV used by batch mode
+MANIFEST_COLUMNS = ('sample', 'pre_dedup_txt', 'pre_dedup_json', 'post_dedup_json', 'output')
+
+
+# How reports load plotly.js: from the CDN, embedded once per report, or
+# from one plotly.min.js shared by all reports written to the same directory
+PLOTLYJS_MODES = ('cdn', 'inline', 'directory')
+PLOTLYJS_BUNDLE = 'plotly.min.js'
+
+# Hydrates every figure spec on the page with the single plotly.js bundle,
+# re-attaching the layout template each figure shares with the others
+HYDRATE_SCRIPT = """<script>
+var plotlyTemplates = JSON.parse(document.getElementById('plotly-templates').textContent);
+document.querySelectorAll('script[data-plotly-figure]').forEach(function (spec) {
+    var figure = JSON.parse(spec.textContent);
+    if (spec.dataset.plotlyTemplate) {
+        figure.layout.template = plotlyTemplates[spec.dataset.plotlyTemplate];
+    }
+    Plotly.newPlot(spec.dataset.plotlyFigure, figure.data, figure.layout, {responsive: true});
+});
+</script>"""
+
+# Layout templates seen by figure_div, keyed by content hash; each page
+# embeds only the ones its figures reference, once
+_FIGURE_TEMPLATES = {}
+
+
+def _script_json(obj) -> str:
+    """Compact JSON that is safe to embed in a <script> element."""
+    return json.dumps(obj, separators=(',', ':')).replace('</', '<\\/')
+
+
+def figure_div(fig: go.Figure, div_id: str) -> str:
+    """
+    Serialise a figure as a placeholder div plus its compact JSON spec.
+    
+    The spec is hydrated client-side by HYDRATE_SCRIPT, so the page carries
+    one copy of plotly.js and of each layout template regardless of the
+    number of figures. Recent plotly versions encode numeric arrays as
+    base64 typed arrays in the JSON.
+    """
+    spec = json.loads(fig.to_json())
+    template = spec.get('layout', {}).pop('template', None)
+    template_attr = ''
+    if template:
+        template_json = _script_json(template)
+        key = hashlib.sha1(template_json.encode('utf-8')).hexdigest()[:12]
+        _FIGURE_TEMPLATES[key] = template_json
+        template_attr = f' data-plotly-template="{key}"'
+    return (f'<div id="{div_id}" class="plotly-graph-div"></div>'
+            f'<script type="application/json" data-plotly-figure="{div_id}"{template_attr}>{_script_json(spec)}</script>')
+
+
+# Bump to invalidate every cached report section
+SECTION_CACHE_FORMAT = 1
+
+# Per-process section cache statistics, reported after each page
+SECTION_CACHE_STATS = {'hit': 0, 'rendered': 0}
+
+
+@functools.lru_cache(maxsize=None)
+def report_source_digest() -> str:
+    """
+    sha256 of this module's source and HYDRATE_SCRIPT, computed once per process.
+    
+    Every section is keyed on it, so a change to any renderer or helper a
+    section calls (plots, colours, formatting, the client-side hydration)
+    invalidates the cache without each call site listing its dependencies.
+    """
+    digest = hashlib.sha256()
+    digest.update(Path(__file__).resolve().read_bytes())
+    digest.update(HYDRATE_SCRIPT.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def section_cache_key(name: str, inputs: Any, use_thresholds: bool) -> str:
+    """
+    Content hash identifying one rendered report section.
+    
+    Covers the section inputs, the source of the report module, the plotly
+    version (figure JSON) and, for sections that colour or judge values,
+    the current REPORT_THRESHOLDS.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{SECTION_CACHE_FORMAT}:{name}:{plotly.__version__}".encode('utf-8'))
+    digest.update(report_source_digest().encode('utf-8'))
+    digest.update(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8'))
+    if use_thresholds:
+        digest.update(json.dumps(REPORT_THRESHOLDS, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cached_section(cache_dir: str, name: str, inputs: Any, render, use_thresholds: bool = False) -> str:
+    """
+    Render a report section, reusing the cached HTML when nothing it depends on changed.
+    
+    Args:
+        cache_dir: Section cache directory (None disables caching)
+        name: Section name (part of the key and the cache file name)
+        inputs: JSON-serialisable data the section is rendered from
+        render: Zero-argument callable producing the section HTML
+        use_thresholds: True if the section depends on REPORT_THRESHOLDS
+        
+    Returns:
+        str: Section HTML
+    """
+    if not cache_dir:
+        return render()
+    
+    key = section_cache_key(name, inputs, use_thresholds)
+    cache_file = os.path.join(cache_dir, f"{name}-{key[:32]}.json")
+    
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            # Figures in the fragment refer to shared layout templates by key
+            _FIGURE_TEMPLATES.update(entry['templates'])
+            SECTION_CACHE_STATS['hit'] += 1
+            return entry['html']
+        except (OSError, ValueError, KeyError):
+            pass  # Unreadable entry: render again and overwrite it
+    
+    html = render()
+    template_keys = set(re.findall(r'data-plotly-template="(\w+)"', html))
+    entry = {'html': html, 'templates': {key: _FIGURE_TEMPLATES[key] for key in template_keys}}
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, separators=(',', ':'))
+    os.replace(tmp_file, cache_file)
+    SECTION_CACHE_STATS['rendered'] += 1
+    
+    return html
+
+
+@functools.lru_cache(maxsize=None)
+def _plotlyjs_bundle() -> str:
+    """Minified plotly.js shipped with the plotly package (read once per process)."""
+    import plotly.offline
+    return plotly.offline.get_plotlyjs()
+
+
+def write_plotlyjs_bundle(directory: str) -> str:
+    """
+    Write the shared plotly.min.js into a directory unless it is already there.
+    
+    Written via a temporary file and rename, so concurrent batch workers never
+    see a partial bundle.
+    
+    Returns:
+        str: Path of the bundle
+    """
+    bundle_file = os.path.join(directory or '.', PLOTLYJS_BUNDLE)
+    bundle = _plotlyjs_bundle()
+    if os.path.exists(bundle_file) and os.path.getsize(bundle_file) == len(bundle.encode('utf-8')):
+        return bundle_file
+    
+    tmp_file = f"{bundle_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(bundle)
+    os.replace(tmp_file, bundle_file)
+    return bundle_file
+
+
+def plotlyjs_tag(plotlyjs: str, output_file: str) -> str:
+    """
+    Build the script tag that loads plotly.js for a report.
+    
+    Args:
+        plotlyjs: One of PLOTLYJS_MODES
+        output_file: Report path; 'directory' mode writes the bundle next to it
+    """
+    if plotlyjs == 'inline':
+        return f'<script type="text/javascript">{_plotlyjs_bundle()}</script>'
+    if plotlyjs == 'directory':
+        write_plotlyjs_bundle(os.path.dirname(output_file))
+        return f'<script src="{PLOTLYJS_BUNDLE}" charset="utf-8"></script>'
+    # Match the CDN bundle to the plotly.js version the figures were built for
+    import plotly.offline
+    return f'<script src="https://cdn.plot.ly/plotly-{plotly.offline.get_plotlyjs_version()}.min.js" charset="utf-8"></script>'
+
+
+def render_page(title: str, heading: str, subtitle: str, content: str, plotlyjs_script: str) -> str:
+    """Wrap report content in the shared page layout (header, styles, footer)."""
+    templates = ','.join(f'"{key}":{template}' for key, template in _FIGURE_TEMPLATES.items()
+                         if f'data-plotly-template="{key}"' in content)
+    return f'''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{title}</title>
+    {plotlyjs_script}
+    <style>
+{REPORT_CSS}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>{heading}</h1>
+            <div class="subtitle">{subtitle}</div>
+            <div class="subtitle">Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</div>
+        </div>
+        
+        <div class="content">
+            {content}
+        </div>
+        
+        <div class="footer">
+            <p>UMI Amplicon Pipeline v1.0.0 | Generated with Plotly</p>
+            <p>Interactive plots: Hover for details, click and drag to zoom, double-click to reset</p>
+        </div>
+    </div>
+    <script type="application/json" id="plotly-templates">{{{templates}}}</script>
+    {HYDRATE_SCRIPT}
+</body>
+</html>'''
 
 
 def parse_args():
@@ -31,33 +429,88 @@ def parse_args():
         '--pre-dedup-txt',
         type=str,
         required=False,
-        help='Path to pre-deduplication metrics text file'
+        help='Path to pre-deduplication metrics text file (legacy; not needed with a metrics record)'
     )
     parser.add_argument(
-        '--pre-dedup-json',
+        '--pre-dedup-json', '--pre-dedup-metrics',
+        dest='pre_dedup_json',
         type=str,
         required=False,
-        help='Path to pre-deduplication metrics JSON file (for plot data)'
+        help='Path to pre-deduplication metrics record (*.umi_metrics.json/.msgpack) '
+             'or MultiQC JSON file (for plot data)'
     )
     parser.add_argument(
-        '--post-dedup-json',
+        '--post-dedup-json', '--post-dedup-metrics',
+        dest='post_dedup_json',
         type=str,
-        required=True,
-        help='Path to post-deduplication metrics JSON file'
+        required=False,
+        help='Path to post-deduplication metrics record (*.dedup_metrics.json/.msgpack) '
+             'or MultiQC JSON file (required unless --manifest)'
     )
     parser.add_argument(
         '--sample',
         type=str,
-        required=True,
-        help='Sample name'
+        required=False,
+        help='Sample name (required unless --manifest)'
     )
     parser.add_argument(
         '--output',
         type=str,
-        required=True,
-        help='Output HTML file path'
+        required=False,
+        help='Output HTML file path (required unless --manifest)'
+    )
+    parser.add_argument(
+        '--manifest',
+        type=str,
+        required=False,
+        help='Batch mode: TSV with columns ' + ', '.join(MANIFEST_COLUMNS) +
+             ' (header required; pre-dedup and output columns may be empty)'
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='Batch mode: number of worker processes rendering reports (default: 1)'
+    )
+    parser.add_argument(
+        '--cohort-output',
+        type=str,
+        required=False,
+        help='Batch mode: also write a cohort dashboard HTML comparing all samples'
+    )
+    parser.add_argument(
+        '--plotlyjs',
+        choices=PLOTLYJS_MODES,
+        default='cdn',
+        help="How reports load plotly.js: 'cdn' (default), 'inline' (embedded once, "
+             "fully offline) or 'directory' (one shared plotly.min.js next to the reports)"
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        required=False,
+        help='Cache rendered report sections here, keyed by a content hash of their inputs, '
+             'code and thresholds; later runs only rebuild sections that changed'
     )
-    return parser.parse_args()
+    parser.add_argument(
+        '--thresholds',
+        type=str,
+        required=False,
+        help='JSON file overriding colour/recommendation thresholds (same layout as REPORT_THRESHOLDS)'
+    )
+    umi_perf.add_perf_arguments(parser)
+    args = parser.parse_args()
+    
+    if args.manifest is None:
+        missing = [opt for opt, value in (('--post-dedup-json', args.post_dedup_json),
+                                          ('--sample', args.sample),
+                                          ('--output', args.output)) if not value]
+        if missing:
+            parser.error(f"the following arguments are required without --manifest: {', '.join(missing)}")
+    elif args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    
+    return args
 
 
 def parse_pre_dedup_txt(txt_file: str) -> Dict[str, Any]:
@@ -173,11 +626,33 @@ def parse_pre_dedup_txt(txt_file: str) -> Dict[str, Any]:
     return metrics
 
 
-def load_metrics(metrics_file: str) -> Dict[str, Any]:
-    """Load metrics from JSON file."""
+def read_metrics_document(metrics_file: str) -> tuple:
+    """
+    Load metrics from a versioned metrics record or a MultiQC JSON file.
+    
+    Returns:
+        tuple: (metrics dict, True if the file was a versioned metrics record)
+    """
+    if metrics_file.endswith('.msgpack'):
+        return to_report_metrics(load_schema_metrics(metrics_file)), True
+    
     with open(metrics_file, 'r') as f:
         data = json.load(f)
     
+    # Versioned metrics record: complete and typed, no further parsing needed
+    if is_metrics_document(data):
+        return to_report_metrics(from_dict(data)), True
+    
+    return _metrics_from_multiqc(data), False
+
+
+def load_metrics(metrics_file: str) -> Dict[str, Any]:
+    """Load metrics from JSON file."""
+    return read_metrics_document(metrics_file)[0]
+
+
+def _metrics_from_multiqc(data: Dict) -> Dict[str, Any]:
+    """Flatten a MultiQC custom-content JSON document into a metrics dict."""
     # Extract metrics from MultiQC JSON structure
     if 'data' in data:
         sample_key = list(data['data'].keys())[0]
@@ -192,15 +667,62 @@ def load_metrics(metrics_file: str) -> Dict[str, Any]:
     return data
 
 
-def get_status_color(metric_name: str, value: float) -> str:
-    """Get color based on metric value and thresholds."""
-    thresholds = {
+# Thresholds behind metric colours, summary-table highlighting and the
+# recommendations. Overridable per run with --thresholds; part of the
+# cache key of every section that uses them.
+REPORT_THRESHOLDS = {
+    'status': {
         'diversity_ratio': {'excellent': 0.7, 'good': 0.5, 'warning': 0.3},
         'complexity_score': {'excellent': 0.9, 'good': 0.7, 'warning': 0.5},
         'collision_rate': {'excellent': 0.01, 'good': 0.05, 'warning': 0.1, 'inverse': True},
         'singleton_rate': {'excellent': (0.2, 0.6), 'good': (0.1, 0.8), 'range': True},
         'mean_umi_quality': {'excellent': 30, 'good': 20, 'warning': 15},
-    }
+    },
+    'summary_table': {
+        'rate_high': 0.8,
+        'rate_medium': 0.5,
+        'deduplication_rate_pct_high': 80,
+        'singleton_family_rate_pct_high': 50,
+        'error_correction_rate_pct_high': 30,
+    },
+    'recommendations': {
+        'diversity_ratio_low': 0.3,
+        'diversity_ratio_high': 0.7,
+        'collision_rate_high': 0.1,
+        'mean_family_size_high': 10,
+        'mean_family_size_low': 2,
+        'singleton_rate_high': 0.8,
+        'mean_umi_quality_low': 20,
+        'mean_umi_quality_excellent': 30,
+    },
+}
+
+
+def load_thresholds(thresholds_file: str):
+    """
+    Override REPORT_THRESHOLDS from a JSON file.
+    
+    The file has the same layout as REPORT_THRESHOLDS; only the values it
+    names are replaced (e.g. {"recommendations": {"collision_rate_high": 0.05}}).
+    """
+    with open(thresholds_file, 'r') as f:
+        overrides = json.load(f)
+    
+    for group, values in overrides.items():
+        if group not in REPORT_THRESHOLDS:
+            raise ValueError(f"Unknown threshold group in {thresholds_file}: {group}")
+        for name, value in values.items():
+            if isinstance(value, dict) and isinstance(REPORT_THRESHOLDS[group].get(name), dict):
+                REPORT_THRESHOLDS[group][name].update(value)
+            else:
+                REPORT_THRESHOLDS[group][name] = value
+    
+    print(f"Loaded report thresholds from {thresholds_file}", file=sys.stderr)
+
+
+def get_status_color(metric_name: str, value: float) -> str:
+    """Get color based on metric value and thresholds."""
+    thresholds = REPORT_THRESHOLDS['status']
     
     if metric_name not in thresholds:
         return '#3b82f6'  # Default blue
@@ -277,6 +799,44 @@ def create_family_size_plot(metrics: Dict) -> go.Figure:
     return fig
 
 
+def create_saturation_plot(metrics: Dict) -> go.Figure:
+    """Create the UMI rarefaction curve (expected unique UMIs vs subsampled reads)."""
+    plot_data = metrics.get('plot_data', {})
+    if not plot_data.get('umi_rarefaction'):
+        return None
+    
+    sample_key = list(plot_data['umi_rarefaction'].keys())[0]
+    data = plot_data['umi_rarefaction'][sample_key]
+    saturation = plot_data.get('umi_saturation', {}).get(sample_key, {})
+    if not data:
+        return None
+    
+    reads = sorted(int(k) for k in data.keys())
+    unique = [data[str(r)] for r in reads]
+    
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=reads,
+        y=unique,
+        mode='lines+markers',
+        line=dict(color='#3b82f6', width=2),
+        customdata=[saturation.get(str(r), 0.0) for r in reads],
+        hovertemplate='<b>Reads:</b> %{x:,}<br><b>Expected unique UMIs:</b> %{y:,.0f}<br>'
+                      '<b>Saturation:</b> %{customdata:.2%}<extra></extra>'
+    ))
+    
+    fig.update_layout(
+        title='UMI Rarefaction (expected unique UMIs at lower sequencing depth)',
+        xaxis_title='Reads (subsampled)',
+        yaxis_title='Expected unique UMIs',
+        template='plotly_white',
+        hovermode='closest',
+        height=450
+    )
+    
+    return fig
+
+
 def create_top_umis_plot(metrics: Dict) -> go.Figure:
     """Create interactive top UMIs bar chart."""
     if 'plot_data' not in metrics or 'top_umis' not in metrics['plot_data']:
@@ -288,8 +848,9 @@ def create_top_umis_plot(metrics: Dict) -> go.Figure:
     umis = list(data.keys())[:20]
     counts = [data[umi] for umi in umis]
     
-    # Create color gradient
-    colors = px.colors.sequential.Blues_r[:len(umis)]
+    # Create color gradient (plotly.colors, not plotly.express, which imports pandas)
+    from plotly.colors import sequential
+    colors = sequential.Blues_r[:len(umis)]
     
     fig = go.Figure()
     
@@ -414,6 +975,7 @@ def create_quality_plot(metrics: Dict) -> go.Figure:
 
 def create_metrics_gauge(metrics: Dict) -> go.Figure:
     """Create gauge charts for key metrics."""
+    from plotly.subplots import make_subplots
     fig = make_subplots(
         rows=2, cols=3,
         specs=[[{'type': 'indicator'}, {'type': 'indicator'}, {'type': 'indicator'}],
@@ -529,7 +1091,7 @@ def create_summary_table(metrics: Dict) -> str:
             ('Complexity score', metrics.get('complexity_score', 0), '{:.4f}'),
         ],
         'UMI Collision Analysis (Birthday Problem)': [
-            ('Starting molecules (n)', metrics.get('starting_molecules', 0), '{:,}'),
+            ('Starting molecules (n)', metrics.get('starting_molecules', metrics.get('unique_umis', 0)), '{:,}'),
             ('Expected num unique UMIs', metrics.get('expected_num_unique_umis', 0), '{:.1f}'),
             ('Expected num colliding pairs', metrics.get('expected_num_colliding_pairs', 0), '{:.2f}'),
             ('Expected fraction molecules colliding', metrics.get('expected_fraction_molecules_colliding', 0), '{:.4f}'),
@@ -558,6 +1120,7 @@ def create_summary_table(metrics: Dict) -> str:
         ]
     }
     
+    thresholds = REPORT_THRESHOLDS['summary_table']
     html = '<div class="metrics-grid">'
     
     for group_name, group_metrics in metric_groups.items():
@@ -576,9 +1139,9 @@ def create_summary_table(metrics: Dict) -> str:
             # Get color based on metric type
             color = '#3b82f6'  # Default blue
             if 'rate' in name.lower() or 'ratio' in name.lower():
-                if value != 'N/A' and value > 0.8:
+                if value != 'N/A' and value > thresholds['rate_high']:
                     color = '#ef4444'  # Red for high rates
-                elif value != 'N/A' and value > 0.5:
+                elif value != 'N/A' and value > thresholds['rate_medium']:
                     color = '#f59e0b'  # Orange for medium
                 else:
                     color = '#10b981'  # Green for low
@@ -627,6 +1190,7 @@ def create_post_dedup_summary_table(metrics: Dict) -> str:
         ]
     }
     
+    thresholds = REPORT_THRESHOLDS['summary_table']
     html = '<div class="metrics-grid">'
     
     for group_name, group_metrics in metric_groups.items():
@@ -640,11 +1204,11 @@ def create_post_dedup_summary_table(metrics: Dict) -> str:
             
             # Get color based on metric type
             color = '#3b82f6'  # Default blue
-            if 'deduplication rate' in name.lower() and value > 80:
+            if 'deduplication rate' in name.lower() and value > thresholds['deduplication_rate_pct_high']:
                 color = '#ef4444'  # Red for high dedup rate
-            elif 'singleton' in name.lower() and 'rate' in name.lower() and value > 50:
+            elif 'singleton' in name.lower() and 'rate' in name.lower() and value > thresholds['singleton_family_rate_pct_high']:
                 color = '#f59e0b'  # Orange for high singleton rate
-            elif 'error correction rate' in name.lower() and value > 30:
+            elif 'error correction rate' in name.lower() and value > thresholds['error_correction_rate_pct_high']:
                 color = '#f59e0b'  # Orange for high error correction
             
             html += f'''
@@ -660,7 +1224,7 @@ def create_post_dedup_summary_table(metrics: Dict) -> str:
     return html
 
 
-def create_pre_dedup_section(metrics: Dict) -> str:
+def create_pre_dedup_section(metrics: Dict, cache_dir: str = None) -> str:
     """Create post-UMI extraction section (before deduplication) with comprehensive metrics and visualizations."""
     if not metrics:
         return ""
@@ -670,25 +1234,41 @@ def create_pre_dedup_section(metrics: Dict) -> str:
     
     # Add comprehensive metrics table using the updated create_summary_table function
     html += '<h3 style="margin-top: 2rem;">Summary Metrics</h3>'
-    html += create_summary_table(metrics)
+    html += cached_section(cache_dir, 'pre_summary', metrics, lambda: create_summary_table(metrics),
+                           use_thresholds=True)
     
     # Add visualizations
     html += '<h3 style="margin-top: 2rem;">Interactive Visualizations</h3>'
+    html += cached_section(cache_dir, 'pre_plots', metrics, lambda: create_pre_dedup_plots(metrics))
+    
+    html += '</div>'
+    
+    return html
+
+
+def create_pre_dedup_plots(metrics: Dict) -> str:
+    """Create the pre-deduplication figures (quality, family size, top UMIs, saturation, collisions)."""
+    html = ''
     
     # 1. Per-position quality plot (using the improved version from create_quality_plot)
     quality_plot = create_quality_plot(metrics)
     if quality_plot:
-        html += f'<div class="plot-container">{quality_plot.to_html(include_plotlyjs=False, div_id="pre_quality")}</div>'
+        html += f'<div class="plot-container">{figure_div(quality_plot, "pre_quality")}</div>'
     
     # 2. Family size distribution
     family_plot = create_family_size_plot(metrics)
     if family_plot:
-        html += f'<div class="plot-container">{family_plot.to_html(include_plotlyjs=False, div_id="pre_family_size")}</div>'
+        html += f'<div class="plot-container">{figure_div(family_plot, "pre_family_size")}</div>'
     
     # 3. Top UMIs
     top_umis_plot = create_top_umis_plot(metrics)
     if top_umis_plot:
-        html += f'<div class="plot-container">{top_umis_plot.to_html(include_plotlyjs=False, div_id="pre_top_umis")}</div>'
+        html += f'<div class="plot-container">{figure_div(top_umis_plot, "pre_top_umis")}</div>'
+    
+    # 3b. Rarefaction / saturation curve
+    saturation_plot = create_saturation_plot(metrics)
+    if saturation_plot:
+        html += f'<div class="plot-container">{figure_div(saturation_plot, "pre_saturation")}</div>'
     
     # 4. Collision Analysis Bar Chart
     collision_data = {
@@ -713,209 +1293,60 @@ def create_pre_dedup_section(metrics: Dict) -> str:
         height=450,
         showlegend=False
     )
-    html += f'<div class="plot-container">{fig.to_html(include_plotlyjs=False, div_id="pre_collision")}</div>'
-    
-    html += '</div>'
+    html += f'<div class="plot-container">{figure_div(fig, "pre_collision")}</div>'
     
     return html
 
 
-def generate_html_report(pre_dedup_metrics: Dict, post_dedup_metrics: Dict, sample: str, output_file: str):
-    """Generate complete HTML report with Plotly visualizations."""
-    
-    # Create post-dedup plots
-    family_size_plot = create_family_size_plot(post_dedup_metrics)
-    top_umis_plot = create_top_umis_plot(post_dedup_metrics)
-    quality_plot = create_quality_plot(post_dedup_metrics)
+def create_post_dedup_plots(metrics: Dict) -> str:
+    """Create the post-deduplication figures (family size, top UMIs, quality)."""
+    family_size_plot = create_family_size_plot(metrics)
+    top_umis_plot = create_top_umis_plot(metrics)
+    quality_plot = create_quality_plot(metrics)
     
     # Convert plots to HTML
     plots_html = ""
     if family_size_plot:
-        plots_html += f'<div class="plot-container">{family_size_plot.to_html(include_plotlyjs=False, div_id="family_size")}</div>'
+        plots_html += f'<div class="plot-container">{figure_div(family_size_plot, "family_size")}</div>'
     if top_umis_plot:
-        plots_html += f'<div class="plot-container">{top_umis_plot.to_html(include_plotlyjs=False, div_id="top_umis")}</div>'
+        plots_html += f'<div class="plot-container">{figure_div(top_umis_plot, "top_umis")}</div>'
     if quality_plot:
-        plots_html += f'<div class="plot-container">{quality_plot.to_html(include_plotlyjs=False, div_id="quality")}</div>'
+        plots_html += f'<div class="plot-container">{figure_div(quality_plot, "quality")}</div>'
+    
+    return plots_html
+
+
+def generate_html_report(pre_dedup_metrics: Dict, post_dedup_metrics: Dict, sample: str, output_file: str,
+                         plotlyjs: str = 'cdn', cache_dir: str = None):
+    """
+    Generate complete HTML report with Plotly visualizations.
+    
+    With a cache_dir, each section (summary tables, figure blocks,
+    recommendations) is cached under a content hash of its inputs and the
+    report code, so only sections whose inputs, code or thresholds changed
+    are rebuilt; the page itself is always reassembled.
+    """
+    SECTION_CACHE_STATS.update(hit=0, rendered=0)
+    
+    # Create post-dedup plots
+    plots_html = cached_section(cache_dir, 'post_plots', post_dedup_metrics,
+                                lambda: create_post_dedup_plots(post_dedup_metrics))
     
     # Create pre-dedup section
-    pre_dedup_section = create_pre_dedup_section(pre_dedup_metrics)
+    pre_dedup_section = create_pre_dedup_section(pre_dedup_metrics, cache_dir)
     
     # Create post-dedup metrics table using the dedicated post-dedup function
-    metrics_table = create_post_dedup_summary_table(post_dedup_metrics)
+    metrics_table = cached_section(cache_dir, 'post_summary', post_dedup_metrics,
+                                   lambda: create_post_dedup_summary_table(post_dedup_metrics),
+                                   use_thresholds=True)
     
     # Generate recommendations
-    recommendations = generate_recommendations(post_dedup_metrics)
+    recommendations = cached_section(cache_dir, 'recommendations', post_dedup_metrics,
+                                     lambda: generate_recommendations(post_dedup_metrics),
+                                     use_thresholds=True)
     
     # Create HTML
-    html = f'''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>UMI QC Report - {sample}</title>
-    <script src="https://cdn.plot.ly/plotly-2.26.0.min.js"></script>
-    <style>
-        * {{
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }}
-        
-        body {{
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
-            line-height: 1.6;
-            color: #1f2937;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            padding: 2rem;
-        }}
-        
-        .container {{
-            max-width: 1400px;
-            margin: 0 auto;
-            background: white;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0, 0, 0, 0.3);
-            overflow: hidden;
-        }}
-        
-        .header {{
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            color: white;
-            padding: 3rem 2rem;
-            text-align: center;
-        }}
-        
-        .header h1 {{
-            font-size: 2.5rem;
-            margin-bottom: 0.5rem;
-            font-weight: 700;
-        }}
-        
-        .header .subtitle {{
-            font-size: 1.2rem;
-            opacity: 0.9;
-        }}
-        
-        .content {{
-            padding: 2rem;
-        }}
-        
-        .section {{
-            margin-bottom: 3rem;
-        }}
-        
-        .section h2 {{
-            font-size: 1.8rem;
-            margin-bottom: 1.5rem;
-            color: #667eea;
-            border-bottom: 3px solid #667eea;
-            padding-bottom: 0.5rem;
-        }}
-        
-        .metrics-grid {{
-            display: grid;
-            grid-template-columns: repeat(auto-fit, minmax(300px, 1fr));
-            gap: 1.5rem;
-            margin-bottom: 2rem;
-        }}
-        
-        .metric-group {{
-            background: #f9fafb;
-            border-radius: 12px;
-            padding: 1.5rem;
-            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-        }}
-        
-        .metric-group h3 {{
-            font-size: 1.2rem;
-            margin-bottom: 1rem;
-            color: #4b5563;
-        }}
-        
-        .metrics-table {{
-            width: 100%;
-            border-collapse: collapse;
-        }}
-        
-        .metrics-table td {{
-            padding: 0.75rem 0;
-            border-bottom: 1px solid #e5e7eb;
-        }}
-        
-        .metrics-table tr:last-child td {{
-            border-bottom: none;
-        }}
-        
-        .metric-name {{
-            font-weight: 500;
-            color: #6b7280;
-        }}
-        
-        .metric-value {{
-            text-align: right;
-            font-weight: 700;
-            font-size: 1.1rem;
-        }}
-        
-        .plot-container {{
-            margin-bottom: 2rem;
-            background: white;
-            border-radius: 12px;
-            padding: 1rem;
-            box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-        }}
-        
-        .recommendations {{
-            background: #fef3c7;
-            border-left: 4px solid #f59e0b;
-            padding: 1.5rem;
-            border-radius: 8px;
-        }}
-        
-        .recommendations h3 {{
-            color: #92400e;
-            margin-bottom: 1rem;
-        }}
-        
-        .recommendations ul {{
-            list-style-position: inside;
-            color: #78350f;
-        }}
-        
-        .recommendations li {{
-            margin-bottom: 0.5rem;
-        }}
-        
-        .footer {{
-            text-align: center;
-            padding: 2rem;
-            color: #6b7280;
-            font-size: 0.9rem;
-            border-top: 1px solid #e5e7eb;
-        }}
-        
-        @media print {{
-            body {{
-                background: white;
-                padding: 0;
-            }}
-            .container {{
-                box-shadow: none;
-            }}
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>🧬 UMI Quality Control Report</h1>
-            <div class="subtitle">Sample: {sample}</div>
-            <div class="subtitle">Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</div>
-        </div>
-        
-        <div class="content">
-            {pre_dedup_section}
+    content = f'''{pre_dedup_section}
             
             <div class="section post-dedup-section">
                 <h2>📊 Section 2: Post-Deduplication Metrics</h2>
@@ -930,58 +1361,55 @@ def generate_html_report(pre_dedup_metrics: Dict, post_dedup_metrics: Dict, samp
             <div class="section">
                 <h2>💡 Recommendations</h2>
                 {recommendations}
-            </div>
-        </div>
-        
-        <div class="footer">
-            <p>UMI Amplicon Pipeline v1.0.0 | Generated with Plotly</p>
-            <p>Interactive plots: Hover for details, click and drag to zoom, double-click to reset</p>
-        </div>
-    </div>
-</body>
-</html>'''
+            </div>'''
+    html = render_page(f"UMI QC Report - {sample}", "🧬 UMI Quality Control Report", f"Sample: {sample}", content,
+                       plotlyjs_tag(plotlyjs, output_file))
     
     # Write HTML file
     with open(output_file, 'w') as f:
         f.write(html)
     
+    if cache_dir:
+        print(f"Report sections: {SECTION_CACHE_STATS['hit']} from cache, "
+              f"{SECTION_CACHE_STATS['rendered']} rendered", file=sys.stderr)
     print(f"Interactive HTML report generated: {output_file}", file=sys.stderr)
 
 
 def generate_recommendations(metrics: Dict) -> str:
     """Generate automated recommendations based on metrics."""
     recommendations = []
+    thresholds = REPORT_THRESHOLDS['recommendations']
     
     diversity_ratio = metrics.get('diversity_ratio', 0)
-    collision_rate = metrics.get('collision_rate', 0)
+    collision_rate = metrics.get('observed_collision_rate', metrics.get('collision_rate', 0))
     mean_family_size = metrics.get('mean_family_size', 0)
     singleton_rate = metrics.get('singleton_rate', 0)
     mean_quality = metrics.get('mean_umi_quality', 0)
     
     # Diversity recommendations
-    if diversity_ratio < 0.3:
+    if diversity_ratio < thresholds['diversity_ratio_low']:
         recommendations.append("⚠️ <strong>Low diversity</strong>: Consider reducing PCR cycles by 2-3 or increasing starting material")
-    elif diversity_ratio > 0.7:
+    elif diversity_ratio > thresholds['diversity_ratio_high']:
         recommendations.append("✅ <strong>Excellent diversity</strong>: Library complexity is optimal")
     
     # Collision recommendations
-    if collision_rate > 0.1:
+    if collision_rate > thresholds['collision_rate_high']:
         recommendations.append("⚠️ <strong>High collision rate</strong>: Consider using longer UMIs (16bp instead of 12bp)")
     
     # Amplification recommendations
-    if mean_family_size > 10:
+    if mean_family_size > thresholds['mean_family_size_high']:
         recommendations.append("⚠️ <strong>Over-amplification</strong>: Reduce PCR cycles to minimize duplication")
-    elif mean_family_size < 2:
+    elif mean_family_size < thresholds['mean_family_size_low']:
         recommendations.append("⚠️ <strong>Under-amplification</strong>: Increase PCR cycles or sequencing depth")
     
     # Singleton recommendations
-    if singleton_rate > 0.8:
+    if singleton_rate > thresholds['singleton_rate_high']:
         recommendations.append("⚠️ <strong>High singleton rate</strong>: May indicate insufficient sequencing depth")
     
     # Quality recommendations
-    if mean_quality < 20:
+    if mean_quality < thresholds['mean_umi_quality_low']:
         recommendations.append("❌ <strong>Low UMI quality</strong>: Check sequencing quality and consider re-sequencing")
-    elif mean_quality >= 30:
+    elif mean_quality >= thresholds['mean_umi_quality_excellent']:
         recommendations.append("✅ <strong>Excellent UMI quality</strong>: Sequencing quality is optimal")
     
     if not recommendations:
@@ -995,35 +1423,264 @@ def generate_recommendations(metrics: Dict) -> str:
     return html
 
 
+def load_sample_metrics(pre_dedup_txt: str = None, pre_dedup_json: str = None,
+                        post_dedup_json: str = None) -> tuple:
+    """
+    Load the pre- and post-deduplication metrics for one sample.
+    
+    Returns:
+        tuple: (pre_dedup_metrics, post_dedup_metrics)
+    """
+    # Load pre-dedup metrics if provided
+    pre_dedup_metrics = {}
+    pre_json_metrics, pre_is_record = read_metrics_document(pre_dedup_json) if pre_dedup_json else ({}, False)
+    if pre_is_record:
+        # Versioned metrics record: skip the text summary entirely
+        pre_dedup_metrics = pre_json_metrics
+        print(f"Loaded pre-dedup metrics record: {pre_dedup_json}", file=sys.stderr)
+    elif pre_dedup_txt:
+        pre_dedup_metrics = parse_pre_dedup_txt(pre_dedup_txt)
+        print(f"Loaded pre-dedup metrics from text file: {pre_dedup_txt}", file=sys.stderr)
+        
+        # Optionally load JSON for additional plot data
+        if pre_dedup_json:
+            # Merge plot_data if available
+            if 'plot_data' in pre_json_metrics:
+                pre_dedup_metrics['plot_data'] = pre_json_metrics['plot_data']
+            print(f"Loaded additional plot data from JSON: {pre_dedup_json}", file=sys.stderr)
+    elif pre_dedup_json:
+        # Fallback to JSON only
+        pre_dedup_metrics = pre_json_metrics
+        print(f"Loaded pre-dedup metrics from JSON: {pre_dedup_json}", file=sys.stderr)
+    
+    # Load post-dedup metrics
+    post_dedup_metrics = load_metrics(post_dedup_json)
+    print(f"Loaded post-dedup metrics from {post_dedup_json}", file=sys.stderr)
+    
+    return pre_dedup_metrics, post_dedup_metrics
+
+
+def parse_manifest(manifest_file: str) -> List[Dict[str, str]]:
+    """
+    Parse a batch manifest TSV into one job per sample.
+    
+    Relative paths are resolved against the manifest's directory. An empty
+    output column defaults to <sample>.umi_qc_report.html next to the manifest.
+    
+    Args:
+        manifest_file: Path to TSV with a header naming MANIFEST_COLUMNS
+        
+    Returns:
+        list: Job dicts keyed by MANIFEST_COLUMNS, in manifest order
+    """
+    base_dir = Path(manifest_file).parent
+    jobs = []
+    
+    with open(manifest_file, 'r', newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        missing = [col for col in ('sample', 'post_dedup_json') if col not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"Manifest {manifest_file} is missing column(s): {', '.join(missing)}")
+        
+        for row in reader:
+            job = {col: (row.get(col) or '').strip() for col in MANIFEST_COLUMNS}
+            if not job['sample']:
+                continue
+            if not job['output']:
+                job['output'] = f"{job['sample']}.umi_qc_report.html"
+            for col in MANIFEST_COLUMNS[1:]:
+                if job[col] and not os.path.isabs(job[col]):
+                    job[col] = str(base_dir / job[col])
+            jobs.append(job)
+    
+    samples = [job['sample'] for job in jobs]
+    duplicates = sorted({sample for sample in samples if samples.count(sample) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate sample(s) in manifest: {', '.join(duplicates)}")
+    
+    return jobs
+
+
+def render_sample_report(job: Dict[str, str], plotlyjs: str = 'cdn', cache_dir: str = None) -> Dict[str, Any]:
+    """
+    Render one manifest entry and return its summary metrics for the cohort view.
+    
+    Top-level so it can run in a worker process.
+    """
+    pre_dedup_metrics, post_dedup_metrics = load_sample_metrics(
+        job['pre_dedup_txt'], job['pre_dedup_json'], job['post_dedup_json']
+    )
+    generate_html_report(pre_dedup_metrics, post_dedup_metrics, job['sample'], job['output'], plotlyjs, cache_dir)
+    
+    return {
+        'sample': job['sample'],
+        'output': job['output'],
+        'pre_dedup': {key: value for key, value in pre_dedup_metrics.items()
+                      if isinstance(value, (int, float)) and not isinstance(value, bool)},
+        'post_dedup': {key: value for key, value in post_dedup_metrics.items()
+                       if isinstance(value, (int, float)) and not isinstance(value, bool)}
+    }
+
+
+# Metrics compared across samples in the cohort dashboard: (source, key, label, format)
+COHORT_METRICS = [
+    ('pre_dedup', 'total_reads', 'Total Reads', '{:,.0f}'),
+    ('pre_dedup', 'unique_umis', 'Unique UMIs', '{:,.0f}'),
+    ('pre_dedup', 'diversity_ratio', 'Diversity Ratio', '{:.3f}'),
+    ('pre_dedup', 'observed_collision_rate', 'Collision Rate', '{:.4f}'),
+    ('pre_dedup', 'singleton_rate', 'Singleton Rate', '{:.3f}'),
+    ('pre_dedup', 'mean_umi_quality', 'Mean UMI Quality', '{:.1f}'),
+    ('post_dedup', 'deduplicated_reads', 'Deduplicated Reads', '{:,.0f}'),
+    ('post_dedup', 'deduplication_rate_pct', 'Deduplication Rate (%)', '{:.2f}'),
+    ('post_dedup', 'avg_family_size', 'Mean Family Size', '{:.2f}'),
+]
+
+
+def generate_cohort_dashboard(summaries: List[Dict[str, Any]], output_file: str, plotlyjs: str = 'cdn'):
+    """
+    Generate a single HTML dashboard comparing key UMI metrics across samples.
+    
+    Args:
+        summaries: Per-sample results from render_sample_report
+        output_file: Output HTML file path
+        plotlyjs: How the page loads plotly.js (one of PLOTLYJS_MODES)
+    """
+    samples = [summary['sample'] for summary in summaries]
+    shown = [(source, key, label, fmt) for source, key, label, fmt in COHORT_METRICS
+             if any(key in summary[source] for summary in summaries)]
+    
+    # Summary table, linking each sample to its own report
+    output_dir = Path(output_file).resolve().parent
+    rows = ''
+    for summary in summaries:
+        link = os.path.relpath(Path(summary['output']).resolve(), output_dir)
+        cells = ''
+        for source, key, label, fmt in shown:
+            value = summary[source].get(key)
+            cells += f'<td>{fmt.format(value) if value is not None else "N/A"}</td>'
+        rows += f'<tr><td><a href="{link}">{summary["sample"]}</a></td>{cells}</tr>'
+    header = ''.join(f'<th>{label}</th>' for _, _, label, _ in shown)
+    table = f'<table class="cohort-table"><tr><th>Sample</th>{header}</tr>{rows}</table>'
+    
+    # One bar chart per metric, all samples side by side
+    plots_html = ''
+    for source, key, label, fmt in shown:
+        values = [summary[source].get(key) for summary in summaries]
+        colors = [get_status_color(key.replace('observed_', ''), value) if value is not None else '#9ca3af' for value in values]
+        fig = go.Figure(data=[go.Bar(x=samples, y=values, marker_color=colors,
+                                     hovertemplate='<b>%{x}</b><br>' + label + ': %{y}<extra></extra>')])
+        fig.update_layout(
+            title=label,
+            xaxis_title='Sample',
+            yaxis_title=label,
+            template='plotly_white',
+            height=350
+        )
+        plots_html += f'<div class="plot-container">{figure_div(fig, f"cohort_{key}")}</div>'
+    
+    content = f'''<div class="section">
+                <h2>📋 Sample Summary</h2>
+                {table}
+            </div>
+            
+            <div class="section">
+                <h2>📊 Metric Comparison</h2>
+                {plots_html}
+            </div>'''
+    html = render_page("UMI QC Cohort Dashboard", "🧬 UMI QC Cohort Dashboard", f"Samples: {len(summaries)}", content,
+                       plotlyjs_tag(plotlyjs, output_file))
+    
+    with open(output_file, 'w') as f:
+        f.write(html)
+    
+    print(f"Cohort dashboard generated: {output_file}", file=sys.stderr)
+
+
+def run_batch(manifest_file: str, jobs: int = 1, cohort_output: str = None, plotlyjs: str = 'cdn',
+              cache_dir: str = None, thresholds_file: str = None) -> int:
+    """
+    Render every sample in a manifest from a single interpreter.
+    
+    plotly and numpy are imported once; with jobs > 1 the reports are rendered
+    by a pool of worker processes, which inherit the already imported modules.
+    In 'directory' mode every report written to the same directory shares one
+    plotly.min.js, written before the workers start.
+    
+    Returns:
+        int: Number of samples that failed
+    """
+    manifest = parse_manifest(manifest_file)
+    print(f"Batch mode: {len(manifest)} sample(s) from {manifest_file}", file=sys.stderr)
+    
+    if plotlyjs == 'directory':
+        output_dirs = {os.path.dirname(job['output']) for job in manifest}
+        if cohort_output:
+            output_dirs.add(os.path.dirname(cohort_output))
+        for directory in sorted(output_dirs):
+            write_plotlyjs_bundle(directory)
+    
+    umi_perf.count('reports', len(manifest))
+    umi_perf.mark('render_reports')
+    summaries = []
+    failed = 0
+    if jobs > 1 and len(manifest) > 1:
+        # Workers load the same threshold overrides as this process
+        initializer, initargs = (load_thresholds, (thresholds_file,)) if thresholds_file else (None, ())
+        with ProcessPoolExecutor(max_workers=min(jobs, len(manifest)),
+                                 initializer=initializer, initargs=initargs) as executor:
+            futures = [executor.submit(render_sample_report, job, plotlyjs, cache_dir) for job in manifest]
+            for job, future in zip(manifest, futures):
+                try:
+                    summaries.append(future.result())
+                except Exception as e:
+                    print(f"ERROR: {job['sample']}: {e}", file=sys.stderr)
+                    failed += 1
+    else:
+        for job in manifest:
+            try:
+                summaries.append(render_sample_report(job, plotlyjs, cache_dir))
+            except Exception as e:
+                print(f"ERROR: {job['sample']}: {e}", file=sys.stderr)
+                failed += 1
+    
+    umi_perf.mark(None)
+    
+    if cohort_output and summaries:
+        with umi_perf.stage('cohort_dashboard'):
+            generate_cohort_dashboard(summaries, cohort_output, plotlyjs)
+    
+    return failed
+
+
 def main():
     """Main entry point."""
     args = parse_args()
+    umi_perf.start_from_args('generate_umi_report_plotly', args, args.sample)
     
     try:
-        # Load pre-dedup metrics if provided
-        pre_dedup_metrics = {}
-        if args.pre_dedup_txt:
-            pre_dedup_metrics = parse_pre_dedup_txt(args.pre_dedup_txt)
-            print(f"Loaded pre-dedup metrics from text file: {args.pre_dedup_txt}", file=sys.stderr)
-            
-            # Optionally load JSON for additional plot data
-            if args.pre_dedup_json:
-                json_data = load_metrics(args.pre_dedup_json)
-                # Merge plot_data if available
-                if 'plot_data' in json_data:
-                    pre_dedup_metrics['plot_data'] = json_data['plot_data']
-                print(f"Loaded additional plot data from JSON: {args.pre_dedup_json}", file=sys.stderr)
-        elif args.pre_dedup_json:
-            # Fallback to JSON only
-            pre_dedup_metrics = load_metrics(args.pre_dedup_json)
-            print(f"Loaded pre-dedup metrics from JSON: {args.pre_dedup_json}", file=sys.stderr)
-        
-        # Load post-dedup metrics
-        post_dedup_metrics = load_metrics(args.post_dedup_json)
-        print(f"Loaded post-dedup metrics from {args.post_dedup_json}", file=sys.stderr)
+        if args.thresholds:
+            load_thresholds(args.thresholds)
+        
+        if args.manifest:
+            failed = run_batch(args.manifest, args.jobs, args.cohort_output, args.plotlyjs,
+                               args.cache_dir, args.thresholds)
+            umi_perf.finish()
+            return 1 if failed else 0
+        
+        with umi_perf.stage('load'):
+            pre_dedup_metrics, post_dedup_metrics = load_sample_metrics(
+                args.pre_dedup_txt, args.pre_dedup_json, args.post_dedup_json
+            )
         
         # Generate report
-        generate_html_report(pre_dedup_metrics, post_dedup_metrics, args.sample, args.output)
+        with umi_perf.stage('render'):
+            generate_html_report(pre_dedup_metrics, post_dedup_metrics, args.sample, args.output, args.plotlyjs,
+                                 args.cache_dir)
+        if args.cache_dir:
+            umi_perf.count('sections_from_cache', SECTION_CACHE_STATS['hit'])
+            umi_perf.count('sections_rendered', SECTION_CACHE_STATS['rendered'])
+        umi_perf.count_bytes('output_bytes', args.output)
+        umi_perf.finish()
         
         return 0
         
@@ -0,0 +1,12 @@
+"""
+umi_amplicon: the pipeline's Python tools behind one command line entry point.
+
+The scripts in bin/ remain the implementation and stay runnable on their
+own (the Nextflow modules call them by name); `umi-amplicon <command>` maps
+a subcommand onto a script's main() and imports only that script. Heavy
+dependencies (matplotlib/seaborn, Biopython, plotly subplots) are imported
+inside the functions that use them, so a command only pays for what its
+code path needs.
+"""
+
+__version__ = '1.0.0'
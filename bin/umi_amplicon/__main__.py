@@ -0,0 +1,7 @@
+"""python -m umi_amplicon <command> [args]"""
+
+import sys
+
+from umi_amplicon.cli import main
+
+sys.exit(main())
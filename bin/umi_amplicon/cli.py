@@ -0,0 +1,75 @@
+"""
+`umi-amplicon <command> [args]`: dispatch subcommands to the bin/ scripts.
+
+A command's script is imported when the command runs, never at startup, so
+`umi-amplicon metrics` does not import plotly and `umi-amplicon report` does
+not import pysam.
+"""
+
+import importlib
+import os
+import sys
+
+from umi_amplicon import __version__
+
+PROG = 'umi-amplicon'
+
+# The scripts live next to the package
+BIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# command -> (script module, help)
+COMMANDS = {
+    'metrics': ('calculate_umi_metrics', 'Pre-dedup UMI QC metrics, chunk states and state merging'),
+    'dedup-metrics': ('calculate_dedup_metrics', 'Post-dedup UMI QC metrics from umi_tools dedup outputs'),
+    'extract-quality': ('extract_umi_with_quality', 'UMI-only FASTQ with UMI base qualities'),
+    'gate': ('umi_qc_gate', 'Early pass/fail UMI QC gate on the first reads of a sample'),
+    'consensus': ('build_umi_consensus', 'Consensus sequences (and placed BAM) per UMI family'),
+    'molecules': ('count_umi_molecules', 'Reads and UMI molecules per reference from a grouped BAM'),
+    'coverage': ('calculate_library_coverage', 'Library coverage, uniformity and dropout metrics'),
+    'report': ('generate_umi_report_plotly', 'Interactive UMI QC HTML report(s)'),
+    'cohort': ('aggregate_umi_cohort', 'Cohort UMI QC tables and dashboard'),
+    'worker': ('umi_worker', 'Warm worker for the Python steps'),
+}
+
+
+def usage():
+    """Top-level help text"""
+    width = max(len(name) for name in COMMANDS)
+    lines = [f'usage: {PROG} <command> [args]', '', 'commands:']
+    lines += [f'  {name:<{width}}  {help_text}' for name, (_, help_text) in COMMANDS.items()]
+    lines += ['', f"Run '{PROG} <command> --help' for the arguments of a command."]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Run a subcommand
+    
+    Args:
+        argv: Arguments after the program name (default: sys.argv[1:])
+    
+    Returns:
+        int: Exit code
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv:
+        print(usage(), file=sys.stderr)
+        return 2
+    if argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0
+    if argv[0] == '--version':
+        print(f'{PROG} {__version__}')
+        return 0
+    
+    command = argv[0]
+    if command not in COMMANDS:
+        print(f"{PROG}: unknown command '{command}'\n\n{usage()}", file=sys.stderr)
+        return 2
+    
+    if BIN_DIR not in sys.path:
+        sys.path.insert(0, BIN_DIR)
+    module = importlib.import_module(COMMANDS[command][0])
+    # argparse in the script reports itself as 'umi-amplicon <command>'
+    sys.argv = [f'{PROG} {command}'] + argv[1:]
+    return module.main() or 0
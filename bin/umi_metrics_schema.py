@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Versioned UMI QC metrics schema shared by the metrics producers, the HTML
+report and the MultiQC exports.
+
+Each producer builds one record (ExtractMetrics before deduplication,
+DedupMetrics after it) and writes it once with write_metrics(). Consumers
+read it back with load_metrics() - a single JSON (or msgpack) decode, no
+parsing of the human-readable text summaries. MultiQC custom-content JSON
+is derived from the same record with to_multiqc().
+"""
+
+import json
+import sys
+from dataclasses import dataclass, field, fields, asdict
+from typing import ClassVar, Dict, List, Optional
+
+SCHEMA_NAME = 'umi_amplicon.metrics'
+SCHEMA_VERSION = 1
+
+
+@dataclass
+class PositionQuality:
+    """Phred quality summary for one UMI base position (1-indexed)."""
+    position: int
+    mean_quality: float
+    min_quality: float
+    max_quality: float
+
+
+@dataclass
+class ExtractMetrics:
+    """UMI metrics after umi_tools extract (before deduplication)."""
+    KIND: ClassVar[str] = 'extract'
+    MULTIQC_ID: ClassVar[str] = 'umi_qc_{sample}'
+    MULTIQC_NAMESPACE: ClassVar[str] = 'UMI QC Metrics'
+    PLOT_FIELDS: ClassVar[tuple] = ('family_size_distribution', 'top_umis', 'umi_rarefaction', 'umi_saturation',
+                                    'neighbour_abundance_ratio')
+    
+    sample: str
+    
+    # UMI extraction statistics (from the umi_tools extract log)
+    extract_input_reads: Optional[int] = None
+    extract_output_reads: Optional[int] = None
+    extract_pass_rate: Optional[float] = None
+    quality_filtered_reads: int = 0
+    quality_filter_rate: float = 0.0
+    
+    # Extraction statistics
+    total_reads: int = 0
+    total_umis: int = 0
+    unique_umis: int = 0
+    umi_length: int = 0
+    
+    # UMI diversity
+    diversity_ratio: float = 0.0
+    shannon_entropy: float = 0.0
+    complexity_score: float = 0.0
+    
+    # UMI collision analysis (birthday problem)
+    expected_num_unique_umis: float = 0.0
+    expected_num_colliding_pairs: float = 0.0
+    expected_fraction_molecules_colliding: float = 0.0
+    prob_at_least_one_umi_collision: float = 0.0
+    expected_duplicate_rate: float = 0.0
+    observed_collision_rate: float = 0.0
+    
+    # Family size statistics
+    mean_family_size: float = 0.0
+    median_family_size: float = 0.0
+    min_family_size: int = 0
+    max_family_size: int = 0
+    amplification_ratio: float = 0.0
+    
+    # Singleton analysis
+    singleton_count: int = 0
+    singleton_rate: float = 0.0
+    
+    # Saturation (analytic rarefaction of the family-size histogram)
+    umi_discovery_rate: float = 0.0
+    
+    # Hamming-1 neighbours (UMIs one mismatch from a more abundant UMI);
+    # None when the census was not computed (UMI counts spilled to disk)
+    neighbour_census_computed: Optional[bool] = None
+    neighbour_checked_umis: Optional[int] = None
+    hamming1_neighbour_umis: Optional[int] = None
+    abundant_neighbour_umis: Optional[int] = None
+    abundant_neighbour_rate: Optional[float] = None
+    directional_neighbour_umis: Optional[int] = None
+    directional_neighbour_rate: Optional[float] = None
+    directional_neighbour_read_fraction: Optional[float] = None
+    
+    # Quality metrics
+    mean_umi_quality: float = 0.0
+    min_umi_quality: float = 0.0
+    max_umi_quality: float = 0.0
+    per_position_quality: List[PositionQuality] = field(default_factory=list)
+    
+    # Performance metrics
+    success_rate: float = 0.0
+    
+    # Plot data
+    family_size_distribution: Dict[str, int] = field(default_factory=dict)
+    top_umis: Dict[str, int] = field(default_factory=dict)
+    umi_rarefaction: Dict[str, float] = field(default_factory=dict)  # subsampled reads -> expected unique UMIs
+    umi_saturation: Dict[str, float] = field(default_factory=dict)  # subsampled reads -> sequencing saturation
+    neighbour_abundance_ratio: Dict[str, int] = field(default_factory=dict)  # neighbour/own reads bin -> UMIs
+
+
+@dataclass
+class DedupMetrics:
+    """UMI metrics after umi_tools dedup."""
+    KIND: ClassVar[str] = 'dedup'
+    MULTIQC_ID: ClassVar[str] = '{sample}'
+    MULTIQC_NAMESPACE: ClassVar[str] = 'UMI Deduplication'
+    PLOT_FIELDS: ClassVar[tuple] = ('family_size_distribution', 'edit_distance_distribution')
+    
+    sample: str
+    
+    # Deduplication summary
+    total_reads: int = 0
+    deduplicated_reads: int = 0
+    duplicates_removed: int = 0
+    deduplication_rate_pct: float = 0.0
+    duplication_rate: float = 0.0
+    
+    # UMI family statistics
+    unique_umi_families: int = 0
+    avg_family_size: float = 0.0
+    median_family_size: float = 0.0
+    stdev_family_size: float = 0.0
+    min_family_size: int = 0
+    max_family_size: int = 0
+    singleton_families: int = 0
+    singleton_family_rate_pct: float = 0.0
+    
+    # UMI error correction & clustering
+    total_umi_pairs_compared: int = 0
+    mean_edit_distance: float = 0.0
+    median_edit_distance: float = 0.0
+    max_edit_distance: int = 0
+    umi_pairs_clustered: int = 0
+    error_correction_rate_pct: float = 0.0
+    
+    # Plot data
+    family_size_distribution: Dict[str, int] = field(default_factory=dict)
+    edit_distance_distribution: Dict[str, int] = field(default_factory=dict)
+
+
+RECORD_TYPES = {cls.KIND: cls for cls in (ExtractMetrics, DedupMetrics)}
+
+
+def from_metrics(cls, sample: str, metrics: Dict, **extra):
+    """
+    Build a record from a producer's metrics dict, ignoring keys outside the schema.
+    
+    Args:
+        cls: ExtractMetrics or DedupMetrics
+        sample: Sample name
+        metrics: Flat metrics dict (e.g. from calculate_metrics)
+        **extra: Additional field values (plot data), overriding metrics
+    
+    Returns:
+        Record instance
+    """
+    values = {**metrics, **extra}
+    names = {f.name for f in fields(cls)} - {'sample'}
+    kwargs = {name: values[name] for name in names if values.get(name) is not None}
+    
+    # Plot data is keyed by strings, as it is once serialised
+    for name in cls.PLOT_FIELDS:
+        if name in kwargs:
+            kwargs[name] = {str(key): value for key, value in kwargs[name].items()}
+    if 'per_position_quality' in kwargs:
+        kwargs['per_position_quality'] = [
+            pos if isinstance(pos, PositionQuality) else PositionQuality(**pos)
+            for pos in kwargs['per_position_quality']
+        ]
+    
+    return cls(sample=sample, **kwargs)
+
+
+def to_dict(record) -> Dict:
+    """Serialisable dict for a record, tagged with the schema name, version and kind."""
+    return {'schema': SCHEMA_NAME, 'schema_version': SCHEMA_VERSION, 'kind': record.KIND, **asdict(record)}
+
+
+def from_dict(data: Dict):
+    """
+    Rebuild a record from to_dict() output.
+    
+    Raises:
+        ValueError: If the document is not a metrics record or its schema
+                    version is newer than this module understands
+    """
+    if data.get('schema') != SCHEMA_NAME:
+        raise ValueError(f"Not a {SCHEMA_NAME} document")
+    if data.get('schema_version', 0) > SCHEMA_VERSION:
+        raise ValueError(f"Metrics schema version {data['schema_version']} is newer than supported "
+                         f"version {SCHEMA_VERSION}")
+    
+    cls = RECORD_TYPES.get(data.get('kind'))
+    if cls is None:
+        raise ValueError(f"Unknown metrics kind: {data.get('kind')}")
+    
+    # Fields added in later versions are ignored; missing ones take defaults
+    return from_metrics(cls, data['sample'], {key: value for key, value in data.items() if key != 'sample'})
+
+
+def is_metrics_document(data) -> bool:
+    """True if a decoded JSON document is a metrics schema record."""
+    return isinstance(data, dict) and data.get('schema') == SCHEMA_NAME
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError("msgpack is required to read or write .msgpack metrics files "
+                          "(use a .json file name instead)")
+    return msgpack
+
+
+def write_metrics(record, output_file: str):
+    """
+    Write a record as compact JSON, or msgpack if the file name ends in .msgpack.
+    """
+    data = to_dict(record)
+    if str(output_file).endswith('.msgpack'):
+        with open(output_file, 'wb') as f:
+            f.write(_msgpack().packb(data, use_bin_type=True))
+    else:
+        with open(output_file, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+    
+    print(f"Metrics record written: {output_file} ({record.KIND}, schema v{SCHEMA_VERSION})", file=sys.stderr)
+
+
+def load_metrics(metrics_file: str):
+    """Load a record written by write_metrics()."""
+    if str(metrics_file).endswith('.msgpack'):
+        with open(metrics_file, 'rb') as f:
+            return from_dict(_msgpack().unpackb(f.read(), raw=False))
+    with open(metrics_file, 'r') as f:
+        return from_dict(json.load(f))
+
+
+def scalar_metrics(record) -> Dict:
+    """Scalar fields of a record (the MultiQC general stats columns); unset (None) fields are left out."""
+    return {f.name: getattr(record, f.name) for f in fields(record)
+            if f.name != 'sample' and isinstance(getattr(record, f.name), (int, float))}
+
+
+def to_multiqc(record) -> Dict:
+    """
+    MultiQC custom-content JSON for a record.
+    
+    Matches the layout of the *_multiqc.json files written before the schema
+    existed: general stats under 'data', distributions under 'plot_data'.
+    """
+    plot_data = {name: {record.sample: getattr(record, name)} for name in record.PLOT_FIELDS}
+    if getattr(record, 'per_position_quality', None):
+        plot_data['umi_quality_by_position'] = {
+            record.sample: {str(pos.position): pos.mean_quality for pos in record.per_position_quality}
+        }
+    
+    return {
+        'id': record.MULTIQC_ID.format(sample=record.sample),
+        'plot_type': 'generalstats',
+        'pconfig': {
+            'namespace': record.MULTIQC_NAMESPACE
+        },
+        'data': {
+            record.sample: scalar_metrics(record)
+        },
+        'plot_data': plot_data
+    }
+
+
+def to_report_metrics(record) -> Dict:
+    """
+    Flat metrics dict in the shape the HTML report works with.
+    
+    Scalars and per-position quality at the top level, distributions under
+    plot_data keyed by sample, as if loaded from the MultiQC JSON.
+    """
+    metrics = scalar_metrics(record)
+    if hasattr(record, 'per_position_quality'):
+        metrics['per_position_quality'] = [asdict(pos) for pos in record.per_position_quality]
+    metrics['plot_data'] = to_multiqc(record)['plot_data']
+    return metrics
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Stage timing, counters and optional profiling shared by the bin/ scripts.
+
+A script calls start() once, wraps its parse/compute/write phases in
+stage() blocks, bumps counters with count() and calls finish() at the end.
+finish() writes a *.perf.json file - a MultiQC custom-content table row with
+wall and CPU time per stage, counters and peak RSS - so task cost can be
+tracked across runs and process labels sized from data.
+
+Profiling (cProfile or pyinstrument) is enabled with --profile or the
+UMI_PERF_PROFILE environment variable; the dump is written next to the
+perf JSON (*.prof for cProfile, *.pyinstrument.html for pyinstrument).
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+PROFILE_ENV = 'UMI_PERF_PROFILE'
+PROFILERS = ('cprofile', 'pyinstrument')
+
+MULTIQC_ID = 'umi_perf'
+MULTIQC_SECTION = 'Script Performance'
+
+
+class PerfRecorder:
+    """Accumulates stage timings and counters for one script run."""
+
+    def __init__(self, script, sample=None, output=None, profiler=None):
+        self.script = script
+        self.sample = sample
+        self.output = output
+        self.profiler = profiler
+        self.stages = {}
+        self.counters = {}
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self._current = None
+        self._profile = None
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block; repeated stages with the same name accumulate."""
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def mark(self, name):
+        """
+        Close the running mark() stage (if any) and start a new one.
+    
+        For long linear scripts where wrapping each phase in stage() would
+        mean re-indenting it; the last mark is closed by finish().
+        """
+        now = time.perf_counter()
+        if self._current:
+            previous, started = self._current
+            self.stages[previous] = self.stages.get(previous, 0.0) + now - started
+        self._current = (name, now) if name else None
+
+    def count(self, name, value=1):
+        """Add to a counter (reads, records, bytes, ...)."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def count_bytes(self, name, *paths):
+        """Add the on-disk size of files to a byte counter; missing files are skipped."""
+        for path in paths:
+            if path and os.path.isfile(path):
+                self.count(name, os.path.getsize(path))
+
+    def start_profile(self):
+        """Start the configured profiler, if any."""
+        if self.profiler == 'cprofile':
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        elif self.profiler == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise ImportError("pyinstrument is required for --profile pyinstrument "
+                                  "(use --profile cprofile instead)")
+            self._profile = Profiler()
+            self._profile.start()
+
+    def _stop_profile(self):
+        if self._profile is None:
+            return None
+        stem = _output_stem(self.output or f"{self.script}.perf.json")
+        if self.profiler == 'cprofile':
+            self._profile.disable()
+            dump = f"{stem}.prof"
+            self._profile.dump_stats(dump)
+        else:
+            self._profile.stop()
+            dump = f"{stem}.pyinstrument.html"
+            with open(dump, 'w') as f:
+                f.write(self._profile.output_html())
+        self._profile = None
+        return dump
+
+    def summary(self):
+        """Flat dict of everything recorded so far (one MultiQC table row)."""
+        row = {
+            'script': self.script,
+            'wall_seconds': round(time.perf_counter() - self._started, 4),
+            'cpu_seconds': round(time.process_time() - self._cpu_started, 4),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        children_rss = peak_rss_mb(children=True)
+        if children_rss:
+            row['peak_children_rss_mb'] = round(children_rss, 1)
+        for name, seconds in self.stages.items():
+            row[f'{name}_seconds'] = round(seconds, 4)
+        row.update(self.counters)
+        return row
+
+    def finish(self):
+        """Stop profiling and write the perf JSON (if an output was given)."""
+        self.mark(None)
+        dump = self._stop_profile()
+        if dump:
+            print(f"Profile written: {dump}", file=sys.stderr)
+        if not self.output:
+            return None
+    
+        row = self.summary()
+        name = f"{self.sample}.{self.script}" if self.sample else self.script
+        data = {
+            'id': MULTIQC_ID,
+            'section_name': MULTIQC_SECTION,
+            'plot_type': 'table',
+            'pconfig': {
+                'id': f'{MULTIQC_ID}_table',
+                'title': 'Script performance'
+            },
+            'data': {
+                name: row
+            }
+        }
+        with open(self.output, 'w') as f:
+            json.dump(data, f, indent=2)
+    
+        print(f"Performance summary written: {self.output} ({row['wall_seconds']:.2f}s, "
+              f"peak RSS {row['peak_rss_mb']:.0f} MB)", file=sys.stderr)
+        return row
+
+
+def _output_stem(path):
+    path = str(path)
+    for suffix in ('.perf.json', '.json'):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def peak_rss_mb(children=False):
+    """Peak resident set size of this process (or its reaped children) in MB."""
+    if not children:
+        # VmHWM covers this program only; ru_maxrss also counts the parent's
+        # memory at fork time, which inflates it for spawned interpreters
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return usage.ru_maxrss / scale
+
+
+def add_perf_arguments(parser):
+    """Add --perf-json and --profile to a script's argument parser."""
+    parser.add_argument('--perf-json', help='Write stage timings, counters and peak RSS to this *.perf.json file')
+    parser.add_argument('--profile', choices=PROFILERS, default=None,
+                        help=f'Profile the run with cProfile or pyinstrument (default: ${PROFILE_ENV} or off)')
+    return parser
+
+
+# The recorder of the running script; stage()/count() below report to it
+_RECORDER = PerfRecorder('python')
+
+
+def start(script, sample=None, output=None, profiler=None):
+    """
+    Start recording for a script run.
+    
+    Args:
+        script: Script name used in the perf table
+        sample: Sample name (prefixed to the table row name)
+        output: Path of the *.perf.json file, or None to skip writing it
+        profiler: 'cprofile', 'pyinstrument' or None (falls back to $UMI_PERF_PROFILE)
+    
+    Returns:
+        PerfRecorder: The active recorder
+    """
+    global _RECORDER
+    profiler = profiler or os.environ.get(PROFILE_ENV) or None
+    if profiler and profiler not in PROFILERS:
+        print(f"WARNING: Unknown profiler '{profiler}' in ${PROFILE_ENV}, profiling disabled", file=sys.stderr)
+        profiler = None
+    _RECORDER = PerfRecorder(script, sample, output, profiler)
+    _RECORDER.start_profile()
+    return _RECORDER
+
+
+def start_from_args(script, args, sample=None):
+    """start() with the --perf-json/--profile values of parsed arguments."""
+    return start(script, sample, getattr(args, 'perf_json', None), getattr(args, 'profile', None))
+
+
+def stage(name):
+    """Time a block against the active recorder."""
+    return _RECORDER.stage(name)
+
+
+def mark(name):
+    """Start a sequential stage on the active recorder."""
+    _RECORDER.mark(name)
+
+
+def count(name, value=1):
+    """Add to a counter of the active recorder."""
+    _RECORDER.count(name, value)
+
+
+def count_bytes(name, *paths):
+    """Add file sizes to a byte counter of the active recorder."""
+    _RECORDER.count_bytes(name, *paths)
+
+
+def finish():
+    """Write the active recorder's perf JSON."""
+    return _RECORDER.finish()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Early UMI QC gate: decide from the first reads of a sample whether its UMI
+library is usable before extraction, trimming, alignment, grouping and
+deduplication run on all of it.
+
+The thresholds are the ones the pre-dedup UMI QC report warns about:
+- mean UMI quality >= --quality-threshold
+- unique UMIs (molecules) >= --diversity-threshold
+- expected random-collision duplicate rate <= --collision-threshold
+
+Reads are streamed from the start of R1 and the metrics re-evaluated every
+--check-every reads with confidence bounds: a normal interval for the mean
+quality and the log-normal Chao1 interval for the number of distinct UMIs in
+the whole library (which also bounds the collision rate). The gate stops as
+soon as every metric is decided either way, or any metric fails; metrics
+still undecided after --max-reads (or at the end of the file) pass, so only
+clearly broken libraries are stopped.
+
+The status ('pass' or 'fail') is printed to stdout; details go to the JSON.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import sys
+from collections import Counter
+
+import umi_perf
+from calculate_umi_metrics import expected_duplicate_rate
+
+PASS = 'pass'
+FAIL = 'fail'
+UNDECIDED = 'undecided'
+
+MULTIQC_ID = 'umi_gate'
+MULTIQC_SECTION = 'UMI QC Gate'
+
+
+def umi_positions(pattern):
+    """
+    0-based UMI positions of a umi_tools string --bc-pattern
+    
+    N marks UMI bases, C cell barcode bases and X bases kept in the read.
+    Regex patterns are not supported.
+    """
+    if not pattern or set(pattern) - set('NCX'):
+        raise ValueError(f"Only string UMI patterns (N/C/X) are supported by the gate, got '{pattern}'")
+    return [i for i, c in enumerate(pattern) if c == 'N']
+
+
+def chao1_interval(observed, f1, f2, z):
+    """
+    Bias-corrected Chao1 richness estimate with its log-normal interval
+    
+    Args:
+        observed: Distinct UMIs seen
+        f1: UMIs seen exactly once
+        f2: UMIs seen exactly twice
+        z: Normal quantile of the interval
+    
+    Returns:
+        tuple: (estimate, lower, upper)
+    """
+    unseen = f1 * (f1 - 1) / (2 * (f2 + 1))
+    if unseen <= 0:
+        return float(observed), float(observed), float(observed)
+    variance = (f1 * (f1 - 1) / (2 * (f2 + 1))
+                + f1 * (2 * f1 - 1) ** 2 / (4 * (f2 + 1) ** 2)
+                + f1 ** 2 * f2 * (f1 - 1) ** 2 / (4 * (f2 + 1) ** 4))
+    spread = math.exp(z * math.sqrt(math.log(1 + variance / unseen ** 2)))
+    return observed + unseen, observed + unseen / spread, observed + unseen * spread
+
+
+def _decide(lower, upper, threshold, higher_is_better=True):
+    """pass/fail when the whole interval is on one side of the threshold"""
+    if higher_is_better:
+        if lower >= threshold:
+            return PASS
+        if upper < threshold:
+            return FAIL
+    else:
+        if upper <= threshold:
+            return PASS
+        if lower > threshold:
+            return FAIL
+    return UNDECIDED
+
+
+class UmiGate:
+    """Running UMI counts and quality moments with threshold decisions."""
+    
+    def __init__(self, umi_length, quality_threshold, diversity_threshold, collision_threshold, z=3.0):
+        self.umi_length = umi_length
+        self.quality_threshold = quality_threshold
+        self.diversity_threshold = diversity_threshold
+        self.collision_threshold = collision_threshold
+        self.z = z
+        self.umi_counts = Counter()
+        self.reads = 0
+        # Welford running mean/variance of the per-read mean UMI quality
+        self._quality_mean = 0.0
+        self._quality_m2 = 0.0
+    
+    def add(self, umi, mean_quality):
+        """Add one read's UMI and mean UMI base quality."""
+        self.reads += 1
+        self.umi_counts[umi] += 1
+        delta = mean_quality - self._quality_mean
+        self._quality_mean += delta / self.reads
+        self._quality_m2 += delta * (mean_quality - self._quality_mean)
+    
+    def evaluate(self, final=False):
+        """
+        Decide every threshold from the reads seen so far
+    
+        Args:
+            final: The whole file has been read; decide on point estimates
+    
+        Returns:
+            dict: Per-metric estimate, bounds and decision
+        """
+        observed = len(self.umi_counts)
+        frequencies = Counter(self.umi_counts.values())
+        chao1, chao1_lower, chao1_upper = chao1_interval(observed, frequencies[1], frequencies[2], self.z)
+        if final:
+            chao1 = chao1_lower = chao1_upper = float(observed)
+    
+        quality_se = math.sqrt(self._quality_m2 / (self.reads - 1) / self.reads) if self.reads > 1 else float('inf')
+        quality_bounds = (self._quality_mean, self._quality_mean) if final else \
+            (self._quality_mean - self.z * quality_se, self._quality_mean + self.z * quality_se)
+    
+        # At least `observed` UMIs exist, so that is a hard lower bound
+        diversity_lower = max(float(observed), chao1_lower)
+        collision = [expected_duplicate_rate(int(n), self.umi_length)
+                     for n in (chao1, diversity_lower, chao1_upper)]
+    
+        return {
+            'mean_umi_quality': {
+                'estimate': self._quality_mean, 'lower': quality_bounds[0], 'upper': quality_bounds[1],
+                'threshold': self.quality_threshold,
+                'decision': _decide(*quality_bounds, self.quality_threshold)
+            },
+            'unique_umis': {
+                'observed': observed, 'estimate': chao1, 'lower': diversity_lower, 'upper': chao1_upper,
+                'threshold': self.diversity_threshold,
+                'decision': _decide(diversity_lower, chao1_upper, self.diversity_threshold)
+            },
+            'expected_duplicate_rate': {
+                'estimate': collision[0], 'lower': collision[1], 'upper': collision[2],
+                'threshold': self.collision_threshold,
+                'decision': _decide(collision[1], collision[2], self.collision_threshold, higher_is_better=False)
+            }
+        }
+
+
+def _read_umis(fastq_file, positions):
+    """Yield (UMI, mean UMI quality) for each read of a (gzipped) FASTQ file."""
+    opener = gzip.open if fastq_file.endswith('.gz') else open
+    end = max(positions) + 1
+    with opener(fastq_file, 'rt') as f:
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            seq = f.readline().rstrip()
+            f.readline()
+            qual = f.readline().rstrip()
+            if len(seq) < end or len(qual) < end:
+                continue
+            umi = ''.join(seq[i] for i in positions)
+            yield umi, sum(ord(qual[i]) - 33 for i in positions) / len(positions)
+
+
+def run_gate(fastq_file, pattern, quality_threshold, diversity_threshold, collision_threshold,
+             max_reads=1_000_000, check_every=20_000, z=3.0):
+    """
+    Stream reads into a UmiGate until every threshold is decided
+    
+    Returns:
+        dict: Gate result (status, reads examined, per-metric details)
+    """
+    positions = umi_positions(pattern)
+    gate = UmiGate(len(positions), quality_threshold, diversity_threshold, collision_threshold, z)
+    decided = None
+    for umi, mean_quality in _read_umis(fastq_file, positions):
+        gate.add(umi, mean_quality)
+        if gate.reads % check_every == 0:
+            checks = gate.evaluate()
+            decisions = {check['decision'] for check in checks.values()}
+            if FAIL in decisions or decisions == {PASS}:
+                decided = checks
+                break
+        if gate.reads >= max_reads:
+            break
+    
+    end_of_file = decided is None and gate.reads < max_reads
+    checks = decided or gate.evaluate(final=end_of_file)
+    decisions = {check['decision'] for check in checks.values()}
+    return {
+        'status': FAIL if FAIL in decisions else PASS,
+        'reads_examined': gate.reads,
+        'end_of_file': end_of_file,
+        'umi_length': len(positions),
+        'z': z,
+        'checks': checks
+    }
+
+
+def to_multiqc(sample, result):
+    """MultiQC custom-content table row for a gate result."""
+    row = {
+        'status': result['status'],
+        'reads_examined': result['reads_examined']
+    }
+    for name, check in result['checks'].items():
+        row[name] = round(check['estimate'], 4)
+        row[f'{name}_decision'] = check['decision']
+    return {
+        'id': MULTIQC_ID,
+        'section_name': MULTIQC_SECTION,
+        'description': 'UMI thresholds evaluated on the first reads of each sample; failed samples skip alignment and deduplication',
+        'plot_type': 'table',
+        'pconfig': {
+            'id': f'{MULTIQC_ID}_table',
+            'title': 'UMI QC gate'
+        },
+        'data': {
+            sample: row
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Early pass/fail UMI QC gate on the first reads of a sample')
+    parser.add_argument('--fastq', required=True, help='R1 FASTQ before UMI extraction')
+    parser.add_argument('--sample', required=True, help='Sample name')
+    parser.add_argument('--umi-pattern', required=True, help='umi_tools string --bc-pattern (N = UMI base)')
+    parser.add_argument('--quality-threshold', type=float, required=True, help='Minimum mean UMI quality')
+    parser.add_argument('--diversity-threshold', type=float, required=True, help='Minimum unique UMIs')
+    parser.add_argument('--collision-threshold', type=float, required=True,
+                        help='Maximum expected random-collision duplicate rate')
+    parser.add_argument('--max-reads', type=int, default=1_000_000,
+                        help='Stop after this many reads; undecided metrics pass (default: 1000000)')
+    parser.add_argument('--check-every', type=int, default=20_000,
+                        help='Re-evaluate the thresholds every this many reads (default: 20000)')
+    parser.add_argument('--z', type=float, default=3.0,
+                        help='Normal quantile of the confidence bounds (default: 3.0)')
+    parser.add_argument('--output', required=True, help='Output gate result JSON')
+    parser.add_argument('--multiqc', help='Output MultiQC custom-content JSON')
+    umi_perf.add_perf_arguments(parser)
+    
+    args = parser.parse_args()
+    umi_perf.start_from_args('umi_qc_gate', args, args.sample)
+    
+    with umi_perf.stage('gate'):
+        result = run_gate(args.fastq, args.umi_pattern, args.quality_threshold, args.diversity_threshold,
+                          args.collision_threshold, args.max_reads, args.check_every, args.z)
+    result['sample'] = args.sample
+    umi_perf.count('reads', result['reads_examined'])
+    
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+    if args.multiqc:
+        with open(args.multiqc, 'w') as f:
+            json.dump(to_multiqc(args.sample, result), f, indent=2)
+    
+    print(f"UMI QC gate for {args.sample}: {result['status'].upper()} after {result['reads_examined']:,} reads", file=sys.stderr)
+    for name, check in result['checks'].items():
+        print(f"  {name}: {check['estimate']:.4g} [{check['lower']:.4g}, {check['upper']:.4g}] "
+              f"vs {check['threshold']} -> {check['decision']}", file=sys.stderr)
+    umi_perf.finish()
+    
+    # The status is the only stdout output, for the pipeline to branch on
+    print(result['status'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Warm worker for the pipeline's Python steps.
+
+Small tasks (thousands of tiny amplicon samples) spend most of their time
+starting Python and importing numpy, plotly, matplotlib, pysam or Biopython.
+`umi_worker.py serve` imports those once and waits on a UNIX socket; each
+request is run in a fork of the warm process, so it starts with everything
+imported and cannot leak state into the next request.
+
+`umi_worker.py run SCRIPT ARGS...` sends a script run to the worker named by
+--socket or $UMI_WORKER_SOCKET. The client's stdin, stdout and stderr file
+descriptors are passed over the socket (SCM_RIGHTS), so the script reads and
+writes exactly what it would as its own process, in the client's working
+directory and environment, and the client exits with the script's exit
+code. Settings the preloaded libraries read once at import are re-applied
+from the request's environment in the fork: thread limits (OMP_NUM_THREADS,
+OPENBLAS_NUM_THREADS, MKL_NUM_THREADS, BLIS_NUM_THREADS; needs threadpoolctl),
+MPLBACKEND and TMPDIR. Variables read only at interpreter start
+(PYTHONPATH, PYTHONHASHSEED, ...) keep the worker's values. Without a
+reachable worker the client execs the script directly (the per-process
+behaviour).
+"""
+
+import argparse
+import json
+import os
+import runpy
+import shutil
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+SOCKET_ENV = 'UMI_WORKER_SOCKET'
+# Set in the forked request process, so run() does not send it back
+CHILD_ENV = 'UMI_WORKER_CHILD'
+
+# Libraries and pipeline modules imported once by the worker; missing ones are skipped
+# (including the ones the scripts only import on the code paths that need them)
+PRELOAD = (
+    'numpy', 'matplotlib', 'matplotlib.pyplot', 'seaborn', 'plotly', 'plotly.graph_objects', 'plotly.subplots',
+    'plotly.offline', 'pysam', 'Bio.SeqIO', 'Bio.SeqRecord', 'threadpoolctl',
+    'umi_perf', 'umi_metrics_schema', 'calculate_umi_metrics', 'calculate_library_coverage',
+    'generate_umi_report_plotly', 'build_umi_consensus'
+)
+
+
+def preload(modules=PRELOAD):
+    """
+    Import the worker's libraries
+    
+    Returns:
+        tuple: (imported module names, {module: error} for the skipped ones)
+    """
+    # Figures are only ever written to files
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    loaded, skipped = [], {}
+    for name in modules:
+        try:
+            __import__(name)
+            loaded.append(name)
+        except Exception as e:
+            skipped[name] = f'{type(e).__name__}: {e}'
+    return loaded, skipped
+
+
+# Thread-count variables, most specific first, and the threadpoolctl APIs they limit
+THREAD_LIMIT_ENV = (
+    ('OPENBLAS_NUM_THREADS', ('blas',)),
+    ('MKL_NUM_THREADS', ('blas',)),
+    ('BLIS_NUM_THREADS', ('blas',)),
+    ('OMP_NUM_THREADS', ('openmp', 'blas')),
+)
+
+
+def apply_environment():
+    """
+    Re-apply the environment settings the preloaded libraries read at import
+    
+    The BLAS/OpenMP thread pools, the matplotlib backend and the tempfile
+    directory were set up in the worker from its own environment; a forked
+    request would otherwise keep them whatever the task's environment says.
+    Thread limits need threadpoolctl and are left alone without it.
+    """
+    tempfile.tempdir = None
+    
+    backend = os.environ.get('MPLBACKEND')
+    if backend and 'matplotlib' in sys.modules:
+        try:
+            sys.modules['matplotlib'].use(backend)
+        except Exception as e:
+            print(f"WARNING: Could not switch matplotlib backend to {backend} ({e})", file=sys.stderr)
+    
+    limits = {}
+    for variable, apis in THREAD_LIMIT_ENV:
+        value = os.environ.get(variable, '')
+        if value.isdigit() and int(value) > 0:
+            for api in apis:
+                limits.setdefault(api, int(value))
+    if not limits:
+        return
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    for api, threads in limits.items():
+        threadpool_limits(limits=threads, user_api=api)
+
+
+def _exit_code(code):
+    """Process exit status for a SystemExit code"""
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
+
+
+def run_request(request, fds):
+    """
+    Run one script request in this (forked) process
+    
+    Args:
+        request: {'script', 'args', 'cwd', 'env'} from the client
+        fds: The client's stdin, stdout and stderr descriptors
+    
+    Returns:
+        int: Exit code of the script
+    """
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.environ[CHILD_ENV] = '1'
+    apply_environment()
+    
+    script = request['script']
+    sys.argv = [script] + request['args']
+    sys.path[0] = os.path.dirname(script)
+    try:
+        runpy.run_path(script, run_name='__main__')
+        code = 0
+    except SystemExit as e:
+        code = _exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    return code
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    """One connection: a script run (or a ping/stop) in a fork of the worker."""
+    
+    def handle(self):
+        message, fds, _, _ = socket.recv_fds(self.request, 1, 3)
+        with self.request.makefile('rb') as stream:
+            request = json.loads(stream.readline())
+    
+        if request.get('op') == 'ping':
+            self.request.sendall(b'0\n')
+            return
+        if request.get('op') == 'stop':
+            self.request.sendall(b'0\n')
+            os.kill(os.getppid(), signal.SIGTERM)
+            return
+        if len(fds) != 3:
+            self.request.sendall(b'1\n')
+            return
+    
+        # A client killed by Nextflow (timeout, cancelled run) closes the
+        # connection; the script is stopped with it
+        connection = self.request
+        finished = threading.Event()
+        def watch():
+            if not connection.recv(1) and not finished.is_set():
+                os._exit(143)
+        threading.Thread(target=watch, daemon=True).start()
+        
+        code = run_request(request, fds)
+        finished.set()
+        self.request.sendall(f'{code}\n'.encode())
+
+
+class _IdleTimeout(Exception):
+    pass
+
+
+class WorkerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """UNIX-socket server forking one warm process per request."""
+    
+    idle_timeout = None
+    _last_request = 0.0
+    
+    def process_request(self, request, client_address):
+        self._last_request = time.monotonic()
+        super().process_request(request, client_address)
+    
+    def service_actions(self):
+        super().service_actions()
+        idle = time.monotonic() - self._last_request
+        if self.idle_timeout and idle > self.idle_timeout and not self.active_children:
+            raise _IdleTimeout
+
+
+def serve(socket_path, idle_timeout=None):
+    """Preload the libraries and serve requests until stopped"""
+    loaded, skipped = preload()
+    print(f"umi_worker: imported {', '.join(loaded)}", file=sys.stderr)
+    for name, error in skipped.items():
+        print(f"umi_worker: skipped {name} ({error})", file=sys.stderr)
+    
+    if os.path.exists(socket_path):
+        if ping(socket_path):
+            raise SystemExit(f"A worker is already listening on {socket_path}")
+        os.unlink(socket_path)
+    # Only the user running the pipeline may connect
+    previous_umask = os.umask(0o177)
+    try:
+        server = WorkerServer(socket_path, _RequestHandler)
+    finally:
+        os.umask(previous_umask)
+    server.idle_timeout = idle_timeout
+    server._last_request = time.monotonic()
+    
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    print(f"umi_worker: listening on {socket_path} (pid {os.getpid()})", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except _IdleTimeout:
+        print(f"umi_worker: idle for {idle_timeout:g}s", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        print("umi_worker: stopped", file=sys.stderr)
+
+
+def _request(socket_path, request, fds=(0, 1, 2)):
+    """
+    Send a request to a worker and wait for its exit code
+    
+    Returns:
+        int or None: The exit code, or None if no worker is listening
+    """
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_path)
+    except OSError:
+        return None
+    with client:
+        socket.send_fds(client, [b'R'], list(fds))
+        client.sendall(json.dumps(request).encode() + b'\n')
+        with client.makefile('rb') as stream:
+            reply = stream.readline()
+    if not reply:
+        print(f"umi_worker: worker on {socket_path} closed the connection without an exit code", file=sys.stderr)
+        return 1
+    return int(reply)
+
+
+def ping(socket_path):
+    """True if a worker is listening on socket_path"""
+    return _request(socket_path, {'op': 'ping'}, fds=()) == 0
+
+
+def run(script, args, socket_path=None):
+    """Run a script (path or name on PATH) in the worker, else exec it"""
+    path = script if os.path.sep in script else shutil.which(script) or script
+    socket_path = socket_path or os.environ.get(SOCKET_ENV)
+    if socket_path and not os.environ.get(CHILD_ENV):
+        code = _request(socket_path, {
+            'script': os.path.abspath(path),
+            'args': args,
+            'cwd': os.getcwd(),
+            'env': dict(os.environ)
+        })
+        if code is not None:
+            return code
+    # Per-process fallback
+    os.execv(sys.executable, [sys.executable, path] + args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm worker for the pipeline Python steps')
+    parser.add_argument('--socket', default=os.environ.get(SOCKET_ENV),
+                        help=f'Worker UNIX socket (default: ${SOCKET_ENV})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    serve_parser = commands.add_parser('serve', help='Import the libraries once and serve script runs')
+    serve_parser.add_argument('--idle-timeout', type=float,
+                              help='Stop after this many seconds without a request (default: never)')
+    run_parser = commands.add_parser('run', help='Run a script in the worker (directly if none is listening)')
+    run_parser.add_argument('script', help='Script path or name on PATH')
+    run_parser.add_argument('args', nargs=argparse.REMAINDER, help='Script arguments')
+    commands.add_parser('ping', help='Exit 0 if a worker is listening')
+    commands.add_parser('stop', help='Stop the worker')
+    
+    args = parser.parse_args()
+    if args.command == 'run':
+        return run(args.script, args.args, args.socket)
+    if not args.socket:
+        parser.error(f'--socket or ${SOCKET_ENV} is required')
+    if args.command == 'serve':
+        serve(args.socket, args.idle_timeout)
+        return 0
+    if args.command == 'ping':
+        return 0 if ping(args.socket) else 1
+    code = _request(args.socket, {'op': 'stop'}, fds=())
+    if code is None:
+        print(f"No worker listening on {args.socket}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
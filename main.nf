@@ -28,6 +28,7 @@ def helpMessage() {
     Reference options:
         --bwa_index [file]                    Path to BWA index directory (if not provided, will be generated)
         --gtf [file]                          Path to GTF annotation file (required for feature counting)
+        --reference_cache [dir]               Reuse the BWA index, .fai and amplicon BED across runs, keyed by FASTA content
 
     UMI parameters:
         --umi_length [int]                    Length of UMI sequences (default: 12)
@@ -36,11 +37,17 @@ def helpMessage() {
         --umi_quality_filter_threshold [int]  Quality filter threshold for UMI bases (default: 15)
         --umi_collision_rate_threshold [float] Maximum acceptable collision rate (default: 0.1)
         --umi_diversity_threshold [int]       Minimum expected UMI diversity (default: 1000)
+        --umi_gate                            Stop samples that clearly fail the UMI thresholds on their first reads (default: false)
+        --umi_gate_reads [int]                Most reads examined by the UMI QC gate (default: 1000000)
+        --umi_metrics_memory_limit [str]      Memory for counting a sample's UMIs, e.g. '4G'; beyond it counts spill to disk (default: unlimited)
         --max_edit_distance [int]             Maximum edit distance for UMI clustering (default: 1)
         --min_base_quality [int]              Minimum base quality for filtering (default: 20)
 
     Read processing options:
         --merge_pairs                         Merge paired-end reads after trimming (default: false, not recommended for UMI dedup)
+        --fastp_single_pass                   One fastp run after UMI extraction instead of QC + trim rounds (default: false)
+        --fastqc_steps [str]                  FastQC runs: comma-separated 'raw', 'qc', 'trim', or 'none' (default: 'raw,qc,trim')
+        --fused_preprocessing                 Stream UMI extraction, trimming and alignment in one task (default: false)
     
     Other options:
         --help                                Show this help message
@@ -156,6 +163,7 @@ log.info "  Input samplesheet: ${params.input}"
 log.info "  Output directory: ${params.outdir}"
 log.info "  FASTA reference: ${params.fasta}"
 log.info "  GTF annotation: ${params.gtf ?: 'Not provided'}"
+log.info "  Reference cache: ${params.reference_cache ?: 'Not used'}"
 log.info ""
 log.info "UMI parameters:"
 log.info "  UMI length: ${params.umi_length}"
@@ -164,9 +172,14 @@ log.info "  UMI method: ${params.umi_method}"
 log.info "  Quality filter threshold: ${params.umi_quality_filter_threshold}"
 log.info "  Collision rate threshold: ${params.umi_collision_rate_threshold}"
 log.info "  Diversity threshold: ${params.umi_diversity_threshold}"
+log.info "  Early QC gate: ${params.umi_gate ? "on (${params.umi_gate_reads} reads)" : 'off'}"
+log.info "  UMI metrics memory limit: ${params.umi_metrics_memory_limit ?: 'none'}"
 log.info ""
 log.info "Read processing:"
 log.info "  Merge paired reads: ${params.merge_pairs}"
+log.info "  Single-pass fastp: ${params.fastp_single_pass}"
+log.info "  FastQC steps: ${params.fastqc_steps ?: 'none'}"
+log.info "  Fused extract/trim/align: ${params.fused_preprocessing}"
 log.info ""
 
 // Load nf-core modules
@@ -11,6 +11,8 @@ process EXTRACT_UMI_QUALITY {
 
     output:
     tuple val(meta), path("*.umi_only.fastq.gz"), emit: umi_fastq
+    path "*.perf.json"                           , emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
     path "versions.yml"                          , emit: versions
 
     when:
@@ -27,7 +29,8 @@ process EXTRACT_UMI_QUALITY {
         -i ${original_r1} \\
         -e ${extracted_r1} \\
         -o ${prefix}.umi_only.fastq.gz \\
-        -l ${umi_length}
+        -l ${umi_length} \\
+        --perf-json ${prefix}.extract_umi_with_quality.perf.json
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -0,0 +1,41 @@
+process FASTA_INDEX {
+    tag "${meta.id}"
+    label 'process_single'
+
+    conda "${moduleDir}/prepare_reference_environment.yml"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://community-cr-prod.seqera.io/docker/registry/v2/blobs/sha256/d7/d7e24dc1e4d93ca4d3a76a78d4c834a7be3985b0e1e56fddd61662e047863a8a/data' :
+        'community.wave.seqera.io/library/bwa_htslib_samtools:83b50ff84ead50d0' }"
+
+    input:
+    tuple val(meta), path(fasta, stageAs: 'reference.fa')
+
+    output:
+    tuple val(meta), path("reference.fa.fai"), emit: fai
+    path "versions.yml"                      , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    // Built once per run and handed to every library coverage task, so no
+    // task writes an index next to the user's FASTA
+    """
+    samtools faidx $fasta
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
+    END_VERSIONS
+    """
+
+    stub:
+    """
+    touch reference.fa.fai
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        samtools: 1.22.1
+    END_VERSIONS
+    """
+}
@@ -8,31 +8,41 @@ process LIBRARY_COVERAGE {
     input:
     tuple val(meta), path(counts)
     path(reference_fasta)
+    path(reference_fai)  // cached .fai (PREPARE_REFERENCE) or [], so the FASTA is not scanned
 
     output:
     tuple val(meta), path("*_library_coverage.txt"), emit: coverage
     tuple val(meta), path("*_library_coverage.json"), emit: json
-    tuple val(meta), path("*_distribution.png"), emit: plot
+    tuple val(meta), path("*_distribution.png"), optional: true, emit: plot
+    path "*_distribution.*.json", optional: true, emit: plot_data  // MultiQC custom content
+    tuple val(meta), path("*_feature_coverage.tsv"), optional: true, emit: feature_table
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
     path "versions.yml", emit: versions
 
     when:
     task.ext.when == null || task.ext.when
 
     script:
+    def args = task.ext.args ?: ''
     def prefix = task.ext.prefix ?: "${meta.id}"
+    def fasta_index = reference_fai ? "--fasta-index ${reference_fai}" : ''
     def sample_id = meta.id
     """
-    calculate_library_coverage.py \\
+    \${UMI_WORKER_SOCKET:+umi_worker.py run} calculate_library_coverage.py \\
         --counts ${counts} \\
         --fasta ${reference_fasta} \\
+        ${fasta_index} \\
         --sample-id "${sample_id}" \\
-        --output-prefix ${prefix}
+        --output-prefix ${prefix} \\
+        --perf-json ${prefix}.calculate_library_coverage.perf.json \\
+        ${args}
     
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
         python: \$(python3 --version | sed 's/Python //g')
-        numpy: \$(python3 -c "import numpy; print(numpy.__version__)")
-        matplotlib: \$(python3 -c "import matplotlib; print(matplotlib.__version__)")
+        numpy: \$(python3 -c "from importlib.metadata import version; print(version('numpy'))")
+        matplotlib: \$(python3 -c "from importlib.metadata import version; print(version('matplotlib'))")
     END_VERSIONS
     """
 
@@ -42,6 +52,7 @@ process LIBRARY_COVERAGE {
     touch ${prefix}_library_coverage.txt
     touch ${prefix}_library_coverage.json
     touch ${prefix}_distribution.png
+    touch ${prefix}.calculate_library_coverage.perf.json
     
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -0,0 +1,61 @@
+process LIBRARY_COVERAGE_COHORT {
+    tag "${meta.id}"
+    label 'process_low'
+
+    conda "${moduleDir}/library_coverage_environment.yml"
+    container 'quay.io/biocontainers/mulled-v2-f42a44964bca5225c7860882e231a7b5488b5485:47ef981087c59f79fdbcab4d9d7316e9ac2e688d-0'
+
+    input:
+    tuple val(meta), path(counts)  // multi-BAM featureCounts matrix
+    path(reference_fasta)
+    path(reference_fai)  // cached .fai (PREPARE_REFERENCE) or [], so the FASTA is not scanned
+
+    output:
+    tuple val(meta), path("*_library_coverage_cohort.tsv"), emit: tsv
+    tuple val(meta), path("*_library_coverage_cohort.json"), emit: json
+    path "*_library_coverage.txt", emit: coverage
+    path "*_library_coverage.json", emit: sample_json
+    path "*_distribution.png", optional: true, emit: plots
+    path "*_distribution.*.json", optional: true, emit: plot_data  // MultiQC custom content
+    tuple val(meta), path("*_feature_coverage_cohort.tsv"), optional: true, emit: feature_table
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
+    path "versions.yml", emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def fasta_index = reference_fai ? "--fasta-index ${reference_fai}" : ''
+    """
+    \${UMI_WORKER_SOCKET:+umi_worker.py run} calculate_library_coverage.py \\
+        --counts ${counts} \\
+        --fasta ${reference_fasta} \\
+        ${fasta_index} \\
+        --matrix \\
+        --output-prefix ${prefix} \\
+        --perf-json ${prefix}.calculate_library_coverage.perf.json \\
+        ${args}
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+        numpy: \$(python3 -c "from importlib.metadata import version; print(version('numpy'))")
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_library_coverage_cohort.tsv
+    touch ${prefix}_library_coverage_cohort.json
+    touch ${prefix}.calculate_library_coverage.perf.json
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
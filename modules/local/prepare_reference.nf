@@ -0,0 +1,75 @@
+process PREPARE_REFERENCE {
+    tag "${meta.id}"
+    label 'process_medium'
+    // NOTE bwa index requires 5.37N memory where N is the size of the database
+    memory { [6.B * fasta.size(), 1.GB].max() }
+
+    conda "${moduleDir}/prepare_reference_environment.yml"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://community-cr-prod.seqera.io/docker/registry/v2/blobs/sha256/d7/d7e24dc1e4d93ca4d3a76a78d4c834a7be3985b0e1e56fddd61662e047863a8a/data' :
+        'community.wave.seqera.io/library/bwa_htslib_samtools:83b50ff84ead50d0' }"
+
+    // Content-addressed: the directory is named by the FASTA's sha256, so any
+    // run with the same reference (under any path) reuses the stored files
+    // and the task is skipped
+    storeDir "${params.reference_cache}/${meta.sha256}"
+
+    input:
+    tuple val(meta), path(fasta, stageAs: 'reference.fa')  // meta.sha256: FASTA content fingerprint
+
+    output:
+    tuple val(meta), path("bwa")             , emit: index
+    tuple val(meta), path("reference.fa.fai"), emit: fai
+    tuple val(meta), path("*.seqlen.tsv")    , emit: lengths
+    tuple val(meta), path("*.amplicons.bed") , emit: bed
+    path "versions.yml"                      , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: 'reference'
+    // Fixed file names: the store is keyed by content, so its files must not
+    // depend on the name the FASTA had in whichever run built them; consumers
+    // get the .fai passed explicitly. Each reference sequence is one amplicon
+    // in the BED
+    """
+    mkdir bwa
+    bwa \\
+        index \\
+        $args \\
+        -p bwa/${prefix} \\
+        $fasta
+
+    samtools faidx $fasta
+    cut -f1,2 reference.fa.fai > ${prefix}.seqlen.tsv
+    awk -v OFS='\\t' '{ print \$1, 0, \$2 }' reference.fa.fai > ${prefix}.amplicons.bed
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        bwa: \$(echo \$(bwa 2>&1) | sed 's/^.*Version: //; s/Contact:.*\$//')
+        samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: 'reference'
+    """
+    mkdir bwa
+    touch bwa/${prefix}.amb
+    touch bwa/${prefix}.ann
+    touch bwa/${prefix}.bwt
+    touch bwa/${prefix}.pac
+    touch bwa/${prefix}.sa
+    touch reference.fa.fai
+    touch ${prefix}.seqlen.tsv
+    touch ${prefix}.amplicons.bed
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        bwa: 0.7.19
+        samtools: 1.22.1
+    END_VERSIONS
+    """
+}
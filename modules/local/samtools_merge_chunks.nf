@@ -0,0 +1,49 @@
+process SAMTOOLS_MERGE_CHUNKS {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda "${moduleDir}/samtools_merge_chunks_environment.yml"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/samtools:1.22.1--h96c455f_0' :
+        'quay.io/biocontainers/samtools:1.22.1--h96c455f_0' }"
+
+    input:
+    tuple val(meta), path(bams, stageAs: 'chunks/*')  // coordinate-sorted chunk BAMs of one sample, in chunk order
+
+    output:
+    tuple val(meta), path("${prefix}.bam"), emit: bam
+    path "versions.yml"                   , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    prefix = task.ext.prefix ?: "${meta.id}"
+    // The inputs are already sorted, so merging keeps coordinate order;
+    // -c/-p collapse the identical @RG/@PG header lines of the chunks
+    """
+    samtools merge \\
+        $args \\
+        -c -p \\
+        --threads ${task.cpus - 1} \\
+        -o ${prefix}.bam \\
+        ${bams}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
+    END_VERSIONS
+    """
+
+    stub:
+    prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}.bam
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,50 @@
+process SPLIT_FASTQ {
+    tag "$meta.id"
+    label 'process_low'
+
+    conda "${moduleDir}/split_fastq_environment.yml"
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/seqkit:2.8.1--h9ee0642_0' :
+        'quay.io/biocontainers/seqkit:2.8.1--h9ee0642_0' }"
+
+    input:
+    tuple val(meta), path(reads, stageAs: 'input/reads_?.fastq.gz')
+
+    output:
+    tuple val(meta), path("chunks/*.fastq.gz"), emit: reads  // reads_<mate>.part_<N>.fastq.gz
+    path "versions.yml"                       , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def files = [reads].flatten()
+    def input = meta.single_end ? "${files[0]}" : "-1 ${files[0]} -2 ${files[1]}"
+    // Pairs stay in step: split2 cuts both mates at the same read count
+    """
+    seqkit split2 \\
+        $args \\
+        --by-size ${params.chunk_reads} \\
+        --threads ${task.cpus} \\
+        --out-dir chunks \\
+        ${input}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        seqkit: \$(seqkit version | sed 's/^seqkit v//')
+    END_VERSIONS
+    """
+
+    stub:
+    def mates = meta.single_end ? [1] : [1, 2]
+    """
+    mkdir chunks
+    ${mates.collect { "echo '' | gzip > chunks/reads_${it}.part_001.fastq.gz" }.join('\n    ')}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        seqkit: 2.8.1
+    END_VERSIONS
+    """
+}
@@ -10,7 +10,11 @@ process UMI_CONSENSUS {
 
     output:
     tuple val(meta), path("*.consensus.fasta"), emit: consensus
+    tuple val(meta), path("*.consensus.placed.bam"), path("*.consensus.placed.bam.bai"), emit: bam
+    tuple val(meta), path("*.consensus.realign.fasta"), emit: realign
     tuple val(meta), path("*.consensus_stats.txt"), emit: stats
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
     path "versions.yml", emit: versions
 
     when:
@@ -22,19 +26,22 @@ process UMI_CONSENSUS {
     def min_base_quality = params.min_base_quality ?: 20
     def min_consensus_freq = params.consensus_call_fraction ?: 0.6
     """
-    build_umi_consensus.py \\
+    \${UMI_WORKER_SOCKET:+umi_worker.py run} build_umi_consensus.py \\
         --bam ${bam} \\
         --output ${prefix}.consensus.fasta \\
         --min-family-size ${min_family_size} \\
         --min-base-quality ${min_base_quality} \\
         --min-consensus-freq ${min_consensus_freq} \\
-        --stats ${prefix}.consensus_stats.txt
+        --stats ${prefix}.consensus_stats.txt \\
+        --bam-output ${prefix}.consensus.placed.bam \\
+        --realign-fasta ${prefix}.consensus.realign.fasta \\
+        --perf-json ${prefix}.build_umi_consensus.perf.json
     
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
         python: \$(python3 --version | sed 's/Python //g')
-        pysam: \$(python3 -c "import pysam; print(pysam.__version__)")
-        biopython: \$(python3 -c "import Bio; print(Bio.__version__)")
+        pysam: \$(python3 -c "from importlib.metadata import version; print(version('pysam'))")
+        biopython: \$(python3 -c "from importlib.metadata import version; print(version('biopython'))")
     END_VERSIONS
     """
 
@@ -43,6 +50,10 @@ process UMI_CONSENSUS {
     """
     touch ${prefix}.consensus.fasta
     touch ${prefix}.consensus_stats.txt
+    touch ${prefix}.consensus.placed.bam
+    touch ${prefix}.consensus.placed.bam.bai
+    touch ${prefix}.consensus.realign.fasta
+    touch ${prefix}.build_umi_consensus.perf.json
     
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
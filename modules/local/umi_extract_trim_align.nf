@@ -0,0 +1,125 @@
+process UMI_EXTRACT_TRIM_ALIGN {
+    tag "$meta.id"
+    label 'process_high'
+
+    conda "${moduleDir}/umi_extract_trim_align_environment.yml"
+    container "umi_extract_trim_align:latest"
+
+    input:
+    tuple val(meta), path(reads)          // reads before UMI extraction (FASTP_QC output or raw)
+    tuple val(meta2), path(index)         // BWA index
+    val(umi_length)
+
+    output:
+    tuple val(meta), path("${prefix}.bam")              , emit: bam
+    tuple val(meta), path("*.umi_extract.log")          , emit: log
+    tuple val(meta), path("*.partial.umi_state")      , emit: partial
+    tuple val(meta), path("*.fastp.json")               , emit: json
+    tuple val(meta), path("*.fastp.html")               , emit: html
+    tuple val(meta), path("*.fastp.log")                , emit: fastp_log
+    path "*.perf.json"                                  , emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true   , emit: profile
+    path "versions.yml"                                 , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''    // umi_tools extract
+    def args2 = task.ext.args2 ?: ''  // fastp
+    def args3 = task.ext.args3 ?: ''  // bwa mem
+    def args4 = task.ext.args4 ?: ''  // samtools sort
+    def args5 = task.ext.args5 ?: ''  // calculate_umi_metrics.py
+    prefix = task.ext.prefix ?: "${meta.id}"
+    def r1 = meta.single_end ? (reads instanceof List ? reads[0] : reads) : reads[0]
+    def side_cpus = Math.max(1, (task.cpus / 4) as int)
+    def chunk = meta.chunk ? "--chunk ${meta.chunk}" : ''
+    // umi_tools writes R1 to stdout; for paired-end data R2 goes through a
+    // named pipe and both are interleaved record by record for fastp
+    def extract_r2 = meta.single_end ? '' : "--read2-in=${reads[1]} --read2-out=${prefix}_2.extracted.fastq"
+    def interleave = meta.single_end ? '' : "| paste - - - - | paste - <(paste - - - - < ${prefix}_2.extracted.fastq) | tr '\\t' '\\n'"
+    def fastp_interleaved = meta.single_end ? '' : '--interleaved_in'
+    def bwa_interleaved = meta.single_end ? '' : '-p'
+    def make_r2_fifo = meta.single_end ? '' : "mkfifo ${prefix}_2.extracted.fastq"
+    // Extraction, trimming, alignment and sorting as one stream: only the
+    // sorted BAM, the logs/reports and the UMI metrics state reach the disk
+    """
+    INDEX=`find -L ./ -name "*.amb" | sed 's/\\.amb\$//'`
+    mkfifo ${prefix}.umi_metrics.fastq
+    ${make_r2_fifo}
+
+    # UMI counts and qualities from a copy of the extracted R1 stream
+    calculate_umi_metrics.py \\
+        --fastq ${prefix}.umi_metrics.fastq \\
+        --original-fastq ${r1} \\
+        --umi-length ${umi_length} \\
+        --sample ${prefix} \\
+        --partial-output ${prefix}.partial.umi_state \\
+        --perf-json ${prefix}.calculate_umi_metrics.perf.json \\
+        ${chunk} \\
+        $args5 &
+    metrics_pid=\$!
+
+    umi_tools \\
+        extract \\
+        -I ${r1} \\
+        ${extract_r2} \\
+        $args \\
+        -L ${prefix}.umi_extract.log \\
+    | tee ${prefix}.umi_metrics.fastq \\
+    ${interleave} \\
+    | fastp \\
+        --stdin \\
+        ${fastp_interleaved} \\
+        --stdout \\
+        --thread ${side_cpus} \\
+        --json ${prefix}.fastp.json \\
+        --html ${prefix}.fastp.html \\
+        $args2 \\
+        2> ${prefix}.fastp.log \\
+    | bwa mem \\
+        $args3 \\
+        ${bwa_interleaved} \\
+        -t $task.cpus \\
+        \$INDEX \\
+        - \\
+    | samtools sort \\
+        $args4 \\
+        --threads ${side_cpus} \\
+        -T ${prefix}.sort \\
+        -o ${prefix}.bam \\
+        -
+
+    wait \$metrics_pid
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        umitools: \$( umi_tools --version | sed '/version:/!d; s/.*: //' )
+        fastp: \$(fastp --version 2>&1 | sed -e "s/fastp //g")
+        bwa: \$(echo \$(bwa 2>&1) | sed 's/^.*Version: //; s/Contact:.*\$//')
+        samtools: \$(echo \$(samtools --version 2>&1) | sed 's/^.*samtools //; s/Using.*\$//')
+        python: \$(python --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+
+    stub:
+    prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}.bam
+    touch ${prefix}.umi_extract.log
+    touch ${prefix}.partial.umi_state
+    touch ${prefix}.fastp.json
+    touch ${prefix}.fastp.html
+    touch ${prefix}.fastp.log
+    touch ${prefix}.calculate_umi_metrics.perf.json
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        umitools: 1.1.5
+        fastp: 1.0.1
+        bwa: 0.7.19
+        samtools: 1.22.1
+        python: 3.11
+    END_VERSIONS
+    """
+}
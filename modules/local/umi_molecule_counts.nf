@@ -0,0 +1,49 @@
+process UMI_MOLECULE_COUNTS {
+    tag "${meta.id}"
+    label 'process_low'
+
+    conda "bioconda::pysam=0.21.0 bioconda::biopython=1.81"
+    container 'quay.io/biocontainers/mulled-v2-3a59640f3fe1ed11819984087d31d68600200c3f:185a25ca79923df85b58f42deb48f5ac4481e91f-0'
+
+    input:
+    tuple val(meta), path(bam)  // umi_tools group BAM (UG tags)
+
+    output:
+    tuple val(meta), path("*.umi_counts.tsv"), emit: counts
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
+    path "versions.yml", emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def min_family_size = params.min_umi_family_size ?: 2
+    """
+    count_umi_molecules.py \\
+        --bam ${bam} \\
+        --sample-id "${meta.id}" \\
+        --output ${prefix}.umi_counts.tsv \\
+        --min-family-size ${min_family_size} \\
+        --perf-json ${prefix}.count_umi_molecules.perf.json
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+        pysam: \$(python3 -c "from importlib.metadata import version; print(version('pysam'))")
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}.umi_counts.tsv
+    touch ${prefix}.count_umi_molecules.perf.json
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,61 @@
+process UMI_QC_COHORT_AGGREGATE {
+    tag "${meta.id}"
+    label 'process_low'
+
+    conda "${moduleDir}/umi_qc_html_report_environment.yml"
+    container "umi_qc_report:latest"
+
+    input:
+    tuple val(meta), path(pre_dedup_metrics), path(post_dedup_metrics)  // versioned metrics records, all samples
+
+    output:
+    tuple val(meta), path("*_umi_qc_dashboard.html"), emit: dashboard
+    tuple val(meta), path("*_umi_metrics.tsv")      , emit: metrics
+    tuple val(meta), path("*_umi_outliers.tsv")     , emit: outliers
+    tuple val(meta), path("*_family_size_bins.tsv") , emit: family_sizes
+    tuple val(meta), path("*_position_quality.tsv") , emit: position_quality
+    path "plotly.min.js", optional: true, emit: plotlyjs
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
+    path "versions.yml", emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    aggregate_umi_cohort.py \\
+        --pre-dedup-metrics ${pre_dedup_metrics} \\
+        --post-dedup-metrics ${post_dedup_metrics} \\
+        --output-prefix ${prefix} \\
+        --perf-json ${prefix}.aggregate_umi_cohort.perf.json \\
+        ${args}
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        numpy: \$(python -c "from importlib.metadata import version; print(version('numpy'))")
+        plotly: \$(python -c "from importlib.metadata import version; print(version('plotly'))")
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}_umi_qc_dashboard.html
+    touch ${prefix}_umi_metrics.tsv
+    touch ${prefix}_umi_outliers.tsv
+    touch ${prefix}_family_size_bins.tsv
+    touch ${prefix}_position_quality.tsv
+    touch ${prefix}.aggregate_umi_cohort.perf.json
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: "3.11"
+        numpy: "1.24.3"
+        plotly: "5.18.0"
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,62 @@
+process UMI_QC_GATE {
+    tag "$meta.id"
+    label 'process_single'
+
+    conda "conda-forge::python=3.11"
+    container "quay.io/biocontainers/python:3.11"
+
+    input:
+    tuple val(meta), path(reads)  // reads before UMI extraction; only the start of R1 is read
+    val(umi_pattern)
+    val(umi_quality_filter_threshold)
+    val(umi_collision_rate_threshold)
+    val(umi_diversity_threshold)
+
+    output:
+    tuple val(meta), env(UMI_GATE_STATUS), emit: status  // 'pass' or 'fail'
+    tuple val(meta), path("*.umi_gate.json"), emit: json
+    path "*.umi_gate_mqc.json", emit: multiqc
+    path "versions.yml", emit: versions
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def r1 = reads instanceof List ? reads[0] : reads
+    """
+    UMI_GATE_STATUS=\$(umi_qc_gate.py \\
+        --fastq ${r1} \\
+        --sample ${prefix} \\
+        --umi-pattern ${umi_pattern} \\
+        --quality-threshold ${umi_quality_filter_threshold} \\
+        --diversity-threshold ${umi_diversity_threshold} \\
+        --collision-threshold ${umi_collision_rate_threshold} \\
+        --output ${prefix}.umi_gate.json \\
+        --multiqc ${prefix}.umi_gate_mqc.json \\
+        --perf-json ${prefix}.umi_qc_gate.perf.json \\
+        ${args})
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    UMI_GATE_STATUS=pass
+    touch ${prefix}.umi_gate.json
+    touch ${prefix}.umi_gate_mqc.json
+    touch ${prefix}.umi_qc_gate.perf.json
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+}
@@ -6,37 +6,42 @@ process UMI_QC_HTML_REPORT {
     container "umi_qc_report:latest"
 
     input:
-    tuple val(meta), path(pre_dedup_txt), path(pre_dedup_json), path(post_dedup_json)
+    tuple val(meta), path(pre_dedup_metrics), path(post_dedup_metrics)  // versioned metrics records
 
     output:
     tuple val(meta), path("*.umi_qc_report.html"), emit: html_report
+    path "plotly.min.js", optional: true, emit: plotlyjs
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
     path "versions.yml", emit: versions
 
     when:
     task.ext.when == null || task.ext.when
 
     script:
+    def args = task.ext.args ?: ''
     def sample = meta.id
-    def pre_txt_arg = pre_dedup_txt ? "--pre-dedup-txt ${pre_dedup_txt}" : ""
-    def pre_json_arg = pre_dedup_json ? "--pre-dedup-json ${pre_dedup_json}" : ""
+    def pre_metrics_arg = pre_dedup_metrics ? "--pre-dedup-metrics ${pre_dedup_metrics}" : ""
     """
-    generate_umi_report_plotly.py \\
-        ${pre_txt_arg} \\
-        ${pre_json_arg} \\
-        --post-dedup-json ${post_dedup_json} \\
+    \${UMI_WORKER_SOCKET:+umi_worker.py run} generate_umi_report_plotly.py \\
+        ${pre_metrics_arg} \\
+        --post-dedup-metrics ${post_dedup_metrics} \\
         --sample ${sample} \\
-        --output ${sample}.umi_qc_report.html
+        --output ${sample}.umi_qc_report.html \\
+        --perf-json ${sample}.generate_umi_report_plotly.perf.json \\
+        ${args}
     
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
         python: \$(python --version | sed 's/Python //g')
-        plotly: \$(python -c "import plotly; print(plotly.__version__)")
+        plotly: \$(python -c "from importlib.metadata import version; print(version('plotly'))")
     END_VERSIONS
     """
 
     stub:
     """
     touch ${sample}.umi_qc_report.html
+    touch ${sample}.generate_umi_report_plotly.perf.json
     
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
@@ -0,0 +1,61 @@
+process UMI_QC_HTML_REPORT_BATCH {
+    tag "${meta.id}"
+    label 'process_medium'
+
+    conda "${moduleDir}/umi_qc_html_report_environment.yml"
+    container "umi_qc_report:latest"
+
+    input:
+    tuple val(meta), val(samples), path(pre_dedup_metrics), path(post_dedup_metrics)  // versioned metrics records
+
+    output:
+    tuple val(meta), path("*.umi_qc_report.html"), emit: html_report
+    tuple val(meta), path("*.umi_qc_cohort.html"), emit: cohort_report
+    path "plotly.min.js", optional: true, emit: plotlyjs
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
+    path "versions.yml", emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def args = task.ext.args ?: ''
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    // Files arrive in the same (sorted) order as the sample names
+    def pre_records = [pre_dedup_metrics].flatten()
+    def post_records = [post_dedup_metrics].flatten()
+    def manifest_rows = samples.withIndex().collect { sample, i ->
+        [sample, '', pre_records[i] ?: '', post_records[i], "${sample}.umi_qc_report.html"].join('\\t')
+    }.join('\\n')
+    """
+    printf 'sample\\tpre_dedup_txt\\tpre_dedup_json\\tpost_dedup_json\\toutput\\n${manifest_rows}\\n' > manifest.tsv
+    
+    \${UMI_WORKER_SOCKET:+umi_worker.py run} generate_umi_report_plotly.py \\
+        --manifest manifest.tsv \\
+        --jobs ${task.cpus} \\
+        --cohort-output ${prefix}.umi_qc_cohort.html \\
+        --perf-json ${prefix}.generate_umi_report_plotly.perf.json \\
+        ${args}
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python --version | sed 's/Python //g')
+        plotly: \$(python -c "from importlib.metadata import version; print(version('plotly'))")
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    ${samples.collect { "touch ${it}.umi_qc_report.html" }.join('\n    ')}
+    touch ${prefix}.umi_qc_cohort.html
+    touch ${prefix}.generate_umi_report_plotly.perf.json
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: "3.11"
+        plotly: "5.18.0"
+    END_VERSIONS
+    """
+}
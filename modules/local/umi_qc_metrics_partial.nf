@@ -0,0 +1,54 @@
+process UMI_QC_METRICS_PARTIAL {
+    tag "$meta.id"
+    label 'process_low'
+
+    conda "conda-forge::python=3.11"
+    container "quay.io/biocontainers/python:3.11"
+
+    input:
+    tuple val(meta), path(fastq), path(extract_log), path(umi_fastq)  // one chunk: extracted reads, log, and UMI-only FASTQ
+    val(umi_length)
+
+    output:
+    tuple val(meta), path("*.partial.umi_state"), emit: partial
+    path "versions.yml", emit: versions
+    path "*.perf.json", emit: perf
+    path "*.{prof,pyinstrument.html}", optional: true, emit: profile
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    def chunk = meta.chunk ? "--chunk ${meta.chunk}" : ''
+    // Mergeable pre-dedup metrics state of one FASTQ chunk; UMI_QC_METRICS_POSTUMIEXTRACT
+    // combines the chunks of a sample into the same metrics as an unsplit run
+    """
+    calculate_umi_metrics.py \\
+        --fastq ${fastq} \\
+        --umi-fastq ${umi_fastq} \\
+        --extract-log ${extract_log} \\
+        --umi-length ${umi_length} \\
+        --sample ${prefix} \\
+        ${chunk} \\
+        --partial-output ${prefix}.partial.umi_state \\
+        --perf-json ${prefix}.calculate_umi_metrics.perf.json
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: \$(python3 --version | sed 's/Python //g')
+    END_VERSIONS
+    """
+
+    stub:
+    def prefix = task.ext.prefix ?: "${meta.id}"
+    """
+    touch ${prefix}.partial.umi_state
+    touch ${prefix}.calculate_umi_metrics.perf.json
+    
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        python: "3.11"
+    END_VERSIONS
+    """
+}
@@ -15,12 +15,14 @@ include { FASTQC as FASTQC_FASTP_TRIM } from '../../modules/nf-core/fastqc/main'
 include { MULTIQC } from '../../modules/nf-core/multiqc/main'
 include { UMITOOLS_EXTRACT } from '../../modules/nf-core/umitools/extract/main'
 include { BWA_MEM } from '../../modules/nf-core/bwa/mem/main'
+include { BWA_MEM as BWA_MEM_CONSENSUS } from '../../modules/nf-core/bwa/mem/main'
 include { BWA_INDEX } from '../../modules/nf-core/bwa/index/main'
 include { SUBREAD_FEATURECOUNTS } from '../../modules/nf-core/subread/featurecounts/main'
 
 // Load nf-core subworkflows and modules for BAM processing
 include { SAMTOOLS_INDEX } from '../../modules/nf-core/samtools/index/main'
 include { SAMTOOLS_INDEX as SAMTOOLS_INDEX_DEDUP } from '../../modules/nf-core/samtools/index/main'
+include { SAMTOOLS_INDEX as SAMTOOLS_INDEX_CONSENSUS } from '../../modules/nf-core/samtools/index/main'
 include { SAMTOOLS_STATS } from '../../modules/nf-core/samtools/stats/main'
 include { SAMTOOLS_FLAGSTAT } from '../../modules/nf-core/samtools/flagstat/main'
 include { SAMTOOLS_IDXSTATS } from '../../modules/nf-core/samtools/idxstats/main'
@@ -37,11 +39,63 @@ include { UMITOOLS_GROUP } from '../../modules/nf-core/umitools/group/main'
 
 // Load custom modules (for functionality not available in nf-core)
 include { EXTRACT_UMI_QUALITY } from '../../modules/local/extract_umi_quality'
+include { UMI_QC_METRICS_PARTIAL } from '../../modules/local/umi_qc_metrics_partial'
 include { UMI_QC_METRICS_POSTUMIEXTRACT } from '../../modules/local/umi_qc_metrics_postumiextract'
 include { UMI_QC_METRICS_POSTDEDUP } from '../../modules/local/umi_qc_metrics_postdedup'
 include { UMI_QC_HTML_REPORT } from '../../modules/local/umi_qc_html_report'
+include { UMI_QC_HTML_REPORT_BATCH } from '../../modules/local/umi_qc_html_report_batch'
+include { UMI_QC_COHORT_AGGREGATE } from '../../modules/local/umi_qc_cohort_aggregate'
 include { LIBRARY_COVERAGE } from '../../modules/local/library_coverage'
+include { LIBRARY_COVERAGE_COHORT } from '../../modules/local/library_coverage_cohort'
 include { UMI_CONSENSUS } from '../../modules/local/umi_consensus'
+include { UMI_MOLECULE_COUNTS } from '../../modules/local/umi_molecule_counts'
+include { PREPARE_REFERENCE } from '../../modules/local/prepare_reference'
+include { FASTA_INDEX } from '../../modules/local/fasta_index'
+include { SPLIT_FASTQ } from '../../modules/local/split_fastq'
+include { SAMTOOLS_MERGE_CHUNKS } from '../../modules/local/samtools_merge_chunks'
+include { SAMTOOLS_MERGE_CHUNKS as SAMTOOLS_MERGE_CONSENSUS } from '../../modules/local/samtools_merge_chunks'
+include { UMI_EXTRACT_TRIM_ALIGN } from '../../modules/local/umi_extract_trim_align'
+include { UMI_QC_GATE } from '../../modules/local/umi_qc_gate'
+
+// Meta of the sample a chunk belongs to (chunk fields dropped, sample id restored)
+def sampleMeta(meta) {
+    meta.findAll { key, value -> !(key in ['sample', 'chunk', 'chunks']) } + [id: meta.sample]
+}
+
+// sha256 of a file's content, read in blocks (key of the reference cache).
+// The result is remembered under cache_dir keyed by (real path, size, mtime),
+// so -resume and later runs with an unchanged FASTA do not re-read it in the
+// head job; a failed write only costs a rehash next time
+def fileSha256(path, cache_dir) {
+    def real = path.toRealPath()
+    def key = "path=${real}\tsize=${real.size()}\tmtime=${real.lastModified()}"
+    def key_digest = java.security.MessageDigest.getInstance('SHA-1')
+    key_digest.update(key.getBytes('UTF-8'))
+    def memo = file("${cache_dir}/sha256/${real.name}.${key_digest.digest().encodeHex().toString().take(16)}.txt")
+    if (memo.exists()) {
+        def lines = memo.readLines()
+        if (lines.size() == 2 && lines[0] == key) {
+            return lines[1]
+        }
+    }
+
+    def digest = java.security.MessageDigest.getInstance('SHA-256')
+    real.withInputStream { stream ->
+        byte[] buffer = new byte[1 << 20]
+        int n
+        while ((n = stream.read(buffer)) > 0) {
+            digest.update(buffer, 0, n)
+        }
+    }
+    def sha256 = digest.digest().encodeHex().toString()
+    try {
+        memo.parent.mkdirs()
+        memo.text = "${key}\n${sha256}\n"
+    } catch (Exception e) {
+        log.warn "Could not cache reference sha256 in ${memo}: ${e.message}"
+    }
+    sha256
+}
 
 workflow UMI_ANALYSIS_SUBWORKFLOW {
     take:
@@ -62,212 +116,396 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     main:
     ch_versions = channel.empty()
     ch_multiqc_files = channel.empty()
+    ch_perf = channel.empty()  // *.perf.json stage timings from the Python steps
+    ch_gate = channel.empty()
+
+    // FastQC runs on demand: any of 'raw', 'qc' and 'trim' in --fastqc_steps
+    def fastqc_steps = (params.fastqc_steps ?: '').tokenize(',')*.trim()
+    
+    // Fused extract/trim/align streams reads between the tools, so there are
+    // no trimmed FASTQ files to merge or run FastQC on
+    if (params.fused_preprocessing) {
+        if (params.merge_pairs) {
+            error "--fused_preprocessing cannot be combined with --merge_pairs"
+        }
+        if ('trim' in fastqc_steps) {
+            log.warn "--fused_preprocessing writes no trimmed reads; skipping FastQC step 'trim'"
+            fastqc_steps = fastqc_steps - ['trim']
+        }
+    }
 
     // Step 1: FastQC on RAW reads (before any processing)
-    ch_samples_for_fastqc_raw = samples.map { sample, fastq_1, fastq_2, is_single_end ->
-        [
-            [id: "${sample}_raw", single_end: is_single_end],
-            is_single_end ? [fastq_1] : [fastq_1, fastq_2]
-        ]
+    if ('raw' in fastqc_steps) {
+        ch_samples_for_fastqc_raw = samples.map { sample, fastq_1, fastq_2, is_single_end ->
+            [
+                [id: "${sample}_raw", single_end: is_single_end],
+                is_single_end ? [fastq_1] : [fastq_1, fastq_2]
+            ]
+        }
+        
+        FASTQC_RAW (
+            ch_samples_for_fastqc_raw
+        )
+        ch_versions = ch_versions.mix(FASTQC_RAW.out.versions)
+        ch_multiqc_files = ch_multiqc_files.mix(FASTQC_RAW.out.html.map { meta, files -> files }.flatten())
     }
-    
-    FASTQC_RAW (
-        ch_samples_for_fastqc_raw
-    )
-    ch_versions = ch_versions.mix(FASTQC_RAW.out.versions)
-    ch_multiqc_files = ch_multiqc_files.mix(FASTQC_RAW.out.html.map { meta, files -> files }.flatten())
 
-    // Step 2: FASTP QC without trimming (initial QC on raw reads)
-    // This provides QC metrics without removing any bases that might contain UMIs
-    // NOTE: We pass raw reads here, not extracted reads
-    ch_samples_for_fastp_qc = samples.map { sample, fastq_1, fastq_2, is_single_end ->
-        [
-            [id: "${sample}_qc", single_end: is_single_end],
-            is_single_end ? [fastq_1] : [fastq_1, fastq_2],
-            []  // adapter_fasta (empty for auto-detection)
-        ]
+    if (params.fastp_single_pass) {
+        // Single fastp pass: extract UMIs from the raw reads; FASTP_TRIM
+        // (after extraction) then writes both the QC JSON and the trimmed
+        // reads from one read of the input
+        ch_samples_for_extract = samples.map { sample, fastq_1, fastq_2, is_single_end ->
+            [
+                [id: sample, single_end: is_single_end],
+                is_single_end ? [fastq_1] : [fastq_1, fastq_2]
+            ]
+        }
+    } else {
+        // Step 2: FASTP QC without trimming (initial QC on raw reads)
+        // This provides QC metrics without removing any bases that might contain UMIs
+        // NOTE: We pass raw reads here, not extracted reads
+        ch_samples_for_fastp_qc = samples.map { sample, fastq_1, fastq_2, is_single_end ->
+            [
+                [id: "${sample}_qc", single_end: is_single_end],
+                is_single_end ? [fastq_1] : [fastq_1, fastq_2],
+                []  // adapter_fasta (empty for auto-detection)
+            ]
+        }
+        
+        // FASTP_QC: QC, filter, and 3' trim (NO 5' trimming to preserve UMIs)
+        // Performs adapter trimming, quality filtering, 3' end trimming
+        // but preserves 5' end where UMIs are located
+        FASTP_QC (
+            ch_samples_for_fastp_qc,
+            false,  // discard_trimmed_pass
+            false,  // save_trimmed_fail
+            false   // save_merged - CRITICAL: no merging in QC step to preserve read pairs
+        )
+        ch_versions = ch_versions.mix(FASTP_QC.out.versions)
+        ch_multiqc_files = ch_multiqc_files.mix(FASTP_QC.out.json.map { meta, files -> files }.flatten())
+        
+        // Step 2b: FastQC after FASTP_QC (check quality after first filtering)
+        if ('qc' in fastqc_steps) {
+            ch_samples_for_fastqc_after_qc = FASTP_QC.out.reads.map { meta, reads ->
+                [
+                    meta,  // Keep the "_qc" suffix in the ID
+                    reads
+                ]
+            }
+            
+            FASTQC_FASTP_QC (
+                ch_samples_for_fastqc_after_qc
+            )
+            ch_versions = ch_versions.mix(FASTQC_FASTP_QC.out.versions)
+            ch_multiqc_files = ch_multiqc_files.mix(FASTQC_FASTP_QC.out.html.map { meta, files -> files }.flatten())
+        }
+        
+        // Step 3: UMI Extraction (uses FASTP_QC filtered reads)
+        // CRITICAL: Extract UMIs from the filtered reads (5' end is intact)
+        // UMI extraction must happen BEFORE full 5' trimming
+        // Use FASTP_QC filtered reads for UMI extraction
+        // Remove the "_qc" suffix from meta.id to get original sample name
+        ch_samples_for_extract = FASTP_QC.out.reads.map { meta, reads ->
+            def original_id = meta.id.replaceAll('_qc$', '')
+            [
+                [id: original_id, single_end: meta.single_end],
+                reads
+            ]
+        }
     }
     
-    // FASTP_QC: QC, filter, and 3' trim (NO 5' trimming to preserve UMIs)
-    // Performs adapter trimming, quality filtering, 3' end trimming
-    // but preserves 5' end where UMIs are located
-    FASTP_QC (
-        ch_samples_for_fastp_qc,
-        false,  // discard_trimmed_pass
-        false,  // save_trimmed_fail
-        false   // save_merged - CRITICAL: no merging in QC step to preserve read pairs
-    )
-    ch_versions = ch_versions.mix(FASTP_QC.out.versions)
-    ch_multiqc_files = ch_multiqc_files.mix(FASTP_QC.out.json.map { meta, files -> files }.flatten())
-    
-    // Step 2b: FastQC after FASTP_QC (check quality after first filtering)
-    ch_samples_for_fastqc_after_qc = FASTP_QC.out.reads.map { meta, reads ->
-        [
-            meta,  // Keep the "_qc" suffix in the ID
-            reads
-        ]
+    // Optional early UMI QC gate: the UMI thresholds are checked on the
+    // first reads of each raw R1 (alongside FASTP_QC); samples that clearly
+    // fail them stop here instead of running extraction onwards
+    if (params.umi_gate) {
+        UMI_QC_GATE (
+            samples.map { sample, fastq_1, fastq_2, is_single_end ->
+                [[id: sample, single_end: is_single_end], fastq_1]
+            },
+            umi_pattern,
+            umi_quality_filter_threshold,
+            umi_collision_rate_threshold,
+            umi_diversity_threshold
+        )
+        ch_versions = ch_versions.mix(UMI_QC_GATE.out.versions)
+        ch_multiqc_files = ch_multiqc_files.mix(UMI_QC_GATE.out.multiqc)
+        ch_perf = ch_perf.mix(UMI_QC_GATE.out.perf)
+        ch_gate = UMI_QC_GATE.out.json
+        
+        ch_gated = ch_samples_for_extract
+            .join(UMI_QC_GATE.out.status)
+            .branch { meta, reads, status ->
+                pass: status == 'pass'
+                fail: true
+            }
+        ch_gated.fail.subscribe { meta, reads, status ->
+            log.warn "UMI QC gate failed for ${meta.id}; skipping the remaining steps (see umi_qc_metrics/gate/${meta.id}.umi_gate.json)"
+        }
+        ch_samples_for_extract = ch_gated.pass.map { meta, reads, status -> [meta, reads] }
     }
     
-    FASTQC_FASTP_QC (
-        ch_samples_for_fastqc_after_qc
-    )
-    ch_versions = ch_versions.mix(FASTQC_FASTP_QC.out.versions)
-    ch_multiqc_files = ch_multiqc_files.mix(FASTQC_FASTP_QC.out.html.map { meta, files -> files }.flatten())
-    
-    // Step 3: UMI Extraction (uses FASTP_QC filtered reads)
-    // CRITICAL: Extract UMIs from the filtered reads (5' end is intact)
-    // UMI extraction must happen BEFORE full 5' trimming
-    // Use FASTP_QC filtered reads for UMI extraction
-    // Remove the "_qc" suffix from meta.id to get original sample name
-    ch_samples_for_extract = FASTP_QC.out.reads.map { meta, reads ->
-        def original_id = meta.id.replaceAll('_qc$', '')
-        [
-            [id: original_id, single_end: meta.single_end],
-            reads
-        ]
+    // Prepare fasta as a channel with meta
+    def fasta_file = file(fasta)
+    ch_fasta = Channel.of([[id: fasta_file.baseName], fasta_file])
+    
+    // Alignment to reference sequences
+    // NOTE: Alignment must happen BEFORE UMI deduplication
+    // umi_tools dedup requires aligned BAM files with genomic coordinates
+    // Create BWA index if not provided
+    ch_fasta_fai = []
+    ch_amplicon_bed = []
+    if (params.reference_cache) {
+        // BWA index, .fai, sequence lengths and amplicon BED from a cache
+        // keyed by the FASTA's content; only built for a new reference
+        PREPARE_REFERENCE (
+            Channel.of([[id: fasta_file.baseName, sha256: fileSha256(fasta_file, params.reference_cache)], fasta_file])
+        )
+        ch_versions = ch_versions.mix(PREPARE_REFERENCE.out.versions)
+        ch_bwa_index = bwa_index ?: PREPARE_REFERENCE.out.index.first()
+        ch_fasta_fai = PREPARE_REFERENCE.out.fai.map { meta, fai -> fai }.first()
+        ch_amplicon_bed = PREPARE_REFERENCE.out.bed.map { meta, bed -> bed }.first()
+    } else if (!bwa_index) {
+        BWA_INDEX (
+            ch_fasta
+        )
+        ch_bwa_index = BWA_INDEX.out.index
+        ch_versions = ch_versions.mix(BWA_INDEX.out.versions)
+    } else {
+        ch_bwa_index = bwa_index
     }
     
-    UMITOOLS_EXTRACT (
-        ch_samples_for_extract
-    )
-    ch_versions = ch_versions.mix(UMITOOLS_EXTRACT.out.versions)
-    
-    // Step 3b: Extract UMI sequences with quality scores
-    // NOTE: Only processes R1 (Read 1) since UMI is on R1 only
-    // Combines original (FASTP_QC) and extracted (UMITOOLS_EXTRACT) reads
-    // to create UMI-only FASTQ with sequences and base-by-base quality scores
-    ch_for_umi_quality = ch_samples_for_extract
-        .join(UMITOOLS_EXTRACT.out.reads, by: 0)
-        .map { meta, original_reads, extracted_reads ->
-            [meta, original_reads, extracted_reads]
+    // Without the reference cache, index the FASTA once for library coverage
+    // (its tasks would otherwise each scan it, or write a sidecar index into
+    // the reference directory)
+    if (!params.reference_cache && (gtf || params.library_coverage_counts != 'featurecounts')) {
+        FASTA_INDEX (
+            ch_fasta
+        )
+        ch_versions = ch_versions.mix(FASTA_INDEX.out.versions)
+        ch_fasta_fai = FASTA_INDEX.out.fai.map { meta, fai -> fai }.first()
+    }
+    
+    // Optional intra-sample scatter: split each sample (after FASTP_QC, or
+    // the raw reads with --fastp_single_pass) into chunks of
+    // --chunk_reads reads (pairs), run extraction, trimming, alignment and
+    // the pre-dedup metrics per chunk and gather again before deduplication
+    if (params.chunk_reads) {
+        // Split in a task (seqkit split2) rather than in the Nextflow head
+        // job, and number each sample's chunks from its own split output;
+        // the chunk count sizes the gather steps below, so each sample
+        // moves on as soon as its own chunks are done
+        SPLIT_FASTQ(ch_samples_for_extract)
+        ch_versions = ch_versions.mix(SPLIT_FASTQ.out.versions)
+        
+        ch_reads_for_extract = SPLIT_FASTQ.out.reads
+            .flatMap { meta, files ->
+                def parts = [files].flatten().sort { (it.name =~ /\.part_(\d+)\./)[0][1] as int }
+                def chunks = meta.single_end
+                    ? parts.collect { [it] }
+                    : [parts.findAll { it.name.startsWith('reads_1.') }, parts.findAll { it.name.startsWith('reads_2.') }].transpose()
+                chunks.withIndex().collect { reads, index ->
+                    [meta + [id: "${meta.id}_chunk${index + 1}".toString(), sample: meta.id, chunk: index + 1, chunks: chunks.size()], reads]
+                }
+            }
+    } else {
+        ch_reads_for_extract = ch_samples_for_extract
+    }
+    
+    if (params.fused_preprocessing) {
+        // Fused: umi_tools extract | fastp | bwa mem | samtools sort in one
+        // task; only the sorted BAM, the logs/reports and the UMI metrics
+        // state (streamed from a copy of the extracted reads) are written
+        UMI_EXTRACT_TRIM_ALIGN (
+            ch_reads_for_extract,
+            ch_bwa_index,
+            umi_length
+        )
+        ch_versions = ch_versions.mix(UMI_EXTRACT_TRIM_ALIGN.out.versions)
+        ch_perf = ch_perf.mix(UMI_EXTRACT_TRIM_ALIGN.out.perf)
+        ch_multiqc_files = ch_multiqc_files.mix(UMI_EXTRACT_TRIM_ALIGN.out.json.map { meta, json -> json })
+        
+        // The state is built while umi_tools still runs, so the extract
+        // counts are taken from its log
+        ch_partial_states = UMI_EXTRACT_TRIM_ALIGN.out.partial.join(UMI_EXTRACT_TRIM_ALIGN.out.log, by: 0)
+        if (!params.chunk_reads) {
+            ch_metrics_input = ch_partial_states.map { meta, partial, log -> [meta, [], log, [], partial] }
         }
+        ch_mapped_bam = UMI_EXTRACT_TRIM_ALIGN.out.bam
+        ch_extracted_reads = Channel.empty()
+        ch_processed_reads = Channel.empty()
+    } else {
+        UMITOOLS_EXTRACT (
+            ch_reads_for_extract
+        )
+        ch_versions = ch_versions.mix(UMITOOLS_EXTRACT.out.versions)
+    
+        // Step 3b: Extract UMI sequences with quality scores
+        // NOTE: Only processes R1 (Read 1) since UMI is on R1 only
+        // Combines original (FASTP_QC) and extracted (UMITOOLS_EXTRACT) reads
+        // to create UMI-only FASTQ with sequences and base-by-base quality scores
+        ch_for_umi_quality = ch_reads_for_extract
+            .join(UMITOOLS_EXTRACT.out.reads, by: 0)
+            .map { meta, original_reads, extracted_reads ->
+                [meta, original_reads, extracted_reads]
+            }
     
-    EXTRACT_UMI_QUALITY (
-        ch_for_umi_quality,
-        umi_length
-    )
-    ch_versions = ch_versions.mix(EXTRACT_UMI_QUALITY.out.versions)
+        EXTRACT_UMI_QUALITY (
+            ch_for_umi_quality,
+            umi_length
+        )
+        ch_versions = ch_versions.mix(EXTRACT_UMI_QUALITY.out.versions)
+        ch_perf = ch_perf.mix(EXTRACT_UMI_QUALITY.out.perf)
         
-    // Step 3c: UMI QC Metrics - Calculate immediately after UMI extraction
-    // Uses reads AFTER quality filtering and UMI extraction, but BEFORE 5' trimming
-    // This ensures metrics reflect the actual data used for downstream analysis
-    // Use UMITOOLS_EXTRACT output (after FASTP_QC and UMI extraction)
-    // Extract R1 only for UMI QC metrics
-    ch_samples_for_qc = UMITOOLS_EXTRACT.out.reads
-        .map { meta, reads ->
-            def r1 = reads instanceof List ? reads[0] : reads
-            [meta, r1]  // Use R1 for UMI QC
+        // Step 3c: UMI QC Metrics - Calculate immediately after UMI extraction
+        // Uses reads AFTER quality filtering and UMI extraction, but BEFORE 5' trimming
+        // This ensures metrics reflect the actual data used for downstream analysis
+        // Use UMITOOLS_EXTRACT output (after FASTP_QC and UMI extraction)
+        // Extract R1 only for UMI QC metrics
+        ch_samples_for_qc = UMITOOLS_EXTRACT.out.reads
+            .map { meta, reads ->
+                def r1 = reads instanceof List ? reads[0] : reads
+                [meta, r1]  // Use R1 for UMI QC
+            }
+    
+        // Combine with extract logs and UMI-only FASTQ
+        // Join all three channels by meta
+        ch_qc_input = ch_samples_for_qc
+            .join(UMITOOLS_EXTRACT.out.log, by: 0)  // Join extract log
+            .join(EXTRACT_UMI_QUALITY.out.umi_fastq, by: 0)  // Join UMI-only FASTQ
+    
+        // ch_qc_input now has structure: [meta, fastq, log, umi_fastq]
+        if (params.chunk_reads) {
+            // Chunked: mergeable state per chunk (combined per sample below)
+            UMI_QC_METRICS_PARTIAL (
+                ch_qc_input,
+                umi_length
+            )
+            ch_versions = ch_versions.mix(UMI_QC_METRICS_PARTIAL.out.versions)
+            ch_perf = ch_perf.mix(UMI_QC_METRICS_PARTIAL.out.perf)
+            ch_partial_states = UMI_QC_METRICS_PARTIAL.out.partial.map { meta, partial -> [meta, partial, []] }
+        } else {
+            ch_metrics_input = ch_qc_input.map { meta, fastq, log, umi_fastq -> [meta, fastq, log, umi_fastq, []] }
         }
     
-    // Combine with extract logs and UMI-only FASTQ
-    // Join all three channels by meta
-    ch_qc_input = ch_samples_for_qc
-        .join(UMITOOLS_EXTRACT.out.log, by: 0)  // Join extract log
-        .join(EXTRACT_UMI_QUALITY.out.umi_fastq, by: 0)  // Join UMI-only FASTQ
+        // Use extracted reads for downstream processing
+        ch_reads_for_fastp_trim = UMITOOLS_EXTRACT.out.reads
+
+        // Step 4: FASTP with full trimming - Complete preprocessing including 5' trimming
+        // Now that UMIs are safely extracted and moved to read headers, we can trim 5' end too
+        ch_samples_for_fastp_trim = ch_reads_for_fastp_trim.map { meta, reads ->
+            [
+                meta,
+                reads,
+                []  // adapter_fasta (empty for auto-detection)
+            ]
+        }
+    
+        FASTP_TRIM (
+            ch_samples_for_fastp_trim,
+            false,  // discard_trimmed_pass
+            false,  // save_trimmed_fail
+            params.merge_pairs   // save_merged - controlled by --merge_pairs parameter
+        )
+        ch_versions = ch_versions.mix(FASTP_TRIM.out.versions)
+        ch_multiqc_files = ch_multiqc_files.mix(FASTP_TRIM.out.json.map { meta, files -> files }.flatten())
+    
+        // Step 4b: FastQC after FASTP_TRIM (check quality after full trimming)
+        // Keep as paired-end for best UMI deduplication
+        if ('trim' in fastqc_steps) {
+            FASTQC_FASTP_TRIM (
+                FASTP_TRIM.out.reads
+            )
+            ch_versions = ch_versions.mix(FASTQC_FASTP_TRIM.out.versions)
+            ch_multiqc_files = ch_multiqc_files.mix(FASTQC_FASTP_TRIM.out.html.map { meta, files -> files }.flatten())
+        }
+    
+        // Step 5: Process reads based on merge_pairs setting
+        // If merged: treat as single-end
+        // If not merged: keep as paired-end for optimal UMI deduplication
+        ch_processed_reads = FASTP_TRIM.out.reads.map { meta, reads ->
+            def is_merged = params.merge_pairs && !meta.single_end
+            def is_single = meta.single_end || is_merged
+        
+            [
+                meta + [single_end: is_single],  // Update meta with correct single_end flag (keeps chunk fields)
+                reads instanceof List ? reads[0] : reads,  // R1 or merged read
+                (reads instanceof List && reads.size() > 1 && !is_merged) ? reads[1] : [],  // R2 (empty if single-end or merged)
+                is_single  // is_single_end flag
+            ]
+        }
+
+        // Note: UMI QC Metrics are now calculated immediately after UMITOOLS_EXTRACT (Step 3c)
+        // This was moved earlier in the workflow for better logical flow
+
+        // Use processed reads (after FASTP) for alignment
+        ch_samples_for_align = ch_processed_reads.map { meta, fastq_1, fastq_2, is_single_end ->
+            [
+                meta,
+                is_single_end ? [fastq_1] : [fastq_1, fastq_2]
+            ]
+        }
+    
+        BWA_MEM (
+            ch_samples_for_align,
+            ch_bwa_index,
+            ch_fasta,
+            true  // sort_bam parameter - BWA_MEM sorts with samtools
+        )
+        ch_versions = ch_versions.mix(BWA_MEM.out.versions)
+        ch_mapped_bam = BWA_MEM.out.bam
+        ch_extracted_reads = UMITOOLS_EXTRACT.out.reads
+    }
+    
+    // Chunked: combine each sample's chunk states in chunk order into the
+    // same metrics an unsplit run produces
+    if (params.chunk_reads) {
+        ch_metrics_input = ch_partial_states
+            .map { meta, partial, log -> [groupKey(meta.sample, meta.chunks), meta, partial, log] }
+            .groupTuple()
+            .map { sample, metas, partials, logs ->
+                def ordered = [metas, partials, logs].transpose().sort { it[0].chunk }
+                [sampleMeta(metas[0]), [], ordered.collect { it[2] }.flatten(), [], ordered.collect { it[1] }]
+            }
+    }
     
-    // ch_qc_input now has structure: [meta, fastq, log, umi_fastq]
     UMI_QC_METRICS_POSTUMIEXTRACT (
-        ch_qc_input,  // Pass all inputs as single tuple
+        ch_metrics_input,  // Pass all inputs as single tuple
         umi_length,
         params.umi_quality_filter_threshold,
         params.umi_collision_rate_threshold,
         params.umi_diversity_threshold
     )
     ch_versions = ch_versions.mix(UMI_QC_METRICS_POSTUMIEXTRACT.out.versions)
+    ch_perf = ch_perf.mix(UMI_QC_METRICS_POSTUMIEXTRACT.out.perf)
     ch_multiqc_files = ch_multiqc_files.mix(UMI_QC_METRICS_POSTUMIEXTRACT.out.multiqc.map { meta, json -> json })
     
-    // Use extracted reads for downstream processing
-    ch_reads_for_fastp_trim = UMITOOLS_EXTRACT.out.reads
-
-    // Step 4: FASTP with full trimming - Complete preprocessing including 5' trimming
-    // Now that UMIs are safely extracted and moved to read headers, we can trim 5' end too
-    ch_samples_for_fastp_trim = ch_reads_for_fastp_trim.map { meta, reads ->
-        [
-            meta,
-            reads,
-            []  // adapter_fasta (empty for auto-detection)
-        ]
-    }
-    
-    FASTP_TRIM (
-        ch_samples_for_fastp_trim,
-        false,  // discard_trimmed_pass
-        false,  // save_trimmed_fail
-        params.merge_pairs   // save_merged - controlled by --merge_pairs parameter
-    )
-    ch_versions = ch_versions.mix(FASTP_TRIM.out.versions)
-    ch_multiqc_files = ch_multiqc_files.mix(FASTP_TRIM.out.json.map { meta, files -> files }.flatten())
-    
-    // Step 4b: FastQC after FASTP_TRIM (check quality after full trimming)
-    // Keep as paired-end for best UMI deduplication
-    FASTQC_FASTP_TRIM (
-        FASTP_TRIM.out.reads
-    )
-    ch_versions = ch_versions.mix(FASTQC_FASTP_TRIM.out.versions)
-    ch_multiqc_files = ch_multiqc_files.mix(FASTQC_FASTP_TRIM.out.html.map { meta, files -> files }.flatten())
-    
-    // Step 5: Process reads based on merge_pairs setting
-    // If merged: treat as single-end
-    // If not merged: keep as paired-end for optimal UMI deduplication
-    ch_processed_reads = FASTP_TRIM.out.reads.map { meta, reads ->
-        def is_merged = params.merge_pairs && !meta.single_end
-        def is_single = meta.single_end || is_merged
+    // Chunked: gather each sample's sorted chunk BAMs into one sorted BAM
+    if (params.chunk_reads) {
+        ch_chunk_bams = ch_mapped_bam
+            .map { meta, bam -> [groupKey(meta.sample, meta.chunks), meta, bam] }
+            .groupTuple()
+            .map { sample, metas, bams ->
+                def ordered = [metas, bams].transpose().sort { it[0].chunk }
+                [sampleMeta(metas[0]), ordered.collect { it[1] }]
+            }
         
-        [
-            [id: meta.id, single_end: is_single],  // Update meta with correct single_end flag
-            reads instanceof List ? reads[0] : reads,  // R1 or merged read
-            (reads instanceof List && reads.size() > 1 && !is_merged) ? reads[1] : [],  // R2 (empty if single-end or merged)
-            is_single  // is_single_end flag
-        ]
-    }
-
-    // Note: UMI QC Metrics are now calculated immediately after UMITOOLS_EXTRACT (Step 3c)
-    // This was moved earlier in the workflow for better logical flow
-
-    // Alignment to reference sequences
-    // NOTE: Alignment must happen BEFORE UMI deduplication
-    // umi_tools dedup requires aligned BAM files with genomic coordinates
-    // Create BWA index if not provided
-    if (!bwa_index) {
-        def fasta_file = file(fasta)
-        ch_fasta_for_index = Channel.of([[id: fasta_file.baseName], fasta_file])
-        BWA_INDEX (
-            ch_fasta_for_index
+        SAMTOOLS_MERGE_CHUNKS (
+            ch_chunk_bams
         )
-        ch_bwa_index = BWA_INDEX.out.index
-        ch_versions = ch_versions.mix(BWA_INDEX.out.versions)
+        ch_versions = ch_versions.mix(SAMTOOLS_MERGE_CHUNKS.out.versions)
+        ch_aligned_bam = SAMTOOLS_MERGE_CHUNKS.out.bam
     } else {
-        ch_bwa_index = bwa_index
-    }
-    
-    // Use processed reads (after FASTP) for alignment
-    ch_samples_for_align = ch_processed_reads.map { meta, fastq_1, fastq_2, is_single_end ->
-        [
-            meta,
-            is_single_end ? [fastq_1] : [fastq_1, fastq_2]
-        ]
+        ch_aligned_bam = ch_mapped_bam
     }
     
-    // Prepare fasta as a channel with meta
-    def fasta_file = file(fasta)
-    ch_fasta = Channel.of([[id: fasta_file.baseName], fasta_file])
-    
-    BWA_MEM (
-        ch_samples_for_align,
-        ch_bwa_index,
-        ch_fasta,
-        true  // sort_bam parameter - BWA_MEM sorts with samtools
-    )
-    ch_versions = ch_versions.mix(BWA_MEM.out.versions)
-    
     // Index the sorted BAM files
     SAMTOOLS_INDEX (
-        BWA_MEM.out.bam
+        ch_aligned_bam
     )
     ch_versions = ch_versions.mix(SAMTOOLS_INDEX.out.versions)
     
     // Combine BAM and BAI for statistics
-    ch_bam_bai_for_stats = BWA_MEM.out.bam
+    ch_bam_bai_for_stats = ch_aligned_bam
         .join(SAMTOOLS_INDEX.out.bai, by: 0)
         .map { meta, bam, bai -> [meta, bam, bai] }
     
@@ -293,7 +531,7 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     
     // Picard CollectAlignmentSummaryMetrics - Detailed alignment metrics
     PICARD_COLLECTALIGNMENTSUMMARYMETRICS (
-        BWA_MEM.out.bam,
+        ch_aligned_bam,
         ch_fasta
     )
     ch_versions = ch_versions.mix(PICARD_COLLECTALIGNMENTSUMMARYMETRICS.out.versions)
@@ -301,7 +539,7 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     
     // Picard CollectInsertSizeMetrics - Insert size distribution (for paired-end only)
     // Only run if reads are kept as paired-end (not merged and not originally single-end)
-    ch_paired_bam = BWA_MEM.out.bam.filter { meta, bam -> !meta.single_end }
+    ch_paired_bam = ch_aligned_bam.filter { meta, bam -> !meta.single_end }
     
     if (ch_paired_bam) {
         PICARD_COLLECTINSERTSIZEMETRICS (
@@ -315,9 +553,15 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     // Skip on macOS due to conda package availability issues
     def is_mac = System.getProperty("os.name").toLowerCase().contains("mac")
     if (!params.skip_mosdepth && !is_mac) {
-        ch_bam_bai_bed = BWA_MEM.out.bam
+        ch_bam_bai_bed = ch_aligned_bam
             .join(SAMTOOLS_INDEX.out.bai, by: 0)
             .map { meta, bam, bai -> [meta, bam, bai, []] }  // Add empty bed file
+        if (params.reference_cache) {
+            // Per-amplicon coverage from the cached amplicon BED
+            ch_bam_bai_bed = ch_bam_bai_bed
+                .combine(ch_amplicon_bed)
+                .map { meta, bam, bai, no_bed, bed -> [meta, bam, bai, bed] }
+        }
         
         MOSDEPTH (
             ch_bam_bai_bed,
@@ -331,7 +575,7 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     }
     
     // Combine BAM and BAI for grouping and deduplication
-    ch_bam_bai = BWA_MEM.out.bam
+    ch_bam_bai = ch_aligned_bam
         .join(SAMTOOLS_INDEX.out.bai, by: 0)
         .map { meta, bam, bai -> [meta, bam, bai] }
     
@@ -353,32 +597,47 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
             ch_grouped_bam_bai
         )
         ch_versions = ch_versions.mix(UMI_CONSENSUS.out.versions)
+        ch_perf = ch_perf.mix(UMI_CONSENSUS.out.perf)
         
         // Re-align consensus sequences
+        // UMI_CONSENSUS already writes families whose reads share one
+        // indel-free alignment as an aligned BAM; only the other families
+        // (indels, disagreeing clips or positions) go through BWA again
         if (params.realign_consensus) {
             // Convert FASTA to single-end reads for alignment
-            ch_consensus_reads = UMI_CONSENSUS.out.consensus
+            ch_consensus_reads = UMI_CONSENSUS.out.realign
                 .map { meta, consensus_fasta -> 
                     [[id: "${meta.id}_consensus", single_end: true], [consensus_fasta]]
                 }
             
-            BWA_MEM (
+            BWA_MEM_CONSENSUS (
                 ch_consensus_reads,
                 ch_bwa_index,
                 ch_fasta,
                 true  // sort
             )
-            ch_versions = ch_versions.mix(BWA_MEM.out.versions)
+            ch_versions = ch_versions.mix(BWA_MEM_CONSENSUS.out.versions)
+            
+            // Placed and realigned consensus into one sorted BAM
+            ch_consensus_bams = UMI_CONSENSUS.out.bam
+                .map { meta, bam, bai -> [[id: "${meta.id}_consensus", single_end: true], bam] }
+                .join(BWA_MEM_CONSENSUS.out.bam, by: 0)
+                .map { meta, placed_bam, realigned_bam -> [meta, [placed_bam, realigned_bam]] }
+            
+            SAMTOOLS_MERGE_CONSENSUS (
+                ch_consensus_bams
+            )
+            ch_versions = ch_versions.mix(SAMTOOLS_MERGE_CONSENSUS.out.versions)
             
             // Index consensus BAM
-            SAMTOOLS_INDEX (
-                BWA_MEM.out.bam
+            SAMTOOLS_INDEX_CONSENSUS (
+                SAMTOOLS_MERGE_CONSENSUS.out.bam
             )
-            ch_versions = ch_versions.mix(SAMTOOLS_INDEX.out.versions)
+            ch_versions = ch_versions.mix(SAMTOOLS_INDEX_CONSENSUS.out.versions)
             
             // Feature counting on consensus BAM
             if (gtf) {
-                ch_consensus_bam_gtf = BWA_MEM.out.bam.map { meta, bam -> [meta, bam, gtf] }
+                ch_consensus_bam_gtf = SAMTOOLS_MERGE_CONSENSUS.out.bam.map { meta, bam -> [meta, bam, gtf] }
                 
                 SUBREAD_FEATURECOUNTS (
                     ch_consensus_bam_gtf
@@ -389,10 +648,13 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
                 // Library coverage from consensus
                 LIBRARY_COVERAGE (
                     SUBREAD_FEATURECOUNTS.out.counts,
-                    ch_fasta
+                    fasta,
+                    ch_fasta_fai
                 )
                 ch_versions = ch_versions.mix(LIBRARY_COVERAGE.out.versions)
+                ch_perf = ch_perf.mix(LIBRARY_COVERAGE.out.perf)
                 ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE.out.json.map { meta, json -> json })
+                ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE.out.plot_data.flatten())
             }
         }
     }
@@ -415,6 +677,7 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
         UMITOOLS_DEDUP.out.bam
     )
     ch_versions = ch_versions.mix(UMI_QC_METRICS_POSTDEDUP.out.versions)
+    ch_perf = ch_perf.mix(UMI_QC_METRICS_POSTDEDUP.out.perf)
     
     // Index deduplicated BAM files for count generation
     SAMTOOLS_INDEX_DEDUP (
@@ -434,22 +697,101 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     ch_multiqc_files = ch_multiqc_files.mix(SAMTOOLS_IDXSTATS_DEDUP.out.idxstats.map { meta, files -> files }.flatten())
     
     // Generate HTML report from both pre-dedup and post-dedup metrics
-    // Combine pre-dedup text, pre-dedup JSON, and post-dedup JSON for comprehensive report
-    ch_combined_metrics = UMI_QC_METRICS_POSTUMIEXTRACT.out.qc_metrics
-        .join(UMI_QC_METRICS_POSTUMIEXTRACT.out.multiqc, by: 0)
-        .join(UMI_QC_METRICS_POSTDEDUP.out.multiqc, by: 0)
-        .map { meta, pre_txt, pre_json, post_json ->
-            [meta, pre_txt, pre_json, post_json]
-        }
+    // Both stages write a versioned metrics record that the report loads directly
+    ch_combined_metrics = UMI_QC_METRICS_POSTUMIEXTRACT.out.metrics
+        .join(UMI_QC_METRICS_POSTDEDUP.out.metrics, by: 0)
+    
+    if (params.umi_report_batch) {
+        // Batch mode: render every sample's report (plus a cohort dashboard)
+        // from one Python process instead of one process per sample
+        ch_batch_metrics = ch_combined_metrics
+            .toSortedList { a, b -> a[0].id <=> b[0].id }
+            .map { items ->
+                [[id: 'cohort'], items.collect { it[0].id }, items.collect { it[1] }, items.collect { it[2] }]
+            }
+        
+        UMI_QC_HTML_REPORT_BATCH (
+            ch_batch_metrics
+        )
+        ch_versions = ch_versions.mix(UMI_QC_HTML_REPORT_BATCH.out.versions)
+        ch_perf = ch_perf.mix(UMI_QC_HTML_REPORT_BATCH.out.perf)
+        ch_umi_html_report = UMI_QC_HTML_REPORT_BATCH.out.html_report
+    } else {
+        UMI_QC_HTML_REPORT (
+            ch_combined_metrics
+        )
+        ch_versions = ch_versions.mix(UMI_QC_HTML_REPORT.out.versions)
+        ch_perf = ch_perf.mix(UMI_QC_HTML_REPORT.out.perf)
+        ch_umi_html_report = UMI_QC_HTML_REPORT.out.html_report
+    }
     
-    UMI_QC_HTML_REPORT (
-        ch_combined_metrics
-    )
-    ch_versions = ch_versions.mix(UMI_QC_HTML_REPORT.out.versions)
+    // Cohort dashboard: one task reads every sample's metrics records into
+    // sample x metric tables, heatmaps and outlier flags
+    ch_umi_cohort_dashboard = Channel.empty()
+    if (params.umi_cohort_qc) {
+        ch_cohort_records = ch_combined_metrics
+            .toSortedList { a, b -> a[0].id <=> b[0].id }
+            .map { items -> [[id: 'cohort'], items.collect { it[1] }, items.collect { it[2] }] }
+        
+        UMI_QC_COHORT_AGGREGATE (
+            ch_cohort_records
+        )
+        ch_versions = ch_versions.mix(UMI_QC_COHORT_AGGREGATE.out.versions)
+        ch_perf = ch_perf.mix(UMI_QC_COHORT_AGGREGATE.out.perf)
+        ch_umi_cohort_dashboard = UMI_QC_COHORT_AGGREGATE.out.dashboard
+    }
     
     // Gene-level counting with featureCounts (if GTF provided)
     // Uses deduplicated BAM for accurate gene expression quantification
-    if (gtf) {
+    ch_library_coverage = Channel.empty()
+    ch_feature_counts = Channel.empty()
+    if (params.library_coverage_counts != 'featurecounts') {
+        // Native counting: reads/molecules/families per reference contig
+        // from one pass over the grouped BAM (no dedup BAM or featureCounts)
+        UMI_MOLECULE_COUNTS (
+            UMITOOLS_GROUP.out.bam
+        )
+        ch_versions = ch_versions.mix(UMI_MOLECULE_COUNTS.out.versions)
+        ch_perf = ch_perf.mix(UMI_MOLECULE_COUNTS.out.perf)
+        
+        LIBRARY_COVERAGE (
+            UMI_MOLECULE_COUNTS.out.counts,
+            fasta,
+            ch_fasta_fai
+        )
+        ch_versions = ch_versions.mix(LIBRARY_COVERAGE.out.versions)
+        ch_perf = ch_perf.mix(LIBRARY_COVERAGE.out.perf)
+        ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE.out.json.map { meta, json -> json })
+        ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE.out.plot_data.flatten())
+        ch_library_coverage = LIBRARY_COVERAGE.out.coverage
+    } else if (gtf && params.library_coverage_cohort) {
+        // Cohort mode: one multi-BAM featureCounts run and one coverage task
+        // for all samples, instead of one FASTA scan and plot per sample
+        ch_cohort_bams_gtf = UMITOOLS_DEDUP.out.bam
+            .toSortedList { a, b -> a[0].id <=> b[0].id }
+            .map { items ->
+                [[id: 'cohort', single_end: items[0][0].single_end], items.collect { it[1] }, gtf]
+            }
+        
+        SUBREAD_FEATURECOUNTS (
+            ch_cohort_bams_gtf
+        )
+        ch_versions = ch_versions.mix(SUBREAD_FEATURECOUNTS.out.versions)
+        ch_multiqc_files = ch_multiqc_files.mix(SUBREAD_FEATURECOUNTS.out.summary)
+        
+        // Calculate library coverage for every sample column of the matrix
+        LIBRARY_COVERAGE_COHORT (
+            SUBREAD_FEATURECOUNTS.out.counts,
+            fasta,
+            ch_fasta_fai
+        )
+        ch_versions = ch_versions.mix(LIBRARY_COVERAGE_COHORT.out.versions)
+        ch_perf = ch_perf.mix(LIBRARY_COVERAGE_COHORT.out.perf)
+        ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE_COHORT.out.sample_json.flatten())
+        ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE_COHORT.out.plot_data.flatten())
+        ch_library_coverage = LIBRARY_COVERAGE_COHORT.out.tsv
+        ch_feature_counts = SUBREAD_FEATURECOUNTS.out.counts
+    } else if (gtf) {
         ch_dedup_bam_gtf = UMITOOLS_DEDUP.out.bam.map { meta, bam -> [meta, bam, gtf] }
         
         SUBREAD_FEATURECOUNTS (
@@ -461,12 +803,20 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
         // Calculate library coverage from featureCounts output
         LIBRARY_COVERAGE (
             SUBREAD_FEATURECOUNTS.out.counts,
-            fasta
+            fasta,
+            ch_fasta_fai
         )
         ch_versions = ch_versions.mix(LIBRARY_COVERAGE.out.versions)
+        ch_perf = ch_perf.mix(LIBRARY_COVERAGE.out.perf)
         ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE.out.json.map { meta, json -> json })
+        ch_multiqc_files = ch_multiqc_files.mix(LIBRARY_COVERAGE.out.plot_data.flatten())
+        ch_library_coverage = LIBRARY_COVERAGE.out.coverage
+        ch_feature_counts = SUBREAD_FEATURECOUNTS.out.counts
     }
 
+    // Per-script stage timings, counters and peak RSS as one MultiQC table
+    ch_multiqc_files = ch_multiqc_files.mix(ch_perf)
+    
     // MultiQC Report - comprehensive report with all QC metrics
     // Prepare MultiQC config
     ch_multiqc_config = Channel.fromPath("${projectDir}/assets/multiqc_config.yaml", checkIfExists: true)
@@ -484,15 +834,18 @@ workflow UMI_ANALYSIS_SUBWORKFLOW {
     emit:
     versions = ch_versions
     multiqc = ch_multiqc_files
-    extracted = UMITOOLS_EXTRACT.out.reads
+    extracted = ch_extracted_reads
     processed = ch_processed_reads
-    aligned = BWA_MEM.out.bam
+    aligned = ch_aligned_bam
     grouped_bam = UMITOOLS_GROUP.out.bam
     groups_tsv = UMITOOLS_GROUP.out.tsv
     group_log = UMITOOLS_GROUP.out.log
     deduped = UMITOOLS_DEDUP.out.bam
-    feature_counts = gtf ? SUBREAD_FEATURECOUNTS.out.counts : Channel.empty()
-    library_coverage = gtf ? LIBRARY_COVERAGE.out.coverage : Channel.empty()
-    umi_html_report = UMI_QC_HTML_REPORT.out.html_report
+    feature_counts = ch_feature_counts
+    library_coverage = ch_library_coverage
+    umi_html_report = ch_umi_html_report
+    umi_cohort_dashboard = ch_umi_cohort_dashboard
     dedup_idxstats = SAMTOOLS_IDXSTATS_DEDUP.out.idxstats
+    gate = ch_gate
+    perf = ch_perf
 }
\ No newline at end of file